@@ -0,0 +1,207 @@
+# # Multi-LoRA adapter registry
+#
+# Fine-tuned variants are served as LoRA adapters on top of one base model, instead of one `Stub`
+# and one full-weight image per variant. `AdapterRegistry` maps adapter names to where their weights
+# live (a HuggingFace repo id or a local directory) and:
+#
+# - fetches an adapter the first time a request names it, so adding variants costs nothing until
+#   they are used,
+# - gives each adapter the stable integer id vLLM's `LoRARequest` needs,
+# - keeps the adapters resident on the GPU within a budget (count and bytes), evicting the least
+#   recently used one that has no request in flight, and
+# - records per-adapter metrics: requests, generated tokens, loads, evictions and load time.
+#
+# The registry only decides; unloading is done by the `evict` callback, which the `Model` class
+# points at the engine's `remove_lora`.
+#
+# Run `python adapters.py` to check fetching, eviction and in-flight accounting with a fake loader.
+import asyncio
+import os
+import time
+from collections import OrderedDict
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Callable, Dict, Optional, Tuple
+
+
+@dataclass
+class AdapterStats:
+    requests: int = 0
+    tokens: int = 0
+    loads: int = 0
+    evictions: int = 0
+    load_seconds: float = 0.0
+    last_used: float = 0.0
+
+
+class UnknownAdapter(KeyError):
+    pass
+
+
+def adapter_size(path: str) -> int:
+    """Bytes of adapter weights on disk, a close proxy for what they take on the GPU."""
+    return sum(
+        f.stat().st_size
+        for f in Path(path).rglob("*")
+        if f.is_file() and f.suffix in (".safetensors", ".bin")
+    )
+
+
+def download_adapter(source: str, local_dir: str) -> str:
+    if os.path.isdir(source):
+        return source
+
+    from huggingface_hub import snapshot_download
+
+    return snapshot_download(source, local_dir=local_dir)
+
+
+class AdapterRegistry:
+    def __init__(
+        self,
+        sources: Dict[str, str],
+        download_dir: str = "/adapters",
+        max_resident: int = 8,
+        max_resident_bytes: Optional[int] = None,
+        evict: Optional[Callable[[int], None]] = None,
+        fetch: Callable[[str, str], str] = download_adapter,
+    ):
+        self.sources = dict(sources)
+        self.download_dir = download_dir
+        self.max_resident = max_resident
+        self.max_resident_bytes = max_resident_bytes
+        self.evict = evict
+        self.fetch = fetch
+        self.ids = {name: i + 1 for i, name in enumerate(sorted(self.sources))}  # vLLM ids must be > 0
+        self.stats = {name: AdapterStats() for name in self.sources}
+        self._paths: Dict[str, str] = {}
+        self._sizes: Dict[str, int] = {}
+        self._resident: "OrderedDict[str, None]" = OrderedDict()
+        self._in_flight: Dict[str, int] = {}
+        self._locks: Dict[str, asyncio.Lock] = {}
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.sources
+
+    @property
+    def resident_bytes(self) -> int:
+        return sum(self._sizes.get(name, 0) for name in self._resident)
+
+    async def acquire(self, name: str) -> Tuple[int, str]:
+        """Returns `(lora_int_id, local_path)` for `name`, fetching it if needed; pair with `release`."""
+        if name not in self.sources:
+            raise UnknownAdapter(name)
+
+        lock = self._locks.setdefault(name, asyncio.Lock())
+        async with lock:
+            if name not in self._paths:
+                t0 = time.time()
+                local_dir = os.path.join(self.download_dir, name)
+                loop = asyncio.get_running_loop()
+                path = await loop.run_in_executor(None, self.fetch, self.sources[name], local_dir)
+                self._paths[name] = path
+                self._sizes[name] = adapter_size(path)
+                self.stats[name].load_seconds += time.time() - t0
+
+        if name not in self._resident:
+            self.stats[name].loads += 1
+        self._resident[name] = None
+        self._resident.move_to_end(name)
+        self._in_flight[name] = self._in_flight.get(name, 0) + 1
+        self._enforce_budget(keep=name)
+
+        stats = self.stats[name]
+        stats.requests += 1
+        stats.last_used = time.time()
+        return self.ids[name], self._paths[name]
+
+    def release(self, name: str, tokens: int = 0):
+        self._in_flight[name] -= 1
+        self.stats[name].tokens += tokens
+
+    def _over_budget(self) -> bool:
+        if len(self._resident) > self.max_resident:
+            return True
+        return self.max_resident_bytes is not None and self.resident_bytes > self.max_resident_bytes
+
+    def _enforce_budget(self, keep: str):
+        for name in list(self._resident):
+            if not self._over_budget():
+                return
+            if name == keep or self._in_flight.get(name):
+                continue
+            del self._resident[name]
+            self.stats[name].evictions += 1
+            if self.evict is not None:
+                self.evict(self.ids[name])
+
+    def metrics(self) -> Dict[str, Dict[str, float]]:
+        return {
+            name: dict(asdict(stats), resident=name in self._resident, bytes=self._sizes.get(name, 0))
+            for name, stats in self.stats.items()
+        }
+
+
+async def check():
+    """Exercises fetching, LRU and byte-budget eviction and in-flight accounting with a fake loader."""
+    import tempfile
+
+    sizes = {"a": 100, "b": 200, "c": 300}
+    fetched, evicted = [], []
+
+    with tempfile.TemporaryDirectory() as root:
+
+        def fetch(source: str, local_dir: str) -> str:
+            fetched.append(source)
+            os.makedirs(local_dir, exist_ok=True)
+            with open(os.path.join(local_dir, "adapter_model.safetensors"), "wb") as f:
+                f.write(b"\0" * sizes[source])
+            return local_dir
+
+        registry = AdapterRegistry({n: n for n in sizes}, root, max_resident=2, evict=evicted.append, fetch=fetch)
+        ids = registry.ids
+
+        # Concurrent first requests fetch an adapter once.
+        results = await asyncio.gather(*(registry.acquire("a") for _ in range(5)))
+        assert fetched == ["a"] and all(r == (ids["a"], os.path.join(root, "a")) for r in results)
+        for _ in range(5):
+            registry.release("a", tokens=10)
+        assert registry.stats["a"].requests == 5 and registry.stats["a"].tokens == 50 and registry._in_flight["a"] == 0
+
+        # Least recently used goes first.
+        for name in ("b", "c"):
+            await registry.acquire(name)
+            registry.release(name)
+        assert evicted == [ids["a"]] and list(registry._resident) == ["b", "c"]
+        await registry.acquire("a")  # Reloaded without fetching again; b is now the oldest.
+        registry.release("a")
+        assert evicted == [ids["a"], ids["b"]] and fetched == ["a", "b", "c"]
+        assert registry.stats["a"].loads == 2 and registry.stats["a"].evictions == 1
+
+        # An adapter with a request in flight is never evicted, even if that leaves the pool over budget.
+        await registry.acquire("c")  # Still resident, in flight from here on.
+        await registry.acquire("b")
+        assert evicted[-1] == ids["a"] and set(registry._resident) == {"b", "c"}
+        await registry.acquire("a")
+        assert set(registry._resident) == {"a", "b", "c"}, "b and c are both in flight"
+        for name in ("a", "b", "c"):
+            registry.release(name)
+
+        # The byte budget evicts until the resident adapters fit.
+        registry = AdapterRegistry({n: n for n in sizes}, root, max_resident=8, max_resident_bytes=400, fetch=fetch)
+        for name in ("a", "b", "c"):
+            await registry.acquire(name)
+            registry.release(name)
+        assert list(registry._resident) == ["c"] and registry.resident_bytes == 300, registry.metrics()
+
+        try:
+            await registry.acquire("missing")
+        except UnknownAdapter:
+            pass
+        else:
+            raise AssertionError("unknown adapter accepted")
+
+
+if __name__ == "__main__":
+    asyncio.run(check())
+    print("adapter registry checks passed")
@@ -0,0 +1,288 @@
+# # Autoscaling policy for the GPU classes
+#
+# The scaling knobs (`keep_warm`, `container_idle_timeout`, `allow_concurrent_inputs`) used to be
+# literals copied between modules. `AutoscalePolicy` turns the live signals we have -- the backlog
+# and runner count from `get_current_stats`, plus the tokens/s the containers report -- into a
+# recommended warm-pool size:
+#
+# - enough warm runners to serve the observed token rate at `target_utilization`, plus one per
+#   `concurrency` requests waiting in the backlog,
+# - never fewer than the floor of the time-of-day `Schedule` that is active (e.g. before the
+#   daily traffic peak), and
+# - never more than `max_cost_per_hour` allows.
+#
+# Per-container concurrency is not part of the recommendation: `allow_concurrent_inputs` is fixed
+# when the app is deployed, and inside that limit the containers adjust it themselves from KV-cache
+# pressure (see `concurrency.py`). `concurrency` here only converts the backlog into runners.
+#
+# `Autoscaler` adds hysteresis (scale up at once, scale down only after `scale_down_delay`) and
+# applies `keep_warm` when the Modal client supports it. The scheduled function that drives it runs
+# in a fresh container each time, so the hysteresis state is kept in a Modal `Dict` between
+# invocations (`load`, `save`). `simulate` replays a recorded traffic
+# trace offline against a policy, reporting cold starts, queueing delay and cost, so the policy can
+# be tuned without touching production. Run `python autoscale.py` for an example comparison.
+import asyncio
+import json
+import math
+import time
+from dataclasses import asdict, dataclass, field
+from typing import Any, Dict, Iterable, List, Optional, Set
+
+
+@dataclass
+class Schedule:
+    """Keeps at least `min_warm` runners between `start_hour` and `end_hour` (UTC, may wrap midnight)."""
+
+    start_hour: int
+    end_hour: int
+    min_warm: int
+
+    def active(self, timestamp: float) -> bool:
+        hour = time.gmtime(timestamp).tm_hour
+        if self.start_hour <= self.end_hour:
+            return self.start_hour <= hour < self.end_hour
+        return hour >= self.start_hour or hour < self.end_hour
+
+
+@dataclass
+class ScalingSignals:
+    backlog: int
+    num_total_runners: int
+    tokens_per_s: float
+    timestamp: float = field(default_factory=time.time)
+
+
+@dataclass
+class ScalingDecision:
+    keep_warm: int
+    reason: str
+
+
+@dataclass
+class AutoscalePolicy:
+    tokens_per_s_per_runner: float = 600.0
+    target_utilization: float = 0.7
+    min_warm: int = 0
+    max_warm: int = 4
+    concurrency: int = 10
+    schedules: List[Schedule] = field(default_factory=list)
+    cost_per_runner_hour: float = 3.70  # A100 40GB
+    max_cost_per_hour: Optional[float] = None
+
+    def recommend(self, signals: ScalingSignals) -> ScalingDecision:
+        capacity = self.tokens_per_s_per_runner * self.target_utilization
+        demand = math.ceil(signals.tokens_per_s / capacity) if capacity > 0 else 0
+        demand += math.ceil(signals.backlog / self.concurrency)
+        reason = f"demand {demand}"
+
+        floor = max([self.min_warm] + [s.min_warm for s in self.schedules if s.active(signals.timestamp)])
+        if floor > demand:
+            reason = f"schedule floor {floor}"
+        keep_warm = min(self.max_warm, max(floor, demand))
+
+        if self.max_cost_per_hour is not None:
+            affordable = int(self.max_cost_per_hour // self.cost_per_runner_hour)
+            if keep_warm > affordable:
+                keep_warm = affordable
+                reason = f"cost ceiling {affordable}"
+        return ScalingDecision(keep_warm=keep_warm, reason=reason)
+
+
+class Autoscaler:
+    def __init__(self, policy: AutoscalePolicy, scale_down_delay: float = 60 * 10):
+        self.policy = policy
+        self.scale_down_delay = scale_down_delay
+        self.current: Optional[ScalingDecision] = None
+        self._below_since: Optional[float] = None
+
+    def step(self, signals: ScalingSignals) -> ScalingDecision:
+        decision = self.policy.recommend(signals)
+        if self.current is None or decision.keep_warm >= self.current.keep_warm:
+            self._below_since = None
+            self.current = decision
+        elif self._below_since is None:
+            self._below_since = signals.timestamp
+        elif signals.timestamp - self._below_since >= self.scale_down_delay:
+            self._below_since = None
+            self.current = decision
+        return self.current
+
+    async def load(self, store, key: str = "autoscaler"):
+        """Restores the hysteresis state `save` left in the Modal `Dict` `store`."""
+        try:
+            state = await store.get.aio(key)
+        except KeyError:
+            return
+        except Exception as e:  # Without it we start over, which only delays a scale-down.
+            print(f"Could not load autoscaler state: {e}")
+            return
+        self.current = ScalingDecision(**state["current"]) if state.get("current") else None
+        self._below_since = state.get("below_since")
+
+    async def save(self, store, key: str = "autoscaler"):
+        state = {"current": asdict(self.current) if self.current else None, "below_since": self._below_since}
+        try:
+            await store.put.aio(key, state)
+        except Exception as e:
+            print(f"Could not save autoscaler state: {e}")
+
+    def apply(self, function, decision: ScalingDecision) -> bool:
+        """Sets `keep_warm` on a Modal function handle; returns False if the client can't."""
+        keep_warm = getattr(function, "keep_warm", None)
+        if not callable(keep_warm):
+            print(f"Autoscale recommendation (not applied): {decision}")
+            return False
+        keep_warm(decision.keep_warm)
+        print(f"Autoscale applied: {decision}")
+        return True
+
+
+def load_trace(path: str) -> List[Dict[str, Any]]:
+    """Reads a JSONL trace of `{"t": seconds, "output_tokens": n}` request arrivals."""
+    with open(path) as f:
+        return sorted((json.loads(line) for line in f if line.strip()), key=lambda r: r["t"])
+
+
+def simulate(
+    trace: Iterable[Dict[str, Any]],
+    policy: AutoscalePolicy,
+    cold_start: float = 30.0,
+    idle_timeout: float = 60 * 10,
+    tokens_per_s_per_request: float = 40.0,
+    interval: float = 60.0,
+    max_runners: int = 16,
+    scale_down_delay: float = 60 * 10,
+) -> Dict[str, float]:
+    """Replays request arrivals against `policy` and reports latency and cost.
+
+    Each runner serves `concurrency` requests at a time, each at `tokens_per_s_per_request`. A
+    request that finds no free slot on a ready runner waits for one, or for a new runner's cold
+    start, whichever comes first. Every `interval` seconds the autoscaler sees the backlog,
+    runner count and token rate of the last interval, and the warm pool is topped up to its
+    `keep_warm`; runners above it retire after `idle_timeout` without work.
+    """
+    autoscaler = Autoscaler(policy, scale_down_delay)
+    runners: List[Dict[str, Any]] = []
+    waits: List[float] = []
+    recent: List[tuple] = []  # (start, tokens) of requests, for the token rate signal
+    cold_starts = 0
+    decision = ScalingDecision(policy.min_warm, "initial")
+    next_tick = None
+
+    def spawn(at: float):
+        runners.append({"spawned": at, "ready": at + cold_start, "slots": [], "last_busy": at, "retired": None})
+
+    def live():
+        return [r for r in runners if r["retired"] is None]
+
+    def tick(at: float):
+        nonlocal decision
+        for r in live():
+            r["slots"] = [end for end in r["slots"] if end > at]
+        backlog = sum(1 for r in live() for end in r["slots"] if r["ready"] > at)
+        window = [tokens for start, tokens in recent if at - interval < start <= at]
+        signals = ScalingSignals(backlog, len(live()), sum(window) / interval, at)
+        decision = autoscaler.step(signals)
+        while len(live()) < decision.keep_warm:
+            spawn(at)
+        idle = [r for r in live() if not r["slots"] and at - r["last_busy"] >= idle_timeout]
+        for r in idle[: max(0, len(live()) - decision.keep_warm)]:
+            r["retired"] = at
+
+    trace = list(trace)
+    for request in trace:
+        t = request["t"]
+        if next_tick is None:
+            next_tick = t
+        while next_tick <= t:
+            tick(next_tick)
+            next_tick += interval
+
+        duration = request["output_tokens"] / tokens_per_s_per_request
+        best, best_start = None, math.inf
+        for r in live():
+            r["slots"] = [end for end in r["slots"] if end > t]
+            free = len(r["slots"]) < policy.concurrency
+            start = max(r["ready"], t if free else min(r["slots"]))
+            if start < best_start:
+                best, best_start = r, start
+        if best is None or (best_start > t + cold_start and len(live()) < max_runners):
+            spawn(t)
+            best, best_start = runners[-1], t + cold_start
+        if best["ready"] > t:
+            cold_starts += 1
+
+        end = best_start + duration
+        best["slots"].append(end)
+        best["last_busy"] = max(best["last_busy"], end)
+        waits.append(best_start - t)
+        recent.append((best_start, request["output_tokens"]))
+        if len(recent) > 10000:
+            recent = recent[-5000:]
+
+    end_time = max([r["last_busy"] for r in runners] + [next_tick or 0.0])
+    runner_seconds = sum((r["retired"] or end_time) - r["spawned"] for r in runners)
+    waits.sort()
+    return {
+        "requests": len(waits),
+        "cold_start_waits": cold_starts,
+        "mean_wait_s": sum(waits) / len(waits) if waits else 0.0,
+        "p99_wait_s": waits[min(len(waits) - 1, int(len(waits) * 0.99))] if waits else 0.0,
+        "runners_spawned": len(runners),
+        "runner_hours": runner_seconds / 3600,
+        "cost": runner_seconds / 3600 * policy.cost_per_runner_hour,
+    }
+
+
+def synthetic_trace(hours: int = 24, peak_rps: float = 2.0, seed: int = 0) -> List[Dict[str, Any]]:
+    """Poisson arrivals with a daytime peak between 14:00 and 22:00 UTC."""
+    import random
+
+    rng = random.Random(seed)
+    trace, t = [], 0.0
+    while t < hours * 3600:
+        hour = (t // 3600) % 24
+        rate = peak_rps if 14 <= hour < 22 else peak_rps / 200
+        t += rng.expovariate(rate)
+        trace.append({"t": t, "output_tokens": rng.randint(50, 1000)})
+    return trace
+
+
+_reports: Set[asyncio.Task] = set()
+
+
+def report_token_count(queue, num_tokens: int):
+    """Pushes a request's token count to `queue` in the background.
+
+    The put happens after the stream has finished; run inline, a failed put would turn a completed
+    request into an error (which `resumable` would then run again), so it is off the request path
+    and its failures are only logged.
+    """
+
+    async def put():
+        try:
+            await queue.put.aio(num_tokens)
+        except Exception as e:
+            print(f"Could not report token count: {e}")
+
+    task = asyncio.ensure_future(put())
+    _reports.add(task)  # The event loop only keeps weak references to tasks.
+    task.add_done_callback(_reports.discard)
+
+
+async def drain_token_counts(queue, max_items: int = 10000) -> int:
+    """Sums the per-request token counts the containers pushed to `queue` since the last drain."""
+    counts = await queue.get_many.aio(max_items, block=False)
+    return sum(counts)
+
+
+if __name__ == "__main__":
+    trace = synthetic_trace()
+    policies = {
+        "static keep_warm=1": AutoscalePolicy(min_warm=1, max_warm=1),
+        "reactive": AutoscalePolicy(min_warm=0),
+        "reactive + peak schedule": AutoscalePolicy(min_warm=0, schedules=[Schedule(13, 22, 2)]),
+        "capped at $8/h": AutoscalePolicy(min_warm=0, schedules=[Schedule(13, 22, 2)], max_cost_per_hour=8.0),
+    }
+    for name, policy in policies.items():
+        print(name, json.dumps({k: round(v, 2) for k, v in simulate(trace, policy).items()}))
@@ -0,0 +1,199 @@
+# # Offline batch generation over JSONL prompt files
+#
+# `run_batch` streams a JSONL file of prompts (`{"prompt": ..., "id": ...}` per line, `id` defaulting
+# to the line number) through a shard processor and writes one JSONL result per prompt, in input
+# order, as soon as each shard is done:
+#
+# - prompts are read lazily and cut into shards of `shard_size`, so the input can be far larger
+#   than memory,
+# - on Modal, shards are fanned out with `Model().generate_batch.map`, which keeps results in input
+#   order while the containers run them concurrently. Inside a container all prompts of a shard are
+#   submitted to the engine at once, so its continuous batching always has work queued,
+# - after every shard the output is fsynced and a checkpoint (`<output>.checkpoint`) records how
+#   many shards and bytes are durable, along with the job they belong to (the input file's path,
+#   size and hash, `shard_size` and the model). A rerun of the same job truncates any partial write
+#   and resumes after the last complete shard; a rerun with a different input, shard size or model
+#   is refused rather than appending mismatched results,
+# - a prompt that fails gets `{"id": ..., "error": ...}` as its result and the shard carries on, so
+#   one bad prompt can't fail the job on every retry, and
+# - every shard reports its prompts, errors, tokens and tokens/s.
+#
+# `python batch.py prompts.jsonl results.jsonl [--shard-size N]` runs the whole pipeline locally against the fake
+# engine from `fake_engine.py`.
+import asyncio
+import hashlib
+import json
+import os
+import time
+import uuid
+from typing import Any, Callable, Dict, Iterable, Iterator, Optional, Tuple
+
+
+def iter_shards(path: str, shard_size: int, skip: int = 0) -> Iterator[Dict[str, Any]]:
+    """Yields `{"index": n, "records": [...]}` shards of the JSONL file, skipping the first `skip`."""
+    records = []
+    index = 0
+    with open(path) as f:
+        for line_no, line in enumerate(f):
+            if not line.strip():
+                continue
+            if index >= skip:
+                record = json.loads(line)
+                record.setdefault("id", line_no)
+                records.append(record)
+            else:
+                records.append(None)  # Only counted, not parsed, while skipping.
+            if len(records) == shard_size:
+                if index >= skip:
+                    yield {"index": index, "records": records}
+                records = []
+                index += 1
+    if records and index >= skip:
+        yield {"index": index, "records": records}
+
+
+async def generate_shard(engine, shard: Dict[str, Any], sampling_params, template: str = "{user}") -> Dict[str, Any]:
+    """Runs every prompt of `shard` through an `AsyncLLMEngine`-like engine concurrently."""
+    t0 = time.time()
+
+    async def generate(record: Dict[str, Any]) -> Dict[str, Any]:
+        final = None
+        request_id = uuid.uuid4().hex
+        try:
+            async for output in engine.generate(template.format(user=record["prompt"]), sampling_params, request_id):
+                final = output
+        except Exception as e:  # Recorded in the output; the rest of the shard carries on.
+            return {"id": record["id"], "error": f"{type(e).__name__}: {e}", "num_tokens": 0}
+        completion = final.outputs[0]
+        return {
+            "id": record["id"],
+            "output": completion.text,
+            "num_tokens": len(completion.token_ids),
+            "finish_reason": completion.finish_reason,
+        }
+
+    results = await asyncio.gather(*(generate(record) for record in shard["records"]))
+    elapsed = time.time() - t0
+    num_tokens = sum(r["num_tokens"] for r in results)
+    return {
+        "index": shard["index"],
+        "results": results,
+        "num_errors": sum("error" in r for r in results),
+        "num_tokens": num_tokens,
+        "elapsed": elapsed,
+        "tokens_per_s": num_tokens / elapsed if elapsed > 0 else 0.0,
+    }
+
+
+def fingerprint(path: str) -> Dict[str, Any]:
+    """Identifies an input file by its path, size and SHA-256, read in chunks."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return {"path": os.path.abspath(path), "size": os.path.getsize(path), "sha256": digest.hexdigest()}
+
+
+class Checkpoint:
+    def __init__(self, path: str, job: Dict[str, Any]):
+        self.path = path
+        self.job = job
+
+    def load(self) -> Tuple[int, int]:
+        """Returns `(shards_done, output_bytes)` from the last run of the same job, or zeros."""
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return 0, 0
+        mismatched = sorted(k for k in self.job if state.get("job", {}).get(k) != self.job[k])
+        if mismatched:
+            raise ValueError(
+                f"{self.path} belongs to a different job ({', '.join(mismatched)} changed); "
+                "write to a new output file, or delete the output and its checkpoint to start over"
+            )
+        return state["shards_done"], state["output_bytes"]
+
+    def save(self, shards_done: int, output_bytes: int):
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"shards_done": shards_done, "output_bytes": output_bytes, "job": self.job}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+
+
+def run_batch(
+    input_path: str,
+    output_path: str,
+    process: Callable[[Iterable[Dict[str, Any]]], Iterable[Dict[str, Any]]],
+    shard_size: int = 64,
+    model: str = "",
+) -> Dict[str, Any]:
+    """Streams shards of `input_path` through `process` and appends results to `output_path` in order.
+
+    `model` names what generates the results (e.g. `"<repo>@<revision>"`); a checkpoint left by a
+    different model, input file or `shard_size` is refused.
+    """
+    job = {"input": fingerprint(input_path), "shard_size": shard_size, "model": model}
+    checkpoint = Checkpoint(output_path + ".checkpoint", job)
+    shards_done, offset = checkpoint.load()
+    if shards_done:
+        print(f"Resuming after {shards_done} shards")
+
+    t0 = time.time()
+    num_prompts = num_errors = num_tokens = 0
+    with open(output_path, "a+b") as out:
+        out.truncate(offset)
+        for shard in process(iter_shards(input_path, shard_size, skip=shards_done)):
+            if shard["index"] != shards_done:
+                raise RuntimeError(f"Shard {shard['index']} arrived out of order, expected {shards_done}")
+            for result in shard["results"]:
+                out.write((json.dumps(result) + "\n").encode())
+            out.flush()
+            os.fsync(out.fileno())
+            shards_done += 1
+            checkpoint.save(shards_done, out.tell())
+
+            num_prompts += len(shard["results"])
+            num_errors += shard["num_errors"]
+            num_tokens += shard["num_tokens"]
+            print(
+                f"Shard {shard['index']}: {len(shard['results'])} prompts ({shard['num_errors']} failed), "
+                f"{shard['num_tokens']} tokens in {shard['elapsed']:.2f}s ({shard['tokens_per_s']:.0f} tokens/s)"
+            )
+
+    elapsed = time.time() - t0
+    print(f"Wrote {num_prompts} results ({num_errors} failed, {num_tokens} tokens) in {elapsed:.2f}s")
+    return {
+        "shards_done": shards_done,
+        "prompts": num_prompts,
+        "errors": num_errors,
+        "tokens": num_tokens,
+        "elapsed": elapsed,
+    }
+
+
+def run_local(input_path: str, output_path: str, shard_size: int = 64, token_latency: Optional[float] = 0.0):
+    """Runs the batch pipeline in-process against `FakeEngine`."""
+    from fake_engine import FakeEngine
+
+    engine = FakeEngine(token_latency=token_latency or 0.0)
+
+    def process(shards):
+        for shard in shards:
+            yield asyncio.run(generate_shard(engine, shard, None))
+
+    return run_batch(input_path, output_path, process, shard_size, model="fake")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Run a JSONL prompt file through the fake engine.")
+    parser.add_argument("input", help="JSONL file of {\"prompt\": ...} lines")
+    parser.add_argument("output", help="JSONL file to append results to; rerun to resume")
+    parser.add_argument("--shard-size", type=int, default=64)
+    parser.add_argument("--token-latency", type=float, default=0.0, help="seconds per generated token")
+    args = parser.parse_args()
+    run_local(args.input, args.output, args.shard_size, args.token_latency)
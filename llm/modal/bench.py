@@ -0,0 +1,356 @@
+# # Throughput and latency benchmarks
+#
+# The throughput numbers in the module comments were measured by hand once. `run_benchmark` makes
+# them reproducible: it sends a fixed prompt set to an engine at several batch sizes (all requests
+# of a batch at once) and records, per batch size, tokens/s, time to first token and request
+# latency (p50/p99), and peak memory. Every request generates exactly `max_tokens` tokens (greedy,
+# EOS ignored where the engine allows it), so runs are comparable.
+#
+# Each app has a `bench` entrypoint (`modal run mistral_vllm.py::bench`) that runs this next to the
+# loaded model and writes a JSON report. Passing `--baseline` compares against a stored report and
+# fails on regressions beyond `--tolerance`. `python bench.py --cpu` runs the same harness against
+# the stand-in engine from `fake_engine.py`, and `--tiny-model sshleifer/tiny-gpt2` against a tiny
+# transformers model on CPU, so the harness itself can be checked in CI.
+#
+# `measure_interference` measures what long prompts do to everyone else: the inter-token latency of
+# short streams while long documents are being admitted (`modal run mistral_vllm.py::bench_prefill`,
+# see `prefill.py`).
+import asyncio
+import json
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Sequence
+
+PROMPTS = [
+    "Implement a Python function to compute the Fibonacci numbers.",
+    "What is the fable involving a fox and grapes?",
+    "Describe the city of the future, considering advances in technology, environmental changes, and societal shifts.",
+    "Think through this step by step. Solve the following system of linear equations: 3x + 2y = 14, 5x - y = 15.",
+    "Who was Emperor Norton I, and what was his significance in San Francisco's history?",
+    "Write a haiku about autumn leaves falling in a quiet forest.",
+    "Explain the difference between TCP and UDP to a new software engineer.",
+    "Summarize the plot of Romeo and Juliet in three sentences.",
+]
+DEFAULT_BATCH_SIZES = (1, 8, 32)
+
+# Higher is better for throughput; lower is better for everything else we compare.
+HIGHER_IS_BETTER = ("tokens_per_s",)
+LOWER_IS_BETTER = ("ttft_p50", "ttft_p99", "latency_p50", "latency_p99", "peak_gpu_memory_bytes")
+
+
+@dataclass
+class BenchParams:
+    """Sampling parameters for engines that aren't vLLM (`FakeEngine`, `TransformersEngine`)."""
+
+    max_tokens: int = 256
+    n: int = 1
+
+
+def percentile(values: Sequence[float], q: float) -> float:
+    """Nearest-rank percentile, `q` in [0, 100]."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(q / 100 * len(ordered))) - 1))]
+
+
+def parse_batch_sizes(text: str) -> List[int]:
+    return [int(size) for size in text.split(",") if size.strip()]
+
+
+def _reset_peak_memory():
+    try:
+        import torch
+    except ImportError:
+        return
+    if torch.cuda.is_available():
+        torch.cuda.reset_peak_memory_stats()
+
+
+def peak_memory() -> Dict[str, Optional[int]]:
+    import resource
+    import sys
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    gpu = None
+    try:
+        import torch
+
+        if torch.cuda.is_available():
+            gpu = int(torch.cuda.max_memory_allocated())
+    except ImportError:
+        pass
+    # ru_maxrss is in KiB on Linux and bytes on macOS.
+    return {"peak_rss_bytes": rss if sys.platform == "darwin" else rss * 1024, "peak_gpu_memory_bytes": gpu}
+
+
+async def _timed_request(engine, prompt: str, sampling_params, request_id: str) -> Dict[str, float]:
+    t0 = time.perf_counter()
+    ttft = None
+    final = None
+    async for output in engine.generate(prompt, sampling_params, request_id):
+        if ttft is None and output.outputs[0].token_ids:
+            ttft = time.perf_counter() - t0
+        final = output
+    latency = time.perf_counter() - t0
+    tokens = len(final.outputs[0].token_ids) if final is not None else 0
+    return {"ttft": ttft if ttft is not None else latency, "latency": latency, "tokens": tokens}
+
+
+async def measure(engine, batch_size: int, sampling_params, template: str = "{user}", prompts: Sequence[str] = PROMPTS) -> Dict[str, Any]:
+    """Sends `batch_size` requests at once and summarises them."""
+    _reset_peak_memory()
+    t0 = time.perf_counter()
+    requests = await asyncio.gather(
+        *(
+            _timed_request(engine, template.format(user=prompts[i % len(prompts)]), sampling_params, f"bench-{batch_size}-{i}")
+            for i in range(batch_size)
+        )
+    )
+    wall = time.perf_counter() - t0
+    tokens = sum(r["tokens"] for r in requests)
+    ttfts = [r["ttft"] for r in requests]
+    latencies = [r["latency"] for r in requests]
+    return dict(
+        batch_size=batch_size,
+        requests=batch_size,
+        tokens=tokens,
+        wall_s=round(wall, 4),
+        tokens_per_s=round(tokens / wall, 2) if wall > 0 else 0.0,
+        ttft_p50=round(percentile(ttfts, 50), 4),
+        ttft_p99=round(percentile(ttfts, 99), 4),
+        latency_p50=round(percentile(latencies, 50), 4),
+        latency_p99=round(percentile(latencies, 99), 4),
+        **peak_memory(),
+    )
+
+
+async def run_benchmark(
+    engine,
+    batch_sizes: Sequence[int],
+    sampling_params,
+    template: str = "{user}",
+    model: str = "",
+    engine_name: str = "vllm",
+) -> Dict[str, Any]:
+    """A JSON-serialisable report for every batch size, after one untimed warmup request."""
+    await _timed_request(engine, template.format(user=PROMPTS[0]), sampling_params, "bench-warmup")
+    results = []
+    for batch_size in batch_sizes:
+        result = await measure(engine, batch_size, sampling_params, template)
+        print(
+            f"batch {batch_size:>4}: {result['tokens_per_s']:>9.1f} tokens/s, "
+            f"TTFT p50 {result['ttft_p50']:.3f}s p99 {result['ttft_p99']:.3f}s, "
+            f"latency p50 {result['latency_p50']:.3f}s p99 {result['latency_p99']:.3f}s"
+        )
+        results.append(result)
+    return {
+        "model": model,
+        "engine": engine_name,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "max_tokens": getattr(sampling_params, "max_tokens", None),
+        "results": results,
+    }
+
+
+def long_document(words: int) -> str:
+    """A prompt of about `words` words (roughly 1.3 tokens each), asking for a summary."""
+    import itertools
+
+    body = []
+    for prompt in itertools.cycle(PROMPTS):
+        if len(body) >= words:
+            break
+        body.extend(prompt.split())
+    return "Summarize this document:\n\n" + " ".join(body[:words])
+
+
+async def _token_times(engine, prompt: str, sampling_params, request_id: str, times: List[float]):
+    seen = 0
+    async for output in engine.generate(prompt, sampling_params, request_id):
+        if len(output.outputs[0].token_ids) > seen:
+            seen = len(output.outputs[0].token_ids)
+            times.append(time.perf_counter())
+
+
+async def measure_interference(
+    engine,
+    sampling_params,
+    long_sampling_params,
+    template: str = "{user}",
+    streams: int = 16,
+    long_words: int = 3000,
+    long_prompts: int = 8,
+    interval: float = 0.5,
+) -> Dict[str, Any]:
+    """Inter-token latency of `streams` short requests while `long_prompts` long ones arrive.
+
+    The short requests start together; once they are all decoding, a prompt of `long_words` words
+    arrives every `interval` seconds. Gaps between consecutive tokens of the short requests during
+    that time are what a user sees as stalls; the long prompts' time to first token is the cost.
+    """
+    short_times: List[List[float]] = [[] for _ in range(streams)]
+    short = [
+        asyncio.ensure_future(
+            _token_times(engine, template.format(user=PROMPTS[i % len(PROMPTS)]), sampling_params, f"interference-{i}", short_times[i])
+        )
+        for i in range(streams)
+    ]
+    while not all(short_times) and not all(task.done() for task in short):
+        await asyncio.sleep(0.01)
+
+    started = time.perf_counter()
+    document = template.format(user=long_document(long_words))
+    long = []
+    for i in range(long_prompts):
+        long.append(asyncio.ensure_future(_timed_request(engine, document, long_sampling_params, f"interference-long-{i}")))
+        await asyncio.sleep(interval)
+    long_results = await asyncio.gather(*long)
+    ended = time.perf_counter()
+    for i, task in enumerate(short):
+        task.cancel()
+        await engine.abort(f"interference-{i}")
+    await asyncio.gather(*short, return_exceptions=True)
+
+    gaps = [b - a for times in short_times for a, b in zip(times, times[1:]) if started <= b <= ended]
+    ttfts = [r["ttft"] for r in long_results]
+    return dict(
+        streams=streams,
+        long_prompts=long_prompts,
+        long_words=long_words,
+        interval_s=interval,
+        itl_p50=round(percentile(gaps, 50), 4),
+        itl_p99=round(percentile(gaps, 99), 4),
+        itl_max=round(max(gaps, default=0.0), 4),
+        long_ttft_p50=round(percentile(ttfts, 50), 4),
+        long_ttft_p99=round(percentile(ttfts, 99), 4),
+    )
+
+
+def compare(report: Dict[str, Any], baseline: Dict[str, Any], tolerance: float = 0.1) -> List[str]:
+    """Regressions of `report` against `baseline`, matched by batch size, beyond `tolerance`."""
+    previous = {r["batch_size"]: r for r in baseline["results"]}
+    regressions = []
+    for result in report["results"]:
+        before = previous.get(result["batch_size"])
+        if before is None:
+            continue
+        for metric in HIGHER_IS_BETTER + LOWER_IS_BETTER:
+            new, old = result.get(metric), before.get(metric)
+            if not new or not old:
+                continue
+            change = (new - old) / old
+            if (metric in HIGHER_IS_BETTER and change < -tolerance) or (metric in LOWER_IS_BETTER and change > tolerance):
+                regressions.append(f"batch {result['batch_size']} {metric}: {old} -> {new} ({change:+.1%})")
+    return regressions
+
+
+def finish_report(report: Dict[str, Any], output: str, baseline: Optional[str] = None, tolerance: float = 0.1):
+    """Writes `report` to `output` and exits non-zero if it regressed against the `baseline` file."""
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {output}")
+    if not baseline:
+        return
+    with open(baseline) as f:
+        regressions = compare(report, json.load(f), tolerance)
+    for regression in regressions:
+        print("REGRESSION", regression)
+    if regressions:
+        raise SystemExit(1)
+    print(f"No regressions beyond {tolerance:.0%} against {baseline}")
+
+
+class TransformersEngine:
+    """Runs a transformers model behind the `generate`/`abort` interface the benchmark uses.
+
+    Each request generates on its own thread with a `TextIteratorStreamer`, which is how the
+    transformers apps serve requests, so concurrent requests are not batched together.
+    """
+
+    def __init__(self, model, tokenizer, device: str = "cpu"):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.device = device
+
+    async def generate(self, prompt: str, sampling_params, request_id: str):
+        from threading import Thread
+
+        from transformers import TextIteratorStreamer
+
+        from fake_engine import FakeCompletionOutput, FakeRequestOutput
+
+        max_tokens = getattr(sampling_params, "max_tokens", None) or 64
+        inputs = self.tokenizer(prompt, return_tensors="pt")
+        input_ids = inputs["input_ids"].to(self.device)
+        streamer = TextIteratorStreamer(self.tokenizer, skip_prompt=True, skip_special_tokens=True)
+        generated = {}
+
+        def run():
+            generated["sequences"] = self.model.generate(
+                inputs=input_ids,
+                attention_mask=inputs["attention_mask"].to(self.device),
+                max_new_tokens=max_tokens,
+                min_new_tokens=max_tokens,
+                do_sample=False,
+                streamer=streamer,
+            )
+
+        thread = Thread(target=run)
+        thread.start()
+        output = FakeCompletionOutput(index=0)
+        result = FakeRequestOutput(request_id, prompt, input_ids[0].tolist(), [output])
+        loop = asyncio.get_running_loop()
+        chunks = iter(streamer)
+        while True:
+            text = await loop.run_in_executor(None, next, chunks, None)
+            if text is None:
+                break
+            output.text += text
+            # The streamer yields words, not tokens; mark progress until the real ids are known.
+            output.token_ids.append(-1)
+            yield result
+        await loop.run_in_executor(None, thread.join)
+        output.token_ids = generated["sequences"][0, input_ids.shape[1] :].tolist()
+        output.finish_reason = "length"
+        result.finished = True
+        yield result
+
+    async def abort(self, request_id: str):
+        pass
+
+
+def main(argv: Optional[Sequence[str]] = None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--cpu", action="store_true", help="benchmark the stand-in engine (default)")
+    parser.add_argument("--tiny-model", help="benchmark a small transformers model on CPU instead")
+    parser.add_argument("--batch-sizes", default=",".join(map(str, DEFAULT_BATCH_SIZES)))
+    parser.add_argument("--max-tokens", type=int, default=64)
+    parser.add_argument("--token-latency", type=float, default=0.002, help="stand-in engine seconds per token")
+    parser.add_argument("--output", default="bench-cpu.json")
+    parser.add_argument("--baseline")
+    parser.add_argument("--tolerance", type=float, default=0.1)
+    args = parser.parse_args(argv)
+
+    params = BenchParams(max_tokens=args.max_tokens)
+    if args.tiny_model:
+        from transformers import AutoModelForCausalLM, AutoTokenizer
+
+        engine = TransformersEngine(
+            AutoModelForCausalLM.from_pretrained(args.tiny_model), AutoTokenizer.from_pretrained(args.tiny_model)
+        )
+        model, engine_name = args.tiny_model, "transformers-cpu"
+    else:
+        from fake_engine import FakeEngine
+
+        engine = FakeEngine(token_latency=args.token_latency)
+        model, engine_name = "fake", "fake"
+
+    report = asyncio.run(run_benchmark(engine, parse_batch_sizes(args.batch_sizes), params, model=model, engine_name=engine_name))
+    finish_report(report, args.output, args.baseline, args.tolerance)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,234 @@
+# # Context-length budgeting
+#
+# A prompt plus the tokens we let the model generate has to fit in its context window. Nothing
+# checked this before: long prompts failed deep inside the engine, after a GPU container had been
+# woken up for them, and `Vicuna.generate` let `history` grow until it did the same. `ContextBudget`
+# enforces `prompt_tokens + max_tokens <= context_length` from a single tokenization, with one of
+# these strategies when a request doesn't fit:
+#
+# - `"reject"`: raise `ContextOverflow`, which the web tiers turn into a 413,
+# - `"shrink"`: lower `max_tokens` to what is left, as long as that is at least `min_new_tokens`,
+# - `"truncate"`: slide the window over the prompt, dropping its oldest tokens and keeping the
+#   template and the most recent `context_length - max_tokens` tokens.
+#
+# For chat histories, `fit_turns` keeps the leading turns that must stay (the system prompt) and as
+# many of the most recent turns as fit, dropping whole turns from the middle.
+#
+# Every result reports how many tokens were dropped. Truncated text is decoded and re-tokenized by
+# the engine, which can differ from our count by a token at the cut; vLLM only enforces the prompt
+# length itself, so that is harmless.
+#
+# Run `python budget.py` to check the strategies against a whitespace tokenizer.
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+STRATEGIES = ("reject", "shrink", "truncate")
+
+
+class ContextOverflow(ValueError):
+    def __init__(self, prompt_tokens: int, max_tokens: int, context_length: int):
+        self.prompt_tokens = prompt_tokens
+        self.max_tokens = max_tokens
+        self.context_length = context_length
+        super().__init__(
+            f"Prompt of {prompt_tokens} tokens plus max_tokens={max_tokens} exceeds the "
+            f"{context_length} token context"
+        )
+
+
+def positive_int(payload: Dict[str, Any], key: str) -> Optional[int]:
+    """`payload[key]`, validated as a positive integer, or None when it isn't set."""
+    value = payload.get(key)
+    if value is None:
+        return None
+    if isinstance(value, bool) or not isinstance(value, int) or value < 1:
+        raise ValueError(f"{key} must be a positive integer, got {value!r}")
+    return value
+
+
+def parse_max_tokens(payload: Dict[str, Any]) -> Optional[int]:
+    """The requested `max_tokens`, validated as a positive integer, or None for the default."""
+    return positive_int(payload, "max_tokens")
+
+
+@dataclass
+class BudgetResult:
+    prompt_tokens: int
+    max_tokens: int
+    truncated_tokens: int = 0
+    text: Optional[str] = None  # The user text, set when `truncate` changed it.
+
+    def headers(self) -> dict:
+        return {
+            "X-Prompt-Tokens": str(self.prompt_tokens),
+            "X-Max-Tokens": str(self.max_tokens),
+            "X-Truncated-Tokens": str(self.truncated_tokens),
+        }
+
+
+@dataclass
+class ContextBudget:
+    context_length: int
+    default_max_tokens: int = 1024
+    min_new_tokens: int = 16
+
+    def check(self, prompt_tokens: int, max_tokens: Optional[int] = None, strategy: str = "shrink") -> BudgetResult:
+        """Fits a prompt of `prompt_tokens` by shrinking `max_tokens`; returns how many prompt tokens to drop."""
+        if strategy not in STRATEGIES:
+            raise ValueError(f"Unknown truncation strategy {strategy!r}, expected one of {STRATEGIES}")
+        max_tokens = min(max_tokens or self.default_max_tokens, self.context_length)
+        if prompt_tokens + max_tokens <= self.context_length:
+            return BudgetResult(prompt_tokens, max_tokens)
+
+        left = self.context_length - prompt_tokens
+        if strategy == "shrink" and left >= self.min_new_tokens:
+            return BudgetResult(prompt_tokens, left)
+        if strategy == "truncate":
+            overflow = prompt_tokens + max_tokens - self.context_length
+            return BudgetResult(prompt_tokens - overflow, max_tokens, truncated_tokens=overflow)
+        raise ContextOverflow(prompt_tokens, max_tokens, self.context_length)
+
+    def fit_prompt(
+        self,
+        tokenizer,
+        text: str,
+        template: Optional[str] = None,
+        max_tokens: Optional[int] = None,
+        strategy: str = "shrink",
+    ) -> BudgetResult:
+        """Budgets `text` sent inside `template`, tokenizing it once with a `CachedTokenizer`."""
+        ids = tokenizer.encode_batch([text])[0]
+        overhead = tokenizer.template_overhead(template)
+        result = self.check(overhead + len(ids), max_tokens, strategy)
+        if result.truncated_tokens:
+            if result.truncated_tokens >= len(ids):
+                # Even an empty user text wouldn't leave room for `max_tokens`.
+                raise ContextOverflow(overhead + len(ids), result.max_tokens, self.context_length)
+            result.text = tokenizer.tokenizer.decode(ids[result.truncated_tokens:])
+        return result
+
+    def fit_turns(
+        self,
+        turn_tokens: Sequence[int],
+        fixed_tokens: int,
+        max_tokens: Optional[int] = None,
+        keep_first: int = 0,
+        turn_size: int = 1,
+    ) -> Tuple[List[int], BudgetResult]:
+        """Indices of the turns to keep: the first `keep_first` and the most recent ones that fit.
+
+        `fixed_tokens` is everything that is always sent (template, system prompt, the new message).
+        Turns are dropped in groups of `turn_size` (2 for user/assistant pairs), oldest first.
+        """
+        max_tokens = min(max_tokens or self.default_max_tokens, self.context_length)
+        available = self.context_length - max_tokens - fixed_tokens - sum(turn_tokens[:keep_first])
+        if available < 0:
+            raise ContextOverflow(fixed_tokens + sum(turn_tokens[:keep_first]), max_tokens, self.context_length)
+
+        start = len(turn_tokens)
+        used = 0
+        while start - turn_size >= keep_first:
+            group = sum(turn_tokens[start - turn_size : start])
+            if used + group > available:
+                break
+            used += group
+            start -= turn_size
+
+        kept = list(range(keep_first)) + list(range(start, len(turn_tokens)))
+        truncated = sum(turn_tokens[keep_first:start])
+        prompt_tokens = fixed_tokens + sum(turn_tokens[:keep_first]) + used
+        return kept, BudgetResult(prompt_tokens, max_tokens, truncated_tokens=truncated)
+
+
+def check():
+    from tokenization import CachedTokenizer
+
+    class WhitespaceTokenizer:
+        """One token per word, and a BOS token, like a HuggingFace tokenizer."""
+
+        def __init__(self):
+            self.vocab = {"<s>": 0}
+            self.words = ["<s>"]
+
+        def _ids(self, text: str, add_special_tokens: bool) -> List[int]:
+            ids = [0] if add_special_tokens else []
+            for word in text.split():
+                if word not in self.vocab:
+                    self.vocab[word] = len(self.words)
+                    self.words.append(word)
+                ids.append(self.vocab[word])
+            return ids
+
+        def __call__(self, text, add_special_tokens: bool = True):
+            if isinstance(text, list):
+                return {"input_ids": [self._ids(t, add_special_tokens) for t in text]}
+            return {"input_ids": self._ids(text, add_special_tokens)}
+
+        def decode(self, ids) -> str:
+            return " ".join(self.words[i] for i in ids)
+
+    budget = ContextBudget(100, default_max_tokens=40, min_new_tokens=16)
+    assert budget.check(50) == BudgetResult(50, 40)
+    assert budget.check(50, 500) == BudgetResult(50, 50)
+    assert budget.check(70, 40) == BudgetResult(70, 30)
+    assert budget.check(70, 40, "truncate") == BudgetResult(60, 40, truncated_tokens=10)
+    for prompt_tokens, strategy in ((70, "reject"), (90, "shrink")):
+        try:
+            budget.check(prompt_tokens, 40, strategy)
+        except ContextOverflow as e:
+            assert (e.prompt_tokens, e.max_tokens, e.context_length) == (prompt_tokens, 40, 100)
+        else:
+            raise AssertionError(f"{prompt_tokens} tokens fit with {strategy!r}")
+    try:
+        budget.check(10, strategy="drop")
+    except ContextOverflow:
+        raise AssertionError("an unknown strategy is a bad request, not an overflow")
+    except ValueError:
+        pass
+
+    for value, expected in (({}, None), ({"max_tokens": 7}, 7)):
+        assert parse_max_tokens(value) == expected
+    for bad in (0, -1, 2.5, "8", True):
+        try:
+            parse_max_tokens({"max_tokens": bad})
+        except ValueError:
+            pass
+        else:
+            raise AssertionError(f"accepted max_tokens={bad!r}")
+
+    # Truncation drops the oldest user words and never the template around them.
+    tokenizer = CachedTokenizer(WhitespaceTokenizer())
+    template = "Answer the question . Q: {user} A:"
+    text = " ".join(f"w{i}" for i in range(80))
+    overhead = tokenizer.template_overhead(template)
+    assert overhead == 7, overhead  # BOS, 5 words before the user text, 1 after.
+    fitted = budget.fit_prompt(tokenizer, text, template, 40, "truncate")
+    assert fitted.truncated_tokens == overhead + 80 + 40 - 100 and fitted.max_tokens == 40
+    assert fitted.text == " ".join(f"w{i}" for i in range(fitted.truncated_tokens, 80))
+    assert fitted.prompt_tokens == len(tokenizer.tokenizer(template.format(user=fitted.text))["input_ids"]) == 60
+    assert fitted.headers()["X-Truncated-Tokens"] == "27"
+    shrunk = budget.fit_prompt(tokenizer, " ".join(f"w{i}" for i in range(60)), template, 40)
+    assert shrunk.text is None and shrunk.max_tokens == 33 and shrunk.truncated_tokens == 0
+    try:
+        budget.fit_prompt(tokenizer, "w1 w2", " ".join(["pad"] * 70) + " {user}", 40, "truncate")
+    except ContextOverflow:
+        pass
+    else:
+        raise AssertionError("truncated into the template")
+
+    # Turns: the system prompt stays, whole user/assistant pairs go from the middle, oldest first.
+    kept, result = budget.fit_turns([10, 8, 8, 8, 8, 8, 8], fixed_tokens=20, max_tokens=40, keep_first=1, turn_size=2)
+    assert kept == [0, 5, 6] and result.truncated_tokens == 32 and result.prompt_tokens == 46, (kept, result)
+    kept, result = budget.fit_turns([5, 5], fixed_tokens=10, max_tokens=40)
+    assert kept == [0, 1] and result.truncated_tokens == 0
+    try:
+        budget.fit_turns([50, 5], fixed_tokens=20, max_tokens=40, keep_first=1)
+    except ContextOverflow:
+        pass
+    else:
+        raise AssertionError("dropped a turn that must stay")
+
+
+if __name__ == "__main__":
+    check()
+    print("budget checks passed")
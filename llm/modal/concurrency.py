@@ -0,0 +1,343 @@
+# # Adaptive per-container concurrency from KV-cache pressure
+#
+# `allow_concurrent_inputs` is a constant, but how many requests fit in a container depends on how
+# long they are. Long prompts fill vLLM's KV cache, and the scheduler starts preempting and
+# swapping sequences. Short prompts leave cache, and so throughput, unused. `AimdController`
+# adjusts the effective limit from what the engine reports:
+#
+# - preemptions since the last step, swapped sequences, or GPU cache usage above
+#   `high_watermark` cut the limit multiplicatively (`decrease`), at most once per `cooldown`;
+# - when the limit was the bottleneck (requests waited at the gate) and cache usage is below
+#   `low_watermark`, it grows additively (`increase`);
+# - otherwise it holds.
+#
+# `ConcurrencyGate` enforces the limit inside the container. Modal's `allow_concurrent_inputs` must
+# be the controller's `max_limit`: Modal sends a container that many inputs before it scales out,
+# so a limit below it only holds requests at the gate that another container could be serving.
+# The apps therefore start the controller at `max_limit` and let it only back off under pressure.
+#
+# It is off by default (`adaptive=False`: the gate samples the engine and records "hold" decisions,
+# but never moves the limit). `python concurrency.py` compares static limits with the controller
+# on a simulated KV cache, and so far the controller doesn't beat a static limit there: preempted
+# sequences are recomputed cheaply enough that backing off costs more latency than it saves.
+# Enable it per app only once `--replay stats.jsonl`, fed with samples recorded from a container
+# (`modal run mistral_vllm.py::record_engine_stats`), shows pressure it would have relieved.
+# Every decision is kept for `metrics()`, along with the engine stats samples it was based on.
+import asyncio
+import json
+import math
+import time
+from collections import deque
+from dataclasses import asdict, dataclass, field
+from typing import Any, Callable, Deque, Dict, Iterable, List, Optional
+
+
+@dataclass
+class EngineStats:
+    gpu_cache_usage: float  # fraction of GPU KV blocks in use
+    num_running: int = 0
+    num_waiting: int = 0
+    num_swapped: int = 0
+    num_preemptions: int = 0  # cumulative
+    in_flight: int = 0  # requests admitted by the gate
+    queued: int = 0  # requests waiting at the gate
+    timestamp: float = field(default_factory=time.time)
+
+
+@dataclass
+class ConcurrencyDecision:
+    timestamp: float
+    limit: int
+    action: str  # "increase", "decrease" or "hold"
+    reason: str
+
+
+def instrument_preemptions(llm_engine) -> Callable[[], int]:
+    """Counts the scheduler's preemptions; returns a function reading the count.
+
+    vLLM (0.2.x) logs preemptions but doesn't count them, so `Scheduler._preempt` is wrapped.
+    """
+    scheduler = llm_engine.scheduler
+    count = [0]
+    preempt = getattr(scheduler, "_preempt", None)
+    if preempt is None:
+        print("Scheduler has no _preempt, preemptions will not be counted")
+        return lambda: 0
+
+    def counting_preempt(*args, **kwargs):
+        count[0] += 1
+        return preempt(*args, **kwargs)
+
+    scheduler._preempt = counting_preempt
+    return lambda: count[0]
+
+
+def read_engine_stats(llm_engine, preemptions: Callable[[], int] = lambda: 0) -> EngineStats:
+    """Samples KV-cache usage and queue lengths from a vLLM `LLMEngine`."""
+    scheduler = llm_engine.scheduler
+    total = scheduler.cache_config.num_gpu_blocks or 1
+    free = scheduler.block_manager.get_num_free_gpu_blocks()
+    return EngineStats(
+        gpu_cache_usage=1.0 - free / total,
+        num_running=len(scheduler.running),
+        num_waiting=len(scheduler.waiting),
+        num_swapped=len(scheduler.swapped),
+        num_preemptions=preemptions(),
+    )
+
+
+class AimdController:
+    def __init__(
+        self,
+        initial: int = 10,
+        min_limit: int = 2,
+        max_limit: int = 64,
+        increase: int = 1,
+        decrease: float = 0.7,
+        high_watermark: float = 0.95,
+        low_watermark: float = 0.85,
+        cooldown: float = 5.0,
+        history: int = 3600,
+        log: bool = True,
+        adaptive: bool = True,
+    ):
+        self.limit = initial
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.increase = increase
+        self.decrease = decrease
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.cooldown = cooldown
+        self.log = log
+        self.adaptive = adaptive
+        self.decisions: Deque[ConcurrencyDecision] = deque(maxlen=history)
+        self.samples: Deque[EngineStats] = deque(maxlen=history)
+        self.counts = {"increase": 0, "decrease": 0, "hold": 0}
+        self._last_preemptions: Optional[int] = None
+        self._last_decrease = -math.inf
+
+    def step(self, stats: EngineStats) -> ConcurrencyDecision:
+        self.samples.append(stats)
+        preempted = 0
+        if self._last_preemptions is not None:
+            preempted = max(0, stats.num_preemptions - self._last_preemptions)
+        self._last_preemptions = stats.num_preemptions
+
+        action, reason = "hold", f"cache {stats.gpu_cache_usage:.0%}"
+        pressure = None
+        if preempted:
+            pressure = f"{preempted} preemptions"
+        elif stats.num_swapped:
+            pressure = f"{stats.num_swapped} swapped"
+        elif stats.gpu_cache_usage >= self.high_watermark:
+            pressure = f"cache {stats.gpu_cache_usage:.0%} above {self.high_watermark:.0%}"
+
+        if not self.adaptive:
+            reason = pressure or reason
+        elif pressure is not None:
+            if stats.timestamp - self._last_decrease >= self.cooldown and self.limit > self.min_limit:
+                self.limit = max(self.min_limit, int(self.limit * self.decrease))
+                self._last_decrease = stats.timestamp
+                action = "decrease"
+            reason = pressure
+        elif stats.queued and stats.gpu_cache_usage < self.low_watermark and self.limit < self.max_limit:
+            self.limit = min(self.max_limit, self.limit + self.increase)
+            action, reason = "increase", f"{stats.queued} queued, cache {stats.gpu_cache_usage:.0%}"
+
+        decision = ConcurrencyDecision(stats.timestamp, self.limit, action, reason)
+        self.decisions.append(decision)
+        self.counts[action] += 1
+        if action != "hold" and self.log:
+            print(f"Concurrency limit {action}d to {self.limit}: {reason}")
+        return decision
+
+    def metrics(self, samples: bool = False, last: int = 20) -> Dict[str, Any]:
+        metrics = {
+            "limit": self.limit,
+            "counts": dict(self.counts),
+            "decisions": [asdict(d) for d in list(self.decisions)[-last:] if d.action != "hold"],
+        }
+        if samples:
+            metrics["samples"] = [asdict(s) for s in self.samples]
+        return metrics
+
+
+class ConcurrencyGate:
+    """Admits at most `controller.limit` requests at once, re-evaluating the limit every `interval`."""
+
+    def __init__(self, controller: AimdController, read_stats: Callable[[], EngineStats], interval: float = 1.0):
+        self.controller = controller
+        self.read_stats = read_stats
+        self.interval = interval
+        self.in_flight = 0
+        self.queued = 0
+        self._condition: Optional[asyncio.Condition] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def _start(self):
+        # Created on first use, so they belong to the event loop serving requests.
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                stats = self.read_stats()
+            except Exception as e:  # The gate keeps its last limit rather than failing requests.
+                print(f"Could not read engine stats: {e}")
+                continue
+            stats.in_flight, stats.queued = self.in_flight, self.queued
+            self.controller.step(stats)
+            async with self._condition:
+                self._condition.notify_all()
+
+    async def __aenter__(self):
+        self._start()
+        async with self._condition:
+            self.queued += 1
+            try:
+                await self._condition.wait_for(lambda: self.in_flight < self.controller.limit)
+            finally:
+                self.queued -= 1
+            self.in_flight += 1
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        async with self._condition:
+            self.in_flight -= 1
+            self._condition.notify()
+
+
+def load_samples(path: str) -> List[EngineStats]:
+    with open(path) as f:
+        return [EngineStats(**json.loads(line)) for line in f if line.strip()]
+
+
+def replay(samples: Iterable[EngineStats], controller: AimdController) -> Dict[str, Any]:
+    """Open-loop: what `controller` would have decided on recorded stats."""
+    limits = [controller.step(s).limit for s in samples]
+    return {
+        "samples": len(limits),
+        "counts": dict(controller.counts),
+        "min_limit": min(limits, default=controller.limit),
+        "max_limit": max(limits, default=controller.limit),
+        "final_limit": controller.limit,
+    }
+
+
+def simulate(
+    controller: Optional[AimdController],
+    static_limit: int = 10,
+    duration: float = 600.0,
+    arrival_rate: float = 1.0,
+    prompt_tokens: Callable[[Any], int] = lambda rng: rng.choice([200, 400, 3000]),
+    output_tokens: Callable[[Any], int] = lambda rng: rng.randint(100, 600),
+    num_blocks: int = 2000,
+    block_size: int = 16,
+    step_s: float = 0.05,
+    prefill_tokens_per_step: int = 4096,
+    seed: int = 0,
+) -> Dict[str, float]:
+    """Closed loop against a toy paged KV cache.
+
+    A step takes `step_s`. When a decoding sequence needs a new block and none is free, the youngest
+    resident sequence is preempted: its blocks are freed and it is prefilled again later. The controller (or `static_limit` without one) bounds how many requests are admitted.
+    """
+    import random
+
+    rng = random.Random(seed)
+    t, next_arrival, next_tick = 0.0, 0.0, 0.0
+    gate: List[Dict[str, Any]] = []  # waiting to be admitted
+    admitted: List[Dict[str, Any]] = []  # in admission order
+    preemptions, generated, latencies = 0, 0, []
+    used = 0
+
+    while t < duration:
+        while next_arrival <= t:
+            gate.append({"arrived": next_arrival, "prompt": prompt_tokens(rng), "output": output_tokens(rng), "generated": 0, "held": 0})
+            next_arrival += rng.expovariate(arrival_rate)
+        if controller is not None and t >= next_tick:
+            resident = sum(1 for s in admitted if s["held"])
+            controller.step(EngineStats(used / num_blocks, resident, len(admitted) - resident, 0, preemptions, len(admitted), len(gate), t))
+            next_tick = t + 1.0
+        limit = controller.limit if controller is not None else static_limit
+        while gate and len(admitted) < limit:
+            admitted.append(gate.pop(0))
+
+        # Like vLLM 0.2's scheduler, a step either prefills sequences that aren't resident (new or
+        # preempted ones, whose prompt and output are recomputed) while decoding waits, or
+        # decodes one token for every resident sequence.
+        waiting = [seq for seq in admitted if not seq["held"]]
+        budget, prefilled = prefill_tokens_per_step, False
+        for seq in waiting:
+            tokens = seq["prompt"] + seq["generated"]
+            need = math.ceil(tokens / block_size)
+            if (prefilled and tokens > budget) or used + need > num_blocks:
+                break
+            used += need
+            seq["held"] = need
+            budget -= tokens
+            prefilled = True
+        if prefilled:
+            t += step_s
+            continue
+
+        resident = [seq for seq in admitted if seq["held"]]
+        for seq in resident:
+            if not seq["held"]:
+                continue  # preempted earlier in this step
+            need = math.ceil((seq["prompt"] + seq["generated"] + 1) / block_size) - seq["held"]
+            # Make room by preempting the youngest resident sequences, this one last.
+            for victim in reversed(resident):
+                if used + need <= num_blocks:
+                    break
+                if victim["held"]:
+                    used -= victim["held"]
+                    victim["held"] = 0
+                    preemptions += 1
+            if not seq["held"]:
+                continue
+            used += need
+            seq["held"] += need
+            seq["generated"] += 1
+            generated += 1
+            if seq["generated"] >= seq["output"]:
+                used -= seq["held"]
+                admitted.remove(seq)
+                latencies.append(t + step_s - seq["arrived"])
+        t += step_s
+
+    latencies.sort()
+    return {
+        "completed": len(latencies),
+        "tokens_per_s": generated / duration,
+        "preemptions": preemptions,
+        "p50_latency_s": latencies[len(latencies) // 2] if latencies else 0.0,
+        "p99_latency_s": latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] if latencies else 0.0,
+        "final_limit": controller.limit if controller is not None else static_limit,
+    }
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--replay", help="JSONL of engine stats recorded with `record_engine_stats`")
+    parser.add_argument("--limit", type=int, default=10, help="allow_concurrent_inputs, the controller's max_limit")
+    parser.add_argument("--rates", default="0.5,1,2", help="arrivals per second")
+    args = parser.parse_args()
+
+    if args.replay:
+        print(json.dumps(replay(load_samples(args.replay), AimdController(args.limit, max_limit=args.limit)), indent=2))
+    else:
+        for rate in map(float, args.rates.split(",")):
+            for name, controller, static in [
+                (f"static {args.limit}", None, args.limit),
+                (f"AIMD <= {args.limit}", AimdController(args.limit, max_limit=args.limit, log=False), 0),
+            ]:
+                result = simulate(controller, static_limit=static, arrival_rate=rate)
+                print(f"{rate:4.1f} {name:>10}", json.dumps({k: round(v, 2) for k, v in result.items()}))
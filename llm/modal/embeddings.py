@@ -0,0 +1,165 @@
+# # Batched embeddings on the generation containers
+#
+# The model classes can also turn text into vectors for retrieval, so we don't need a separate
+# embedding service next to the playground. Embeddings are the mean of the last hidden state over
+# the non-padding tokens, L2-normalised.
+#
+# Requests carry many texts at once. Texts are sorted by token count and cut into batches of
+# similar length, so a batch is only padded up to its own longest text rather than the longest
+# text in the request.
+#
+# Results are returned either as JSON lists or in a compact binary format:
+#
+#     b"EMB1" | dtype (1 byte, b"f" float32 / b"e" float16) | rows (uint32 LE) | dim (uint32 LE) | rows * dim values (LE)
+#
+# `torch` and `numpy` are imported inside the functions that need them, so this module can be
+# imported by the web tier to unpack responses without either installed.
+#
+# Run `python embeddings.py` to check bucketing, the binary format and `encode` with a tiny model
+# on CPU (`--model sshleifer/tiny-gpt2` by default).
+import struct
+from typing import Any, Dict, List, Sequence
+
+MAGIC = b"EMB1"
+HEADER = struct.Struct("<4scII")
+DTYPES = {"float32": b"f", "float16": b"e"}
+MAX_TEXTS = 512
+
+
+def length_buckets(lengths: Sequence[int], max_batch_size: int = 32, max_batch_tokens: int = 16384) -> List[List[int]]:
+    """Groups indices of `lengths` into batches of similar length.
+
+    A batch closes when it reaches `max_batch_size` texts or when padding everything to its
+    longest text would exceed `max_batch_tokens`.
+    """
+    batches: List[List[int]] = []
+    batch: List[int] = []
+    for i in sorted(range(len(lengths)), key=lambda i: lengths[i]):
+        # Sorted ascending, so the text being added is the longest in the batch.
+        if batch and (len(batch) == max_batch_size or (len(batch) + 1) * lengths[i] > max_batch_tokens):
+            batches.append(batch)
+            batch = []
+        batch.append(i)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def encode(texts: Sequence[str], tokenizer, model, device: str = "cuda", max_length: int = 512, **bucket_kwargs):
+    """Embeds `texts` with `model`, returning a float32 numpy array in input order."""
+    import numpy as np
+    import torch
+
+    token_ids = [tokenizer(text, truncation=True, max_length=max_length)["input_ids"] for text in texts]
+    pad_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else 0
+
+    result = None
+    for batch in length_buckets([len(ids) for ids in token_ids], **bucket_kwargs):
+        width = max(len(token_ids[i]) for i in batch)
+        input_ids = torch.full((len(batch), width), pad_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(batch), width), dtype=torch.long)
+        for row, i in enumerate(batch):
+            input_ids[row, : len(token_ids[i])] = torch.tensor(token_ids[i])
+            attention_mask[row, : len(token_ids[i])] = 1
+
+        with torch.no_grad():
+            output = model(
+                input_ids=input_ids.to(device),
+                attention_mask=attention_mask.to(device),
+                output_hidden_states=True,
+            )
+        hidden = output.hidden_states[-1].float()
+        mask = attention_mask.to(hidden.device).unsqueeze(-1).float()
+        pooled = (hidden * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1)
+        pooled = torch.nn.functional.normalize(pooled, dim=-1).cpu().numpy()
+
+        if result is None:
+            result = np.zeros((len(texts), pooled.shape[1]), dtype=np.float32)
+        result[batch] = pooled
+
+    if result is None:
+        return np.zeros((0, 0), dtype=np.float32)
+    return result
+
+
+def pack(embeddings, dtype: str = "float32") -> bytes:
+    """Serialises a 2-D array in the binary format described above."""
+    rows, dim = embeddings.shape
+    values = embeddings.astype("<f4" if dtype == "float32" else "<f2", copy=False)
+    return HEADER.pack(MAGIC, DTYPES[dtype], rows, dim) + values.tobytes()
+
+
+def unpack(data: bytes):
+    """Reads the binary format back into a numpy array of the dtype it was sent as."""
+    import numpy as np
+
+    magic, code, rows, dim = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError("Not an embeddings payload")
+    values = np.frombuffer(data, dtype="<f4" if code == b"f" else "<f2", offset=HEADER.size)
+    return values.reshape(rows, dim)
+
+
+def parse_request(payload: Dict[str, Any]):
+    """Validates an embed payload, returning `(texts, format, dtype)` or raising `ValueError`."""
+    texts = payload.get("texts")
+    if not isinstance(texts, list) or not texts or not all(isinstance(t, str) for t in texts):
+        raise ValueError("`texts` must be a non-empty list of strings")
+    if len(texts) > MAX_TEXTS:
+        raise ValueError(f"At most {MAX_TEXTS} texts per request")
+    format = payload.get("format", "binary")
+    if format not in ("binary", "json"):
+        raise ValueError("`format` must be 'binary' or 'json'")
+    dtype = payload.get("dtype", "float32")
+    if dtype not in DTYPES:
+        raise ValueError("`dtype` must be 'float32' or 'float16'")
+    return texts, format, dtype
+
+
+if __name__ == "__main__":
+    import argparse
+
+    import numpy as np
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", default="sshleifer/tiny-gpt2")
+    args = parser.parse_args()
+
+    # Every index lands in exactly one batch, batches respect both limits, and lengths only grow.
+    lengths = [7, 1, 30, 2, 2, 90, 5, 12, 1, 64]
+    batches = length_buckets(lengths, max_batch_size=3, max_batch_tokens=100)
+    assert sorted(i for batch in batches for i in batch) == list(range(len(lengths))), batches
+    # A single text longer than the token limit still gets a batch of its own.
+    for batch in batches:
+        assert len(batch) == 1 or (len(batch) <= 3 and len(batch) * max(lengths[i] for i in batch) <= 100), batches
+    flat = [lengths[i] for batch in batches for i in batch]
+    assert flat == sorted(flat), batches
+
+    # float32 round-trips exactly, float16 to its precision.
+    vectors = np.random.default_rng(0).standard_normal((5, 16)).astype(np.float32)
+    assert np.array_equal(unpack(pack(vectors)), vectors)
+    halves = unpack(pack(vectors, "float16"))
+    assert halves.dtype == np.float16 and np.allclose(halves, vectors, rtol=1e-3, atol=1e-3)
+    assert unpack(pack(np.zeros((0, 0), dtype=np.float32))).shape == (0, 0)
+
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+
+    tokenizer = AutoTokenizer.from_pretrained(args.model)
+    model = AutoModelForCausalLM.from_pretrained(args.model).eval()
+    texts = [
+        "What is the fable involving a fox and grapes?",
+        "Hi",
+        "Describe the city of the future, considering advances in technology, environmental changes, and societal shifts.",
+        "Write a haiku about autumn leaves.",
+        "Hi",
+    ]
+    # Small batches force several buckets, so texts are embedded out of order and padded.
+    embedded = encode(texts, tokenizer, model, "cpu", max_batch_size=2)
+    assert embedded.shape[0] == len(texts) and embedded.dtype == np.float32
+    assert np.allclose(np.linalg.norm(embedded, axis=1), 1.0, atol=1e-5)
+    # Rows come back in input order and don't depend on what else was in the batch.
+    alone = np.stack([encode([text], tokenizer, model, "cpu")[0] for text in texts])
+    assert np.allclose(embedded, alone, atol=1e-5), np.abs(embedded - alone).max()
+    assert np.allclose(embedded[1], embedded[4], atol=1e-6)
+    assert np.array_equal(unpack(pack(embedded)), embedded)
+    print(f"embeddings checks passed ({args.model}: {embedded.shape[1]} dims)")
@@ -0,0 +1,107 @@
+# # Stand-in engine for running the serving code without a GPU
+#
+# `FakeEngine` has the parts of vLLM's `AsyncLLMEngine` interface that our `Model` classes use
+# (`generate` yielding cumulative `RequestOutput`-like objects, and `abort`), and
+# `fake_completion_stream` plays the role of `Model().completion_stream.remote_gen.aio` for the web
+# tier. Both produce a deterministic canned answer at a configurable token rate, so proxying,
+# batching and scheduling code can be exercised and timed locally.
+import asyncio
+import itertools
+import time
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Dict, List, Optional
+
+ANSWER = (
+    "A hungry fox saw some grapes hanging from a vine on a high trellis. He tried to reach them "
+    "by jumping as high as he could, but they were just out of reach. Finally he gave up and "
+    "walked away, saying to himself that the grapes were probably sour anyway."
+)
+
+
+@dataclass
+class FakeCompletionOutput:
+    index: int
+    text: str = ""
+    token_ids: List[int] = field(default_factory=list)
+    cumulative_logprob: float = 0.0
+    finish_reason: Optional[str] = None
+
+
+@dataclass
+class FakeRequestOutput:
+    request_id: str
+    prompt: str
+    prompt_token_ids: List[int]
+    outputs: List[FakeCompletionOutput]
+    finished: bool = False
+
+
+def fake_tokenize(text: str) -> List[str]:
+    """Whitespace-preserving word pieces, standing in for a real tokenizer."""
+    pieces, start = [], 0
+    for i in range(1, len(text) + 1):
+        if i == len(text) or text[i] == " ":
+            pieces.append(text[start:i])
+            start = i
+    return pieces
+
+
+class FakeEngine:
+    """Generates `ANSWER` (or `max_tokens` of it) one word per `token_latency` seconds.
+
+    A prompt that ends with the start of the answer is continued from there, so resumed requests
+    can be checked against uninterrupted ones.
+    """
+
+    def __init__(self, token_latency: float = 0.0, prefill_latency: float = 0.0, answer: str = ANSWER):
+        self.token_latency = token_latency
+        self.prefill_latency = prefill_latency
+        self.pieces = fake_tokenize(answer)
+        self.running: Dict[str, bool] = {}
+        self.num_generated_tokens = 0
+
+    def resume_point(self, prompt: str) -> int:
+        """How many pieces of the answer the prompt already ends with, like a greedy model continuing it."""
+        for k in range(len(self.pieces), 0, -1):
+            if prompt.endswith("".join(self.pieces[:k])):
+                return k
+        return 0
+
+    async def generate(self, prompt: str, sampling_params, request_id: str) -> AsyncIterator[FakeRequestOutput]:
+        start = self.resume_point(prompt)
+        max_tokens = getattr(sampling_params, "max_tokens", None) or len(self.pieces) - start
+        n = getattr(sampling_params, "n", 1) or 1
+        prompt_ids = [hash(piece) % 32000 for piece in fake_tokenize(prompt)]
+        outputs = [FakeCompletionOutput(index=i) for i in range(n)]
+        self.running[request_id] = True
+        try:
+            await asyncio.sleep(self.prefill_latency * len(prompt_ids))
+            pieces = itertools.islice(itertools.cycle(self.pieces), start, start + max_tokens)
+            for step, piece in enumerate(pieces):
+                if not self.running.get(request_id):
+                    return
+                await asyncio.sleep(self.token_latency)
+                for output in outputs:
+                    output.text += piece
+                    output.token_ids.append(hash(piece) % 32000)
+                    output.cumulative_logprob -= 0.1 * (output.index + 1)
+                self.num_generated_tokens += n
+                finished = step == max_tokens - 1
+                if finished:
+                    for output in outputs:
+                        output.finish_reason = "length"
+                yield FakeRequestOutput(request_id, prompt, prompt_ids, outputs, finished)
+        finally:
+            self.running.pop(request_id, None)
+
+    async def abort(self, request_id: str):
+        self.running[request_id] = False
+
+
+async def fake_completion_stream(user_question: str, *args, token_latency: float = 0.0, **kwargs) -> AsyncIterator[str]:
+    """Stand-in for `Model().completion_stream.remote_gen.aio`: yields text deltas."""
+    engine = FakeEngine(token_latency=token_latency)
+    index = 0
+    async for output in engine.generate(user_question, None, str(time.time())):
+        yield output.outputs[0].text[index:]
+        index = len(output.outputs[0].text)
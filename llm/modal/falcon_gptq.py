@@ -16,33 +16,43 @@
 # ## Setup
 #
 # First we import the components we need from `modal`.
-from typing import Dict
+from functools import lru_cache
+from typing import Any, Dict
 
-from fastapi import Depends, HTTPException, status
+from fastapi import Depends, HTTPException, Request, status
 from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
-from modal import Image, Secret, Stub, gpu, method, web_endpoint
+from modal import Dict as ModalDict, Image, Secret, Stub, Volume, gpu, method, web_endpoint
+
+from bench import PROMPTS, BenchParams, TransformersEngine, finish_report, parse_batch_sizes, run_benchmark
+from budget import ContextBudget, ContextOverflow, parse_max_tokens
+from embeddings import encode, pack, parse_request
+from lifecycle import Lifecycle, resume_prompt, resumable
+from pool import BackendPool
+from profiling import MAX_SECONDS, Profiler, ProfilerBusy, annotate_forward, write_profile
+from stopping import StoppingEngine, stop_event, stopping_options, transformers_stopping_criteria
+from tokenization import CachedTokenizer, load_fast_tokenizer
+from transport import negotiate
+from warmup import Readiness, ReadinessProbe, with_eta
+from weights import VOLUME_NAME, WEIGHTS_DIR, ensure
 
 auth_scheme = HTTPBearer()
 
 # ## Define a container image
 #
-# To take advantage of Modal's blazing fast cold-start times, we download model weights
-# into a folder inside our container image. These weights come from a quantized model
-# found on Huggingface.
-IMAGE_MODEL_DIR = "/model"
-
-
-def download_model():
-    from huggingface_hub import snapshot_download
-
-    model_name = "TheBloke/falcon-40b-instruct-GPTQ"
-    snapshot_download(model_name, local_dir=IMAGE_MODEL_DIR)
+# The weights come from a quantized model found on Huggingface. Rather than being baked into the
+# image, they are stored once on the shared, content-addressed weights volume (see `weights.py`)
+# and paged in lazily when the model loads.
+MODEL_NAME = "TheBloke/falcon-40b-instruct-GPTQ"
+MODEL_REVISION = "main"
+# Falcon's context window. Clients send the whole prompt, instructions included, so there is no
+# user text we could drop safely: prompts that don't leave room for `max_tokens` shrink it, or are
+# rejected with a 413 by the web tier.
+budget = ContextBudget(2048, default_max_tokens=512)
+TOKENIZER_DIR = "/tokenizer"
 
 
 # Now, we define our image. We'll use the `debian-slim` base image, and install the dependencies we need
-# using [`pip_install`](/docs/reference/modal.Image#pip_install). At the end, we'll use
-# [`run_function`](/docs/guide/custom-container#running-a-function-as-a-build-step-beta) to run the
-# function defined above as part of the image build.
+# using [`pip_install`](/docs/reference/modal.Image#pip_install).
 
 image = (
     Image.debian_slim(python_version="3.10")
@@ -53,11 +63,13 @@ image = (
         "auto-gptq @ git+https://github.com/PanQiWei/AutoGPTQ.git@b5db750c00e5f3f195382068433a3408ec3e8f3c",
         "einops==0.6.1",
     )
-    .run_function(download_model)
 )
+weights_volume = Volume.persisted(VOLUME_NAME)
 
 # Let's instantiate and name our [Stub](/docs/guide/apps).
 stub = Stub(name="example-falcon-gptq", image=image)
+# Containers record when they start and how long cold starts take here; see `warmup.py`.
+stub.warmup_stats = ModalDict.new()
 
 
 # ## The model class
@@ -75,17 +87,26 @@ stub = Stub(name="example-falcon-gptq", image=image)
 #
 # Note that we need to create a separate thread to call the `generate` function because we need to
 # yield the text back from the streamer in the main thread. This is an idiosyncrasy with streaming in `transformers`.
-@stub.cls(gpu=gpu.A100(), timeout=60 * 10, container_idle_timeout=60 * 5)
+@stub.cls(
+    gpu=gpu.A100(),
+    timeout=60 * 10,
+    container_idle_timeout=60 * 5,
+    volumes={WEIGHTS_DIR: weights_volume},
+)
 class Falcon40BGPTQ:
     def __enter__(self):
         from auto_gptq import AutoGPTQForCausalLM
         from transformers import AutoTokenizer
 
-        self.tokenizer = AutoTokenizer.from_pretrained(IMAGE_MODEL_DIR, use_fast=True)
+        self.readiness = Readiness(stub.warmup_stats)
+        self.lifecycle = Lifecycle(grace_period=20)
+
+        model_dir = ensure(MODEL_NAME, MODEL_REVISION, weights_volume)
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir, use_fast=True)
         print("Loaded tokenizer.")
 
         self.model = AutoGPTQForCausalLM.from_quantized(
-            IMAGE_MODEL_DIR,
+            model_dir,
             trust_remote_code=True,
             use_safetensors=True,
             device_map="auto",
@@ -94,30 +115,110 @@ class Falcon40BGPTQ:
         )
         print("Loaded model.")
 
+        # A short generation picks the CUDA kernels now instead of during the first request.
+        warmup_ids = self.tokenizer("Hello", return_tensors="pt").input_ids.cuda()
+        self.readiness.warmup(lambda: self.model.generate(inputs=warmup_ids, max_new_tokens=4))
+        self.profiler = Profiler()
+
+    def __exit__(self, exc_type, exc, tb):
+        # Running streams get a grace period to finish, then hand their text so far back to the
+        # web tier, which resumes them on another container (see `lifecycle.py`).
+        self.lifecycle.drain_sync()
+
     @method()
-    def generate(self, prompt: str):
+    def ready(self):
+        return self.readiness.snapshot()
+
+    @method()
+    def generate(self, prompt: str, stopping=None, prefix: str = "", max_tokens=None):
+        # New streams are turned away while the container drains; see `__exit__`.
+        yield from self.lifecycle.track_sync(self._generate(prompt, stopping, prefix, max_tokens))
+
+    def _generate(self, prompt: str, stopping=None, prefix: str = "", max_tokens=None):
         from threading import Thread
 
         from transformers import TextIteratorStreamer
 
-        inputs = self.tokenizer(prompt, return_tensors="pt")
-        streamer = TextIteratorStreamer(self.tokenizer, skip_special_tokens=True)
+        stopping = stopping or {}
+        # A resumed request continues after the text already sent, which includes the echoed prompt.
+        text, resumed = resume_prompt(prompt, prefix)
+        inputs = self.tokenizer(text, return_tensors="pt")
+        # The web tier already fitted the prompt; this only catches the token it may have miscounted
+        # and the text a resumed request adds.
+        fitted = budget.check(inputs.input_ids.shape[1], max_tokens)
+        input_ids = inputs.input_ids
+        attention_mask = inputs.attention_mask
+        # The prompt is echoed as sent, ahead of the completion and outside the stop matcher; a
+        # resumed request already sent it.
+        streamer = TextIteratorStreamer(self.tokenizer, skip_prompt=True, skip_special_tokens=True)
         generation_kwargs = dict(
-            inputs=inputs.input_ids.cuda(),
-            attention_mask=inputs.attention_mask,
+            inputs=input_ids.cuda(),
+            attention_mask=attention_mask,
             temperature=0.1,
-            max_new_tokens=512,
+            max_new_tokens=fitted.max_tokens,
             streamer=streamer,
         )
+        if stopping:
+            # The criteria run inside `generate`, so a match ends decoding on the GPU; the
+            # streamer side only trims the stop text out of what we send back.
+            generation_kwargs["stopping_criteria"] = transformers_stopping_criteria(
+                StoppingEngine.from_payload(stopping),
+                self.tokenizer,
+                input_ids.shape[1],
+            )
 
         # Run generation on separate thread to enable response streaming.
         thread = Thread(target=self.model.generate, kwargs=generation_kwargs)
         thread.start()
+        stopper = StoppingEngine.from_payload(stopping)
+        if not resumed:
+            yield prompt
         for new_text in streamer:
-            yield new_text
+            new_text, stopped = stopper.feed(new_text)
+            if new_text:
+                yield new_text
+            if stopped:
+                break
+
+        tail = stopper.flush()
+        if tail:
+            yield tail
+        event = stop_event(stopper.reason)
+        if event is not None:
+            yield event
 
         thread.join()
 
+    @method()
+    def embed(self, texts, format="binary", dtype="float32"):
+        # Embeddings reuse the loaded weights: mean-pooled last hidden state, batched by length.
+        vectors = encode(texts, self.tokenizer, self.model, "cuda")
+        if format == "json":
+            return vectors.astype(dtype).tolist()
+        return pack(vectors, dtype)
+
+    @method()
+    async def benchmark(self, batch_sizes, max_tokens: int = 64):
+        # Each request generates on its own thread, as `generate` does, so this measures how
+        # concurrent requests share the GPU rather than batched throughput.
+        engine = TransformersEngine(self.model, self.tokenizer, "cuda")
+        return await run_benchmark(
+            engine, batch_sizes, BenchParams(max_tokens), model=MODEL_NAME, engine_name="transformers"
+        )
+
+    @method()
+    def profile(self, seconds: float = 10.0, interval: float = 0.01, max_tokens: int = 128):
+        # A container serves one input at a time, so rather than live traffic this profiles
+        # generations of a fixed prompt on a warm container; see `profiling.py`.
+        input_ids = self.tokenizer(PROMPTS[1], return_tensors="pt").input_ids.cuda()
+        return self.profiler.run_sync(
+            seconds,
+            lambda: self.model.generate(inputs=input_ids, max_new_tokens=max_tokens),
+            # AutoGPTQ wraps the transformers model, whose forward passes are the steps.
+            [lambda spans: annotate_forward(getattr(self.model, "model", self.model), spans)],
+            interval,
+        )
+
 
 # ## Run the model
 # We define a [`local_entrypoint`](/docs/guide/apps#entrypoints-for-ephemeral-apps) to call our remote function
@@ -135,14 +236,54 @@ def cli():
         print(text, end="", flush=True)
 
 
+# Measures tokens/s, time to first token and latency at each batch size; see `bench.py`.
+@stub.local_entrypoint()
+def bench(batch_sizes: str = "1,4", max_tokens: int = 64, output: str = "", baseline: str = "", tolerance: float = 0.1):
+    report = Falcon40BGPTQ().benchmark.remote(parse_batch_sizes(batch_sizes), max_tokens)
+    finish_report(report, output or f"bench-{stub.name}.json", baseline, tolerance)
+
+
 # ## Serve the model with FastAPI StreamingResponse
-@stub.function(timeout=600, secret=Secret.from_name("llm-playground-secrets"))
+# The handlers are async and share one handle per GPU method, so a long generation doesn't hold a
+# worker thread of the web container.
+#
+# The generate endpoint runs on an image with just the tokenizer files, so prompts that can't fit
+# the context window are turned away before a GPU container is involved.
+def download_tokenizer_to_folder():
+    from huggingface_hub import snapshot_download
+
+    snapshot_download(
+        MODEL_NAME,
+        local_dir=TOKENIZER_DIR,
+        allow_patterns=["tokenizer*", "special_tokens_map.json"],
+    )
+
+
+tokenizer_image = (
+    Image.debian_slim(python_version="3.10")
+    .pip_install("transformers==4.36.2", "huggingface_hub==0.19.4")
+    .run_function(download_tokenizer_to_folder)
+)
+
+
+@lru_cache(maxsize=1)
+def web_tokenizer():
+    return CachedTokenizer(load_fast_tokenizer(TOKENIZER_DIR))
+
+
+generate_pool = BackendPool(lambda: Falcon40BGPTQ().generate.remote_gen.aio)
+readiness_probe = ReadinessProbe(lambda: Falcon40BGPTQ().generate.get_current_stats.aio(), stub.warmup_stats, default_cold_start=30)
+embed_pool = BackendPool(lambda: Falcon40BGPTQ().embed.remote.aio)
+
+
+@stub.function(image=tokenizer_image, timeout=600, secret=Secret.from_name("llm-playground-secrets"))
 @web_endpoint(method="POST")
-def generate(
-    payload: Dict[str, str], token: HTTPAuthorizationCredentials = Depends(auth_scheme)
+async def generate(
+    request: Request,
+    payload: Dict[str, Any],
+    token: HTTPAuthorizationCredentials = Depends(auth_scheme),
 ):
     import os
-    from itertools import chain
 
     from fastapi.responses import StreamingResponse
 
@@ -155,13 +296,91 @@ def generate(
             headers={"WWW-Authenticate": "Bearer"},
         )
 
-    model = Falcon40BGPTQ()
+    try:
+        stopping = stopping_options(payload)
+        strategy = payload.get("truncation", "shrink")
+        if strategy == "truncate":
+            raise ValueError("Falcon prompts carry their own instructions, so truncation must be 'reject' or 'shrink'")
+        fitted = budget.fit_prompt(web_tokenizer(), prompt, None, parse_max_tokens(payload), strategy)
+    except ContextOverflow as e:
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+
+    # The streamer only yields text, so NDJSON records from Falcon carry no token ids.
+    encoder = negotiate(request.headers, payload.get("stream_format"))
     return StreamingResponse(
-        chain(
-            (
-                "...\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n\n"
-            ),
-            model.generate.call(prompt),
+        # Cold starts are announced with `status` events carrying an ETA, see `warmup.py`.
+        encoder.stream(
+            with_eta(
+                # Streams cut off by a retiring or failed container resume on another one.
+                resumable(
+                    lambda prefix, sent: generate_pool.stream(prompt, stopping, prefix, max(1, fitted.max_tokens - sent))
+                ),
+                readiness_probe.check(),
+            )
         ),
-        media_type="text/event-stream",
+        media_type=encoder.media_type,
+        headers={**encoder.headers, **fitted.headers()},
     )
+
+
+# ## Profiling
+# `POST /profile` with `{"seconds": 10}` and the `ADMIN_TOKEN` from the secret returns collapsed
+# stacks, a Chrome trace and a summary of prefill and decode steps for a profiled generation.
+# `modal run falcon_gptq.py::flamegraph` writes them to `profile.folded` and `profile.trace.json`.
+@stub.local_entrypoint()
+def flamegraph(seconds: float = 10.0, interval: float = 0.01, output: str = "profile"):
+    write_profile(Falcon40BGPTQ().profile.remote(seconds, interval), output)
+
+
+@stub.function(timeout=int(MAX_SECONDS) + 60, secret=Secret.from_name("llm-playground-secrets"))
+@web_endpoint(method="POST")
+async def profile(payload: Dict[str, Any], token: HTTPAuthorizationCredentials = Depends(auth_scheme)):
+    import os
+
+    if not os.environ.get("ADMIN_TOKEN") or token.credentials != os.environ["ADMIN_TOKEN"]:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Incorrect bearer token",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+
+    seconds = float(payload.get("seconds", 10))
+    if not 0 < seconds <= MAX_SECONDS:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"seconds must be in (0, {MAX_SECONDS:g}]")
+    try:
+        return await Falcon40BGPTQ().profile.remote.aio(seconds, float(payload.get("interval", 0.01)))
+    except ProfilerBusy as e:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(e))
+
+
+# ## Embeddings endpoint
+# Send `{"texts": [...]}` to get one vector per text. By default the response is the compact binary
+# format from `embeddings.py` (`application/octet-stream`, read it with `embeddings.unpack`); pass
+# `"format": "json"` for nested lists, and `"dtype": "float16"` to halve the payload.
+@stub.function(timeout=600, secret=Secret.from_name("llm-playground-secrets"))
+@web_endpoint(method="POST")
+async def embed(
+    payload: Dict[str, Any], token: HTTPAuthorizationCredentials = Depends(auth_scheme)
+):
+    import os
+
+    from fastapi.responses import Response
+
+    if token.credentials != os.environ["AUTH_TOKEN"]:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Incorrect bearer token",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+
+    try:
+        texts, format, dtype = parse_request(payload)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=str(e))
+
+    result = await embed_pool.call(texts, format, dtype)
+    if format == "json":
+        return {"embeddings": result, "dtype": dtype}
+    return Response(content=result, media_type="application/octet-stream")
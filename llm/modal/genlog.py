@@ -0,0 +1,359 @@
+# # Generation log
+#
+# The Next.js app keeps chats in Postgres, but what the model tier actually generated (the fitted
+# prompt, the output, timings and token counts) was never stored. `GenerationLog` keeps an
+# append-only log of completions without putting a write on the request path:
+#
+# - `track` re-yields a response's deltas and, when the stream ends, builds one record and
+#   `submit`s it: a `put_nowait` on a bounded queue, nothing else.
+# - A background task takes records off the queue and writes them in batches, as soon as
+#   `batch_size` are waiting or `flush_interval` seconds after the first one. The write (and
+#   counting output tokens for text streams, which carry no token ids) runs on a worker thread, so
+#   the event loop serving requests never blocks on the disk.
+# - When the sink can't keep up, the queue fills up to `max_queue` records, and further records
+#   are dropped and counted in `metrics()` rather than slowing requests down.
+#
+# Sinks append to a local file: `SqliteSink` (one `generations` table) or `ParquetSink` (one part
+# file per batch, with pyarrow). Each web container writes its own file, so writers never share
+# one. `load` reads records back from either, for analysis or to warm caches.
+#
+# Run `python genlog.py` to measure what logging costs a request, with a slow sink.
+import asyncio
+import json
+import os
+import sqlite3
+import time
+import uuid
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, List, Optional, Sequence
+
+from lifecycle import delta_text
+from records import num_tokens
+
+# Queued by `close` behind the last records.
+_CLOSE = object()
+
+# Columns of a record, in table order. `candidates` holds the texts of a `best_of` request, as JSON.
+COLUMNS = (
+    "request_id",
+    "created",
+    "model",
+    "adapter",
+    "prompt",
+    "output",
+    "candidates",
+    "status",
+    "cached",
+    "stream_format",
+    "temperature",
+    "max_tokens",
+    "prompt_tokens",
+    "output_tokens",
+    "ttft_s",
+    "latency_s",
+)
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS generations (
+    request_id TEXT,
+    created REAL,
+    model TEXT,
+    adapter TEXT,
+    prompt TEXT,
+    output TEXT,
+    candidates TEXT,
+    status TEXT,
+    cached INTEGER,
+    stream_format TEXT,
+    temperature REAL,
+    max_tokens INTEGER,
+    prompt_tokens INTEGER,
+    output_tokens INTEGER,
+    ttft_s REAL,
+    latency_s REAL
+)
+"""
+
+
+class SqliteSink:
+    """Appends batches to the `generations` table of a SQLite file, one transaction per batch."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._connection: Optional[sqlite3.Connection] = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._connection is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            # Batches are written from worker threads, one at a time.
+            self._connection = sqlite3.connect(self.path, check_same_thread=False)
+            self._connection.execute(SCHEMA)
+        return self._connection
+
+    def write(self, records: Sequence[Dict[str, Any]]):
+        connection = self._connect()
+        with connection:
+            connection.executemany(
+                f"INSERT INTO generations ({', '.join(COLUMNS)}) VALUES ({', '.join('?' * len(COLUMNS))})",
+                [tuple(record.get(column) for column in COLUMNS) for record in records],
+            )
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+
+class ParquetSink:
+    """Writes each batch to its own part file in `directory`."""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def write(self, records: Sequence[Dict[str, Any]]):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        os.makedirs(self.directory, exist_ok=True)
+        table = pa.Table.from_pylist([{column: record.get(column) for column in COLUMNS} for record in records])
+        name = f"part-{time.strftime('%Y%m%dT%H%M%S', time.gmtime())}-{uuid.uuid4().hex[:8]}.parquet"
+        # Written under a temporary name first, so readers never see half a file.
+        path = os.path.join(self.directory, name)
+        pq.write_table(table, path + ".tmp")
+        os.replace(path + ".tmp", path)
+
+    def close(self):
+        pass
+
+
+def open_sink(path: str):
+    """A `ParquetSink` for a `.parquet` directory, otherwise a `SqliteSink`."""
+    if path.rstrip("/").endswith(".parquet"):
+        return ParquetSink(path)
+    return SqliteSink(path)
+
+
+def load(path: str) -> Iterator[Dict[str, Any]]:
+    """The records in a SQLite log, a directory of Parquet parts, or a directory of either."""
+    if os.path.isdir(path) and not path.rstrip("/").endswith(".parquet"):
+        for name in sorted(os.listdir(path)):
+            if name.endswith((".sqlite", ".parquet")):
+                yield from load(os.path.join(path, name))
+    elif os.path.isdir(path):
+        import pyarrow.parquet as pq
+
+        for name in sorted(os.listdir(path)):
+            if name.endswith(".parquet"):
+                yield from pq.read_table(os.path.join(path, name)).to_pylist()
+    else:
+        connection = sqlite3.connect(path)
+        connection.row_factory = sqlite3.Row
+        try:
+            for row in connection.execute(f"SELECT {', '.join(COLUMNS)} FROM generations ORDER BY created"):
+                yield dict(row)
+        finally:
+            connection.close()
+
+
+class GenerationLog:
+    def __init__(
+        self,
+        sink,
+        batch_size: int = 256,
+        flush_interval: float = 5.0,
+        max_queue: int = 10000,
+        count_tokens: Optional[Callable[[List[str]], List[int]]] = None,
+        on_flush: Optional[Callable[[], None]] = None,
+    ):
+        self.sink = sink
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+        # Runs on the worker thread, for records whose stream carried no token ids.
+        self.count_tokens = count_tokens
+        # Runs on the worker thread after each batch, e.g. to commit a Modal `Volume`.
+        self.on_flush = on_flush
+        self.counts = {"submitted": 0, "written": 0, "dropped": 0, "batches": 0, "failed": 0}
+        self.flush_seconds = 0.0
+        self._queue: Optional[asyncio.Queue] = None
+        self._writer: Optional[asyncio.Task] = None
+
+    def _ensure_writer(self):
+        # The queue and the writer task belong to the event loop serving requests, so they are
+        # created on first use rather than at import time.
+        if self._queue is None:
+            self._queue = asyncio.Queue(self.max_queue)
+        if self._writer is None or self._writer.done():
+            self._writer = asyncio.ensure_future(self._run())
+
+    def submit(self, record: Dict[str, Any]) -> bool:
+        """Queues `record` for writing, or drops it if the queue is full. Never blocks."""
+        self._ensure_writer()
+        self.counts["submitted"] += 1
+        try:
+            self._queue.put_nowait(record)
+        except asyncio.QueueFull:
+            self.counts["dropped"] += 1
+            return False
+        return True
+
+    def _write(self, batch: List[Dict[str, Any]]):
+        # Only the writer task calls this, so batches are written one at a time.
+        if self.count_tokens is not None:
+            uncounted = [record for record in batch if record.get("output_tokens") is None]
+            if uncounted:
+                counts = self.count_tokens([record["output"] or "" for record in uncounted])
+                for record, count in zip(uncounted, counts):
+                    record["output_tokens"] = count
+        self.sink.write(batch)
+        if self.on_flush is not None:
+            self.on_flush()
+
+    async def _take_batch(self):
+        """Waits for a record, then collects more until the batch is full or `flush_interval` passes.
+
+        Returns the batch and whether `close` was called.
+        """
+        batch: List[Dict[str, Any]] = []
+        deadline = None
+        while len(batch) < self.batch_size:
+            if deadline is None:
+                record = await self._queue.get()
+                deadline = time.monotonic() + self.flush_interval
+            else:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    record = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+            if record is _CLOSE:
+                return batch, True
+            batch.append(record)
+        return batch, False
+
+    async def _flush(self, batch: List[Dict[str, Any]]):
+        t0 = time.monotonic()
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, self._write, batch)
+        except Exception as e:  # The log must never take the web tier down; the batch is lost.
+            self.counts["failed"] += len(batch)
+            print(f"Could not write {len(batch)} generation records: {e}")
+        else:
+            self.counts["written"] += len(batch)
+            self.counts["batches"] += 1
+        self.flush_seconds += time.monotonic() - t0
+
+    async def _run(self):
+        closed = False
+        while not closed:
+            batch, closed = await self._take_batch()
+            if batch:
+                await self._flush(batch)
+
+    async def close(self):
+        """Writes everything queued so far and stops the writer, e.g. before the container exits."""
+        if self._writer is not None and not self._writer.done():
+            # Behind the records already queued, so they are all written first.
+            await self._queue.put(_CLOSE)
+            await self._writer
+        self._writer = None
+        await asyncio.get_running_loop().run_in_executor(None, self.sink.close)
+
+    async def track(self, deltas: AsyncIterator[Any], started: Optional[float] = None, **fields: Any) -> AsyncIterator[Any]:
+        """Re-yields `deltas`, then submits a record of the response with `fields` added.
+
+        `started` is the `time.monotonic()` the request arrived at; the stream's status is `ok`,
+        `cancelled` (the client went away) or `error`.
+        """
+        started = time.monotonic() if started is None else started
+        parts: List[str] = []
+        candidates: Dict[int, List[str]] = {}
+        tokens, has_ids, ttft, status = 0, False, None, "cancelled"
+        try:
+            async for delta in deltas:
+                if ttft is None:
+                    ttft = time.monotonic() - started
+                if isinstance(delta, dict) and "index" in delta:
+                    candidates.setdefault(delta["index"], []).append(delta.get("text", ""))
+                else:
+                    parts.append(delta_text(delta))
+                has_ids = has_ids or isinstance(delta, (bytes, dict))
+                tokens += num_tokens(delta)
+                yield delta
+            status = "ok"
+        except Exception:
+            status = "error"
+            raise
+        finally:
+            record = dict(
+                fields,
+                request_id=fields.get("request_id") or uuid.uuid4().hex,
+                created=time.time(),
+                output="".join(parts),
+                candidates=json.dumps(["".join(candidates[i]) for i in sorted(candidates)]) if candidates else None,
+                status=status,
+                output_tokens=tokens if has_ids else None,
+                ttft_s=ttft,
+                latency_s=time.monotonic() - started,
+            )
+            try:
+                self.submit(record)
+            except RuntimeError:  # The stream was finalized outside of a running event loop.
+                self.counts["dropped"] += 1
+
+    def metrics(self) -> Dict[str, Any]:
+        return dict(
+            self.counts,
+            queued=self._queue.qsize() if self._queue is not None else 0,
+            flush_seconds=round(self.flush_seconds, 4),
+        )
+
+
+async def simulate(num_requests: int = 2000, deltas_per_request: int = 50, write_latency: float = 0.05) -> Dict[str, Any]:
+    """Streams requests through `track` into a sink that takes `write_latency` seconds per batch.
+
+    Returns the log's metrics, plus the CPU time `track` adds per request and per delta. Requests
+    finish faster than the sink writes, so the queue fills and some records are dropped.
+    """
+    import tempfile
+
+    class SlowSink(SqliteSink):
+        def write(self, records):
+            time.sleep(write_latency)
+            super().write(records)
+
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "generations.sqlite")
+    log = GenerationLog(SlowSink(path), batch_size=256, flush_interval=0.2, max_queue=1000)
+
+    async def backend():
+        for i in range(deltas_per_request):
+            yield {"text": f" word{i}", "token_ids": [i], "t": 0.0}
+
+    async def drain(stream) -> float:
+        t0 = time.process_time()
+        async for _ in stream:
+            pass
+        return time.process_time() - t0
+
+    plain = sum([await drain(backend()) for _ in range(num_requests)])
+    logged = 0.0
+    for i in range(num_requests):
+        logged += await drain(log.track(backend(), model="fake", prompt=f"prompt {i}", stream_format="ndjson"))
+        await asyncio.sleep(0)  # Requests arrive over time; let the writer run.
+    await log.close()
+
+    records = list(load(path))
+    os.remove(path)
+    os.rmdir(directory)
+    assert len(records) == log.counts["written"], (len(records), log.counts)
+    assert all(record["output_tokens"] == deltas_per_request for record in records)
+    return dict(
+        log.metrics(),
+        track_us_per_request=round((logged - plain) / num_requests * 1e6, 2),
+        track_us_per_delta=round((logged - plain) / num_requests / deltas_per_request * 1e6, 3),
+    )
+
+
+if __name__ == "__main__":
+    print(json.dumps(asyncio.run(simulate()), indent=2))
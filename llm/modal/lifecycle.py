@@ -0,0 +1,282 @@
+# # Graceful drain and resuming streams on another container
+#
+# When `container_idle_timeout` or a redeploy retires a GPU container, streams still running in it
+# used to be cut off mid-answer. With a `Lifecycle` per container:
+#
+# - `drain` (from `__aexit__` / `__exit__`) stops admitting work: a stream that starts while
+#   draining immediately returns an empty checkpoint, so the web tier sends it elsewhere.
+# - Streams already running get `grace_period` seconds to finish normally.
+# - A stream still running after that ends with a checkpoint record,
+#   `{"event": "checkpoint", "text": <generated so far>, "deltas": <count>}`, instead of being cut.
+#
+# On the web tier, `resumable` forwards deltas and keeps the text it forwarded. On a checkpoint, or
+# when the connection to the backend fails after the stream started (a container that was killed
+# rather than drained), it starts the request again with that text as `prefix`: the new container
+# appends it to the prompt and generates only the rest. Clients see one uninterrupted stream.
+# Failures before the first delta are `BackendPool`'s to retry, and timeouts are never resumed:
+# the backend may still be generating, as for the pool's retries (see `pool.py`).
+#
+# Stopping options are re-applied to the continuation only, so a stop string that straddles the
+# point of migration is missed. Multiplexed `n`/`best_of` streams are drained but not resumed.
+#
+# Run `python lifecycle.py` to drain a stand-in container mid-stream and check that the resumed
+# answer matches an uninterrupted one, and which failures are resumed.
+import asyncio
+import threading
+import time
+from typing import Any, AsyncIterator, Callable, Dict, Iterable, Iterator, List, Optional, Tuple, Type
+
+from pool import RETRYABLE
+from records import record_text
+
+CHECKPOINT = "checkpoint"
+
+
+def delta_text(delta: Any) -> str:
+    """The text a single-candidate delta adds: a string, a packed record, or a metadata record's `text`."""
+    if isinstance(delta, str):
+        return delta
+    if isinstance(delta, bytes):
+        return record_text(delta)
+    if isinstance(delta, dict) and "text" in delta and "index" not in delta and "event" not in delta:
+        return delta["text"]
+    return ""
+
+
+def checkpoint(text: str, deltas: int) -> Dict[str, Any]:
+    return {"event": CHECKPOINT, "text": text, "deltas": deltas}
+
+
+def is_checkpoint(delta: Any) -> bool:
+    return isinstance(delta, dict) and delta.get("event") == CHECKPOINT
+
+
+class Lifecycle:
+    """Admission and drain state of one container."""
+
+    def __init__(self, grace_period: float = 20.0, settle: float = 1.0):
+        self.grace_period = grace_period
+        self.settle = settle
+        self.draining = False
+        self.deadline: Optional[float] = None
+        self.in_flight = 0
+        self.num_checkpointed = 0
+        self._lock = threading.Lock()
+
+    @property
+    def expired(self) -> bool:
+        """Draining and past the grace period: running streams should checkpoint now."""
+        return self.draining and time.monotonic() >= self.deadline
+
+    def _begin(self, grace_period: Optional[float]):
+        self.draining = True
+        self.deadline = time.monotonic() + (self.grace_period if grace_period is None else grace_period)
+        print(f"Draining: {self.in_flight} streams in flight")
+
+    def _report(self) -> int:
+        print(f"Drained: {self.num_checkpointed} streams checkpointed, {self.in_flight} still running")
+        return self.in_flight
+
+    async def drain(self, grace_period: Optional[float] = None) -> int:
+        """Waits for in-flight streams, then for those past the grace period to checkpoint."""
+        self._begin(grace_period)
+        while self.in_flight and time.monotonic() < self.deadline + self.settle:
+            await asyncio.sleep(0.05)
+        return self._report()
+
+    def drain_sync(self, grace_period: Optional[float] = None) -> int:
+        """`drain` for containers whose streams run on threads, like the transformers apps."""
+        self._begin(grace_period)
+        while self.in_flight and time.monotonic() < self.deadline + self.settle:
+            time.sleep(0.05)
+        return self._report()
+
+    def _enter(self):
+        with self._lock:
+            self.in_flight += 1
+
+    def _exit(self, checkpointed: bool):
+        with self._lock:
+            self.in_flight -= 1
+            self.num_checkpointed += checkpointed
+
+    async def track(self, deltas: AsyncIterator[Any], resumable: bool = True) -> AsyncIterator[Any]:
+        """Re-yields `deltas`, ending with a checkpoint if the container drains past its grace period."""
+        if self.draining and resumable:
+            yield checkpoint("", 0)
+            return
+        self._enter()
+        sent: List[Any] = []
+        checkpointed = False
+        try:
+            async for delta in deltas:
+                yield delta
+                sent.append(delta)
+                if resumable and self.expired:
+                    checkpointed = True
+                    yield checkpoint("".join(map(delta_text, sent)), len(sent))
+                    return
+        finally:
+            self._exit(checkpointed)
+            aclose = getattr(deltas, "aclose", None)
+            if aclose is not None:
+                await aclose()
+
+    def track_sync(self, deltas: Iterable[Any], resumable: bool = True) -> Iterator[Any]:
+        """`track` for generator methods that run on threads."""
+        if self.draining and resumable:
+            yield checkpoint("", 0)
+            return
+        self._enter()
+        sent: List[Any] = []
+        checkpointed = False
+        try:
+            for delta in deltas:
+                yield delta
+                sent.append(delta)
+                if resumable and self.expired:
+                    checkpointed = True
+                    yield checkpoint("".join(map(delta_text, sent)), len(sent))
+                    return
+        finally:
+            self._exit(checkpointed)
+            close = getattr(deltas, "close", None)
+            if close is not None:
+                close()
+
+
+async def resumable(
+    start: Callable[[str, int], AsyncIterator[Any]],
+    max_resumes: int = 2,
+    retry_on: Tuple[Type[BaseException], ...] = RETRYABLE,
+) -> AsyncIterator[Any]:
+    """Streams `start(prefix, deltas_sent)`, restarting it after checkpoints and dropped connections.
+
+    `prefix` is the text forwarded so far, and `deltas_sent` how many deltas carried it, a lower
+    bound on the tokens already generated for callers that shrink `max_tokens` on resume.
+    """
+    # The deltas are only decoded into a prefix when a resume needs one.
+    forwarded: List[Any] = []
+    for attempt in range(max_resumes + 1):
+        stream = start("".join(map(delta_text, forwarded)), len(forwarded))
+        started = False
+        try:
+            async for delta in stream:
+                if is_checkpoint(delta):
+                    break
+                started = True
+                forwarded.append(delta)
+                yield delta
+            else:
+                return
+        except retry_on as e:
+            if not started or attempt == max_resumes or isinstance(e, asyncio.TimeoutError):
+                raise
+            print(f"Backend failed after {len(forwarded)} deltas ({type(e).__name__}: {e}), resuming elsewhere")
+        else:
+            print(f"Backend drained after {len(forwarded)} deltas, resuming elsewhere")
+        finally:
+            aclose = getattr(stream, "aclose", None)
+            if aclose is not None:
+                await aclose()
+    raise ConnectionError(f"Stream was interrupted {max_resumes + 1} times, giving up")
+
+
+def resume_prompt(prompt: str, prefix: str) -> Tuple[str, bool]:
+    """The text to continue from for backends that echo the prompt, and whether to skip the echo.
+
+    A resumed request already sent the echoed prompt as part of `prefix`, so it is not repeated.
+    """
+    if not prefix:
+        return prompt, False
+    if prefix.startswith(prompt):
+        prefix = prefix[len(prompt) :]
+    return prompt + prefix, True
+
+
+async def simulate(token_latency: float = 0.005, drain_after: float = 0.15, grace_period: float = 0.05):
+    """Drains a stand-in container mid-stream; returns `(resumed text, expected text, checkpoints)`."""
+    from fake_engine import ANSWER, FakeEngine
+
+    def container():
+        lifecycle, engine = Lifecycle(grace_period, settle=0.5), FakeEngine(token_latency=token_latency)
+
+        async def completion_stream(question: str, prefix: str = ""):
+            async def deltas():
+                index = 0
+                async for output in engine.generate(question + prefix, None, f"{question}-{len(prefix)}"):
+                    yield output.outputs[0].text[index:]
+                    index = len(output.outputs[0].text)
+
+            async for delta in lifecycle.track(deltas()):
+                yield delta
+
+        return lifecycle, completion_stream
+
+    old, old_stream = container()
+    new, new_stream = container()
+
+    def start(prefix: str, sent: int):
+        # Modal stops routing to a container once it drains; the first attempt went to the old one.
+        stream = old_stream if not old.draining else new_stream
+        return stream("What is the fable involving a fox and grapes? ", prefix)
+
+    async def client() -> str:
+        return "".join([delta async for delta in resumable(start)])
+
+    task = asyncio.ensure_future(client())
+    await asyncio.sleep(drain_after)
+    await old.drain()
+    # A request arriving at the draining container is turned away with an empty checkpoint.
+    turned_away = [delta async for delta in old_stream("Late request")]
+    assert turned_away == [checkpoint("", 0)], turned_away
+    return await task, ANSWER, old.num_checkpointed
+
+
+async def check_failures():
+    """Connection errors after a delta resume; timeouts and failures before the first delta don't."""
+
+    def backend(failure: BaseException, calls: List[str]):
+        def start(prefix: str, sent: int):
+            async def stream():
+                calls.append(prefix)
+                if len(calls) == 1:
+                    yield "Once"
+                    raise failure
+                yield " upon a time"
+
+            return stream()
+
+        return start
+
+    for failure, resumed in ((ConnectionError("reset"), True), (asyncio.TimeoutError(), False), (OSError("gone"), True)):
+        calls: List[str] = []
+        try:
+            text = "".join([delta async for delta in resumable(backend(failure, calls))])
+        except type(failure):
+            assert not resumed, f"{failure!r} wasn't resumed"
+            assert calls == [""], calls
+        else:
+            assert resumed, f"{failure!r} was resumed"
+            assert text == "Once upon a time" and calls == ["", "Once"], (text, calls)
+
+    async def refused(prefix: str, sent: int):
+        calls.append(prefix)
+        raise ConnectionError("refused")
+        yield
+
+    calls = []
+    try:
+        [delta async for delta in resumable(refused)]
+    except ConnectionError:
+        pass
+    assert calls == [""], calls
+
+
+if __name__ == "__main__":
+    asyncio.run(check_failures())
+    text, expected, checkpointed = asyncio.run(simulate())
+    print(f"{checkpointed} stream(s) checkpointed, resumed answer {'matches' if text == expected else 'DIFFERS'}")
+    if text != expected:
+        print(text)
+        raise SystemExit(1)
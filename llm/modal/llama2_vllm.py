@@ -11,6 +11,7 @@
 # We are running the Llama 2 13B model here, and you can expect 30 second cold starts and well over 100 tokens/second.
 # The larger the batch of prompts, the higher the throughput. For example, with [60 prompts](/docs/guide/ex/vllm_prompts.txt)
 # we can produce 24k tokens in 39 seconds, which is around 600 tokens/second.
+# To reproduce these numbers (and catch regressions), run `modal run llama2_vllm.py::bench`; see `bench.py`.
 #
 # To run
 # [any of the other supported models](https://vllm.readthedocs.io/en/latest/models/supported_models.html),
@@ -22,27 +23,73 @@
 
 import os
 import time
-from typing import Dict
+from functools import lru_cache
+from typing import Any, Dict
 
-from fastapi import Depends, HTTPException, status
+from fastapi import Depends, HTTPException, Request, status
 from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
 
+from autoscale import AutoscalePolicy, Autoscaler, ScalingSignals, drain_token_counts, report_token_count
+from batch import generate_shard, run_batch
+from bench import finish_report, measure_interference, parse_batch_sizes, run_benchmark
+from budget import ContextBudget, ContextOverflow, parse_max_tokens
+from concurrency import AimdController, ConcurrencyGate, instrument_preemptions, read_engine_stats
+from genlog import GenerationLog, load, open_sink
+from lifecycle import Lifecycle, resumable
+from pool import BackendPool
+from prefill import PrefillPacer
+from profiling import MAX_SECONDS, Profiler, ProfilerBusy, annotate_vllm_steps, write_profile
+from providers import OverflowRouter, backends_from_env
+from records import RecordStreamingResponse, pack
+from sampling import CandidateMux, parse_candidates, parse_temperature
+from semcache import EMBEDDER_DIR, SemanticCache, SentenceEmbedder, collect_metrics, download_embedder, replay
+from singleflight import SingleFlight, collect_flight_metrics, flight_key
+from stopping import StoppingEngine, stop_event, stopping_options
+from topology import init_tensor_parallel, pin_ray_workers
+from tokenization import CachedTokenizer, TextsTooLarge, load_fast_tokenizer, parse_texts
+from tracing import Tracer, request_attributes, traced_stream
+from transport import negotiate
+from warmup import Readiness, ReadinessProbe, warmup_llm_engine, with_eta
+from weights import VOLUME_NAME, WEIGHTS_DIR, ensure, populate
+
 auth_scheme = HTTPBearer()
 
-from modal import Image, Secret, Stub, gpu, method, web_endpoint
+from modal import Cron, Dict as ModalDict, Image, Period, Queue, Secret, Stub, Volume, gpu, method, web_endpoint
 
-MODEL_DIR = "/model"
+MODEL_REVISION = "main"  # Pin a commit to roll out new weights deliberately.
 BASE_MODEL = "meta-llama/Llama-2-13b-chat-hf"
 GPU_CONFIG = gpu.A100()
+PROMPT_TEMPLATE = "<s> [INST] {user} [/INST] "
+TOKENIZER_DIR = "/tokenizer"
+# The engine is started with this context window, and the web tier budgets prompts against it.
+CONTEXT_LENGTH = 4096
+DEFAULT_MAX_TOKENS = 1024
+# Cold start estimate until containers have recorded real ones, and when to warm up before the
+# daily traffic peak (14:00 UTC).
+COLD_START_S = 60
+DRAIN_GRACE_S = 20  # How long running streams may finish when a container retires.
+# Inputs Modal sends one container before scaling out, and the ceiling of the adaptive limit, which
+# may only lower it under KV-cache pressure. The adaptive limit is off until a recorded
+# `record_engine_stats` replay shows a win over this static limit; see `concurrency.py`.
+MAX_CONCURRENCY = 10
+ADAPTIVE_CONCURRENCY = False
+WARMUP_CRON = "50 13 * * *"
+# With `PREFILL_PACING`, a prefill step admits waiting prompts up to this many tokens (a longer
+# prompt runs alone), and running streams get at least `MIN_DECODE_STEPS` tokens between prefills.
+# Off until `bench_prefill` shows a win on this engine; see `prefill.py`.
+PREFILL_PACING = False
+PREFILL_TOKEN_BUDGET = 2048
+MIN_DECODE_STEPS = 8
 
 
 # ## Define a container image
 #
-# We want to create a Modal image which has the model weights pre-saved to a directory. The benefit of this
-# is that the container no longer has to re-download the model from Huggingface - instead, it will take
-# advantage of Modal's internal filesystem for faster cold starts.
+# The image only holds the code and its dependencies. The model weights live on a shared,
+# content-addressed volume (see `weights.py`): each file is stored once under its SHA-256, whichever
+# app needs it, and containers mount the volume and page weights in lazily as the engine loads them.
+# Changing a pip pin therefore rebuilds a small layer instead of downloading the model again.
 #
-# ### Download the weights
+# ### Access to the weights
 #
 # Since the weights are gated on HuggingFace, we must request access in two places:
 # - on the [model card page](https://huggingface.co/meta-llama/Llama-2-13b-chat-hf)
@@ -51,29 +98,6 @@ GPU_CONFIG = gpu.A100()
 # Next, [create a HuggingFace access token](https://huggingface.co/settings/tokens).
 # To access the token in a Modal function, we can create a secret on the [secrets page](https://modal.com/secrets).
 # Now the token will be available via the environment variable named `HUGGINGFACE_TOKEN`. Functions that inject this secret will have access to the environment variable.
-#
-# We can download the model to a particular directory using the HuggingFace utility function `snapshot_download`.
-#
-# Tip: avoid using global variables in this function. Changes to code outside this function will not be detected and the download step will not re-run.
-def download_model_to_folder():
-    from huggingface_hub import snapshot_download
-    from transformers.utils import move_cache
-
-    os.makedirs(MODEL_DIR, exist_ok=True)
-
-    snapshot_download(
-        BASE_MODEL,
-        local_dir=MODEL_DIR,
-        ignore_patterns="*.pt",  # Using safetensors
-        token=os.environ["HUGGINGFACE_TOKEN"],
-    )
-    move_cache()
-
-
-# ### Image definition
-# We’ll start from a Dockerhub image recommended by `vLLM`, and use
-# run_function to run the function defined above to ensure the weights of
-# the model are saved within the container image.
 
 vllm_image = (
     Image.from_registry(
@@ -82,14 +106,46 @@ vllm_image = (
     .pip_install("vllm==0.2.5", "huggingface_hub==0.19.4", "hf-transfer==0.1.4")
     # Use the barebones hf-transfer package for maximum download speeds. No progress bar, but expect 700MB/s.
     .env({"HF_HUB_ENABLE_HF_TRANSFER": "1"})
-    .run_function(
-        download_model_to_folder,
-        secret=Secret.from_name("llm-playground-secrets"),
-        timeout=60 * 20,
-    )
 )
+weights_volume = Volume.persisted(VOLUME_NAME)
+# Each web container appends the completions it served to its own SQLite file here; see `genlog.py`.
+generations_volume = Volume.persisted("llm-playground-generations")
+GENERATIONS_DIR = "/generations"
+# Sampled traces, one JSONL file per container, written in batches; see `tracing.py`.
+traces_volume = Volume.persisted("llm-playground-traces")
+TRACES_DIR = "/traces"
 
 stub = Stub("example-llama2-vllm-inference")
+# Containers push each request's token count here; the scheduled `autoscale` function drains it.
+stub.token_counts = Queue.new()
+# The autoscaler's hysteresis state, kept between its scheduled runs.
+stub.autoscale_state = ModalDict.new()
+# Containers record when they start and how long cold starts take here; see `warmup.py`.
+stub.warmup_stats = ModalDict.new()
+stub.semantic_cache_stats = ModalDict.new()
+stub.single_flight_stats = ModalDict.new()
+# Samples 1% of requests into OTLP JSON traces; see `tracing.py`.
+tracer = Tracer(
+    "example-llama2-vllm-inference",
+    sample_rate=0.01,
+    sink=os.path.join(TRACES_DIR, stub.name, f"{os.environ.get('MODAL_TASK_ID', os.getpid())}.jsonl"),
+    on_flush=traces_volume.commit,
+)
+
+
+# ### Populate the weights
+# `modal run llama2_vllm.py::populate_weights` stores the weights of `MODEL_REVISION` on the volume
+# once; reruns for a revision that is already there return right away. If nobody ran it, the first
+# container of a new revision does the same before loading.
+@stub.function(
+    image=vllm_image,
+    volumes={WEIGHTS_DIR: weights_volume},
+    timeout=60 * 30,
+    secret=Secret.from_name("llm-playground-secrets"),
+)
+def populate_weights():
+    populate(BASE_MODEL, MODEL_REVISION, ignore_patterns="*.pt", token=os.environ["HUGGINGFACE_TOKEN"])
+    weights_volume.commit()
 
 
 # ## The model class
@@ -105,69 +161,241 @@ stub = Stub("example-llama2-vllm-inference")
     gpu=GPU_CONFIG,
     timeout=60 * 10,
     container_idle_timeout=60 * 10,
-    allow_concurrent_inputs=10,
+    allow_concurrent_inputs=MAX_CONCURRENCY,
     image=vllm_image,
+    volumes={WEIGHTS_DIR: weights_volume, TRACES_DIR: traces_volume},
+    secret=Secret.from_name("llm-playground-secrets"),
 )
 class Model:
     def __enter__(self):
         from vllm.engine.arg_utils import AsyncEngineArgs
         from vllm.engine.async_llm_engine import AsyncLLMEngine
 
-        if GPU_CONFIG.count > 1:
-            # Patch issue from https://github.com/vllm-project/vllm/issues/1116
-            import ray
+        self.readiness = Readiness(stub.warmup_stats)
+        self.lifecycle = Lifecycle(DRAIN_GRACE_S)
 
-            ray.shutdown()
-            ray.init(num_gpus=GPU_CONFIG.count)
+        init_tensor_parallel(GPU_CONFIG.count)
 
+        model_dir = ensure(
+            BASE_MODEL,
+            MODEL_REVISION,
+            weights_volume,
+            ignore_patterns="*.pt",  # Using safetensors
+            token=os.environ["HUGGINGFACE_TOKEN"],
+        )
         engine_args = AsyncEngineArgs(
-            model=MODEL_DIR,
+            model=model_dir,
             tensor_parallel_size=GPU_CONFIG.count,
             gpu_memory_utilization=0.90,
+            max_model_len=CONTEXT_LENGTH,
         )
 
         self.engine = AsyncLLMEngine.from_engine_args(engine_args)
-        self.template = "<s> [INST] {user} [/INST] "
+        self.template = PROMPT_TEMPLATE
 
         # Performance improvement from https://github.com/vllm-project/vllm/issues/2073#issuecomment-1853422529
         if GPU_CONFIG.count > 1:
-            import subprocess
+            pin_ray_workers()
+
+        # With `ADAPTIVE_CONCURRENCY`, how many requests run at once follows the engine's KV-cache
+        # pressure (see `concurrency.py`); otherwise the gate only records engine stats.
+        preemptions = instrument_preemptions(self.engine.engine)
+        self.concurrency = ConcurrencyGate(
+            AimdController(initial=MAX_CONCURRENCY, max_limit=MAX_CONCURRENCY, adaptive=ADAPTIVE_CONCURRENCY),
+            lambda: read_engine_stats(self.engine.engine, preemptions),
+        )
+
+        # Long prompts are admitted in bounded steps between decode steps of the running streams.
+        self.pacer = PrefillPacer(PREFILL_TOKEN_BUDGET, MIN_DECODE_STEPS)
+        if PREFILL_PACING:
+            self.pacer.install(self.engine.engine)
+
+        self.profiler = Profiler()
+
+        # Only a container whose engine has generated once reports ready.
+        self.readiness.warmup(lambda: warmup_llm_engine(self.engine.engine))
+
+    async def __aexit__(self, exc_type, exc, tb):
+        # Running streams get a grace period to finish, then hand their text so far back to the
+        # web tier, which resumes them on another container (see `lifecycle.py`).
+        await self.lifecycle.drain()
+
+    @method()
+    def ready(self):
+        return self.readiness.snapshot()
+
+    @method()
+    async def completion_stream(self, user_question, stopping=None, metadata=False, trace_context=None, max_tokens=None, n=1, best_of=None, prefix="", binary=False, temperature=None):
+        # Requests wait at the concurrency gate, and new streams are turned away while the
+        # container drains; see `__aexit__`.
+        deltas = self._completion_stream(
+            user_question,
+            stopping=stopping,
+            metadata=metadata,
+            trace_context=trace_context,
+            max_tokens=max_tokens,
+            n=n,
+            best_of=best_of,
+            prefix=prefix,
+            binary=binary,
+            temperature=temperature,
+        )
+        async with self.concurrency:
+            async for delta in self.lifecycle.track(deltas, resumable=(best_of or n) == 1):
+                yield delta
 
-            RAY_CORE_PIN_OVERRIDE = "cpuid=0 ; for pid in $(ps xo '%p %c' | grep ray:: | awk '{print $1;}') ; do taskset -cp $cpuid $pid ; cpuid=$(($cpuid + 1)) ; done"
-            subprocess.call(RAY_CORE_PIN_OVERRIDE, shell=True)
+    @method()
+    def concurrency_metrics(self, samples: bool = False):
+        return self.concurrency.controller.metrics(samples)
 
     @method()
-    async def completion_stream(self, user_question):
+    async def profile(self, seconds: float = 10.0, interval: float = 0.01):
+        # Samples stacks and wraps the engine steps for `seconds` of live traffic; see `profiling.py`.
+        return await self.profiler.run(seconds, [lambda spans: annotate_vllm_steps(self.engine.engine, spans)], interval)
+
+    async def _completion_stream(self, user_question, stopping=None, metadata=False, trace_context=None, max_tokens=None, n=1, best_of=None, prefix="", binary=False, temperature=None):
         from vllm import SamplingParams
-        from vllm.utils import random_uuid
 
+        # Stop strings, regex and JSON constraints are checked on every engine step, and a
+        # match aborts the request so the sequence leaves the running batch straight away.
+        stopper = StoppingEngine.from_payload(stopping or {})
+
+        # `n` candidates are returned out of `best_of` sampled, all forked from one prefill of the prompt.
         sampling_params = SamplingParams(
-            temperature=0.75,
-            max_tokens=1024,
+            n=best_of or n,
+            best_of=best_of or n,
+            temperature=0.75 if temperature is None else temperature,
+            max_tokens=max_tokens or DEFAULT_MAX_TOKENS,
             repetition_penalty=1.1,
         )
 
         t0 = time.time()
-        request_id = random_uuid()
+        # The web tier's request id doubles as the vLLM request id and the trace id.
+        trace = tracer.continue_trace(trace_context)
+        if trace_context and "dispatched_at_ns" in trace_context:
+            trace.span("queue", start_ns=trace_context["dispatched_at_ns"]).end()
+        request_id = trace.trace_id
         result_generator = self.engine.generate(
-            self.template.format(user=user_question),
+            # A resumed request continues after the text another container already sent.
+            self.template.format(user=user_question) + prefix,
             sampling_params,
             request_id,
         )
         index, num_tokens = 0, 0
-        async for output in result_generator:
-            if (
-                output.outputs[0].text
-                and "\ufffd" == output.outputs[0].text[-1]
-            ):
-                continue
-            text_delta = output.outputs[0].text[index:]
-            index = len(output.outputs[0].text)
-            num_tokens = len(output.outputs[0].token_ids)
+        prefill, decode = trace.span("prefill"), None
+        try:
+            if sampling_params.best_of > 1:
+                # Candidates stream as records tagged with their index (see `sampling.py`).
+                mux = CandidateMux(n, sampling_params.best_of, stopping)
+                async for record in mux.run(result_generator):
+                    if decode is None:
+                        prefill.end()
+                        decode = trace.span("decode", candidates=mux.best_of)
+                    yield record
+                num_tokens = mux.num_tokens
+                # Ends candidates the engine is still sampling after all of them stopped; a no-op otherwise.
+                await self.engine.abort(request_id)
+            else:
+                # With `metadata`, deltas are dicts carrying their token ids and the time since the
+                # request started, for the NDJSON transport; with `binary`, the same is packed into
+                # one record (see `records.py`). Ids of held-back text ride with the next delta.
+                token_ids = []
+                async for output in result_generator:
+                    if decode is None:
+                        prefill.end(prompt_tokens=len(output.prompt_token_ids))
+                        decode = trace.span("decode")
+                    if (
+                        output.outputs[0].text
+                        and "\ufffd" == output.outputs[0].text[-1]
+                    ):
+                        continue
+                    text_delta = output.outputs[0].text[index:]
+                    index = len(output.outputs[0].text)
+                    token_ids.extend(output.outputs[0].token_ids[num_tokens:])
+                    num_tokens = len(output.outputs[0].token_ids)
+
+                    text_delta, stopped = stopper.feed(text_delta)
+                    if text_delta:
+                        decode.add_event("flush")
+                        if binary:
+                            yield pack(text_delta, token_ids, time.time() - t0)
+                            token_ids = []
+                        elif metadata:
+                            yield {"text": text_delta, "token_ids": token_ids, "t": round(time.time() - t0, 4)}
+                            token_ids = []
+                        else:
+                            yield text_delta
+                    if stopped:
+                        await self.engine.abort(request_id)
+                        break
+
+                tail = stopper.flush()
+                if tail and binary:
+                    yield pack(tail, token_ids, time.time() - t0)
+                elif tail:
+                    yield {"text": tail, "token_ids": token_ids, "t": round(time.time() - t0, 4)} if metadata else tail
+                # Sent as an event, which raw text streams drop (see `transport.py`).
+                event = stop_event(stopper.reason)
+                if event is not None:
+                    yield event
+
+            print(f"Generated {num_tokens} tokens in {time.time() - t0:.2f}s")
+        finally:
+            (decode or prefill).end(num_tokens=num_tokens)
+            trace.finish()
+
+        report_token_count(stub.token_counts, num_tokens)
+
+
+    @method()
+    async def generate_batch(self, shard):
+        from vllm import SamplingParams
 
-            yield text_delta
+        # All prompts of the shard go to the engine at once, so continuous batching stays full.
+        sampling_params = SamplingParams(
+            temperature=0.75,
+            max_tokens=DEFAULT_MAX_TOKENS,
+            repetition_penalty=1.1,
+        )
+        return await generate_shard(self.engine, shard, sampling_params, self.template)
+
+    @method()
+    async def benchmark(self, batch_sizes, max_tokens: int = 256):
+        from vllm import SamplingParams
+
+        # Greedy and EOS ignored: every request generates exactly `max_tokens`, run after run.
+        sampling_params = SamplingParams(temperature=0, max_tokens=max_tokens, ignore_eos=True)
+        return await run_benchmark(self.engine, batch_sizes, sampling_params, self.template, model=BASE_MODEL)
+
+    @method()
+    async def benchmark_prefill(self, streams: int = 16, long_words: int = 3000, long_prompts: int = 8, interval: float = 0.5):
+        from vllm import SamplingParams
 
-        print(f"Generated {num_tokens} tokens in {time.time() - t0:.2f}s")
+        # Short streams run long enough to span the whole window; long prompts only need their prefill.
+        sampling_params = SamplingParams(temperature=0, max_tokens=DEFAULT_MAX_TOKENS, ignore_eos=True)
+        long_sampling_params = SamplingParams(temperature=0, max_tokens=16, ignore_eos=True)
+        report = {"model": BASE_MODEL, "prefill_pacing": PREFILL_PACING}
+        # Installed for the measurement only, unless the app runs with pacing anyway.
+        installed = self.pacer.installed
+        if not installed:
+            self.pacer.install(self.engine.engine)
+        try:
+            for paced in (False, True):
+                self.pacer.enabled = paced
+                result = await measure_interference(
+                    self.engine, sampling_params, long_sampling_params, self.template, streams, long_words, long_prompts, interval
+                )
+                print(f"{'paced' if paced else 'unpaced'}: {result}")
+                report["paced" if paced else "unpaced"] = result
+        finally:
+            self.pacer.enabled = True
+            if not installed:
+                self.pacer.uninstall()
+        report["pacer"] = self.pacer.metrics()
+        # Worth enabling only if pacing improves the short streams' tail without hurting the long prompts.
+        paced, unpaced = report["paced"], report["unpaced"]
+        report["pacing_wins"] = paced["itl_p99"] < unpaced["itl_p99"] and paced["long_ttft_p99"] <= unpaced["long_ttft_p99"]
+        return report
 
 
 # ## Run the model
@@ -195,20 +423,174 @@ def main():
             print(text, end="", flush=True)
 
 
-@stub.function(
-    keep_warm=1,
-    allow_concurrent_inputs=10,
-    timeout=60 * 10,
-    secret=Secret.from_name("llm-playground-secrets")
-)
+# ## Batch generation
+# To run a whole JSONL file of `{"prompt": ...}` lines, use
+# `modal run llama2_vllm.py::batch --input prompts.jsonl --output results.jsonl`. Shards are spread
+# over containers, results are written in order as they complete, and rerunning the same command
+# after a failure resumes from the last completed shard.
+@stub.local_entrypoint()
+def batch(input: str, output: str, shard_size: int = 64):
+    run_batch(input, output, Model().generate_batch.map, shard_size, model=f"{BASE_MODEL}@{MODEL_REVISION}")
+
+
+# ## Benchmark
+# `modal run llama2_vllm.py::bench` measures tokens/s, time to first token, p50/p99 latency and peak GPU
+# memory at each batch size and writes them to a JSON report. With `--baseline bench-old.json` it
+# exits non-zero when a metric regressed by more than `--tolerance`.
+@stub.local_entrypoint()
+def bench(batch_sizes: str = "1,8,32", max_tokens: int = 256, output: str = "", baseline: str = "", tolerance: float = 0.1):
+    report = Model().benchmark.remote(parse_batch_sizes(batch_sizes), max_tokens)
+    finish_report(report, output or f"bench-{stub.name}.json", baseline, tolerance)
+
+
+# `modal run llama2_vllm.py::bench_prefill` measures the inter-token latency of short streams while long
+# documents arrive, with and without prefill pacing, and writes both to a JSON report. Set
+# `PREFILL_PACING = True` only if it reports `pacing_wins` on representative traffic.
+@stub.local_entrypoint()
+def bench_prefill(streams: int = 16, long_words: int = 3000, long_prompts: int = 8, interval: float = 0.5, output: str = ""):
+    import json
+
+    report = Model().benchmark_prefill.remote(streams, long_words, long_prompts, interval)
+    output = output or f"bench-prefill-{stub.name}.json"
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {output}; pacing {'wins' if report['pacing_wins'] else 'does not win'}")
+
+
+# ## Generation log
+# `modal run llama2_vllm.py::export_generations` writes every logged completion of this app, from all web
+# containers, to a JSONL file for analysis (or to seed caches).
+@stub.function(volumes={GENERATIONS_DIR: generations_volume}, timeout=60 * 10)
+def read_generations():
+    generations_volume.reload()
+    directory = os.path.join(GENERATIONS_DIR, stub.name)
+    if os.path.isdir(directory):
+        yield from load(directory)
+
+
+@stub.local_entrypoint()
+def export_generations(output: str = "generations.jsonl"):
+    import json
+
+    count = 0
+    with open(output, "w") as f:
+        for record in read_generations.remote_gen():
+            f.write(json.dumps(record) + "\n")
+            count += 1
+    print(f"Wrote {count} generations to {output}")
+
+
+# ## Traces
+# `modal run llama2_vllm.py::export_traces` concatenates the sampled traces of all containers into one OTLP
+# JSONL file, e.g. to load into a trace viewer or look up a request with `recorded_request`.
+@stub.function(volumes={TRACES_DIR: traces_volume}, timeout=60 * 10)
+def read_traces():
+    traces_volume.reload()
+    directory = os.path.join(TRACES_DIR, stub.name)
+    if os.path.isdir(directory):
+        for name in sorted(os.listdir(directory)):
+            with open(os.path.join(directory, name)) as f:
+                yield from f
+
+
+@stub.local_entrypoint()
+def export_traces(output: str = "traces.jsonl"):
+    count = 0
+    with open(output, "w") as f:
+        for line in read_traces.remote_gen():
+            f.write(line)
+            count += 1
+    print(f"Wrote {count} traces to {output}")
+
+
+# ## Engine stats
+# Saves the engine stats samples a running container based its concurrency decisions on, to replay
+# offline with `python concurrency.py --replay engine_stats.jsonl`.
+@stub.local_entrypoint()
+def record_engine_stats(output: str = "engine_stats.jsonl"):
+    import json
+
+    metrics = Model().concurrency_metrics.remote(samples=True)
+    with open(output, "w") as f:
+        for sample in metrics.pop("samples"):
+            f.write(json.dumps(sample) + "\n")
+    print(json.dumps(metrics, indent=2))
+
+
+# ## Profiling
+# `POST /profile` with `{"seconds": 10}` and the `ADMIN_TOKEN` from the secret profiles a GPU
+# container serving traffic (the one Modal routes the call to) and returns collapsed stacks, a
+# Chrome trace and a summary of prefill and decode steps. `modal run llama2_vllm.py::flamegraph`
+# writes them to `profile.folded` and `profile.trace.json`. Nothing is hooked outside the window.
+@stub.local_entrypoint()
+def flamegraph(seconds: float = 10.0, interval: float = 0.01, output: str = "profile"):
+    write_profile(Model().profile.remote(seconds, interval), output)
+
+
+@stub.function(timeout=int(MAX_SECONDS) + 60, secret=Secret.from_name("llm-playground-secrets"))
 @web_endpoint(method="POST")
-async def completion(payload: Dict[str, str], token: HTTPAuthorizationCredentials = Depends(auth_scheme)):
-    from urllib.parse import unquote
+async def profile(payload: Dict[str, Any], token: HTTPAuthorizationCredentials = Depends(auth_scheme)):
+    if not os.environ.get("ADMIN_TOKEN") or token.credentials != os.environ["ADMIN_TOKEN"]:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Incorrect bearer token",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
 
-    from fastapi.responses import StreamingResponse
+    seconds = float(payload.get("seconds", 10))
+    if not 0 < seconds <= MAX_SECONDS:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"seconds must be in (0, {MAX_SECONDS:g}]")
+    try:
+        return await Model().profile.remote.aio(seconds, float(payload.get("interval", 0.01)))
+    except ProfilerBusy as e:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(e))
 
-    prompt = payload["prompt"]
 
+# ## Token counting on CPU
+# The frontend counts tokens through `count_tokens` without waking a GPU: a small CPU image holds
+# only the tokenizer files, and the fast tokenizer encodes each batch in one call with the prompt
+# template's tokens cached.
+def download_tokenizer_to_folder():
+    from huggingface_hub import snapshot_download
+
+    snapshot_download(
+        BASE_MODEL,
+        local_dir=TOKENIZER_DIR,
+        allow_patterns=["tokenizer*", "special_tokens_map.json", "*.model"],
+        token=os.environ["HUGGINGFACE_TOKEN"],
+    )
+
+
+tokenizer_image = (
+    Image.debian_slim(python_version="3.10")
+    .pip_install("transformers==4.36.2", "sentencepiece==0.1.99", "huggingface_hub==0.19.4", "aiohttp==3.9.1")
+    .run_function(download_tokenizer_to_folder,
+        secret=Secret.from_name("llm-playground-secrets"),)
+)
+
+
+@stub.cls(
+    image=tokenizer_image,
+    cpu=1,
+    container_idle_timeout=60 * 10,
+    allow_concurrent_inputs=20,
+)
+class Tokenizer:
+    def __enter__(self):
+        self.tokenizer = CachedTokenizer(load_fast_tokenizer(TOKENIZER_DIR))
+
+    @method()
+    def count_tokens(self, texts):
+        return self.tokenizer.count_tokens(texts, PROMPT_TEMPLATE)
+
+
+@stub.function(
+    allow_concurrent_inputs=20,
+    timeout=60,
+    secret=Secret.from_name("llm-playground-secrets"),
+)
+@web_endpoint(method="POST")
+async def count_tokens(payload: Dict[str, Any], token: HTTPAuthorizationCredentials = Depends(auth_scheme)):
     if token.credentials != os.environ["AUTH_TOKEN"]:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -216,13 +598,200 @@ async def completion(payload: Dict[str, str], token: HTTPAuthorizationCredential
             headers={"WWW-Authenticate": "Bearer"},
         )
 
-    async def generate():
-        async for text in Model().completion_stream.remote_gen.aio(
-            unquote(prompt)
-        ):
-            yield text
+    try:
+        texts = parse_texts(payload)
+    except TextsTooLarge as e:
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    counts = await Tokenizer().count_tokens.remote.aio(texts)
+    return {"counts": counts, "model": BASE_MODEL}
+
+
+# ## Semantic cache
+# Requests with `"cache": "semantic"` can be answered from earlier answers to similar prompts without
+# waking a GPU (see `semcache.py`). The cache lives in the web container; prompts are embedded by a
+# small sentence-transformers model on CPU.
+embedder_image = (
+    Image.debian_slim(python_version="3.10")
+    .pip_install("torch==2.1.2", index_url="https://download.pytorch.org/whl/cpu")
+    .pip_install("sentence-transformers==2.2.2", "huggingface_hub==0.19.4")
+    .run_function(download_embedder)
+)
+
+
+@stub.cls(
+    image=embedder_image,
+    cpu=2,
+    container_idle_timeout=60 * 10,
+    allow_concurrent_inputs=20,
+)
+class PromptEmbedder:
+    def __enter__(self):
+        self.embedder = SentenceEmbedder(EMBEDDER_DIR)
+
+    @method()
+    def embed(self, texts):
+        return self.embedder.embed(texts)
 
-    return StreamingResponse(generate(), media_type="text/event-stream")
+
+semantic_cache = SemanticCache(lambda texts: PromptEmbedder().embed.remote.aio(texts))
+
+# Concurrent identical greedy requests in this web container share a generation; see `singleflight.py`.
+flights = SingleFlight()
+
+# Every completion is recorded (prompt, output, timings, token counts) by a background task that
+# writes batches to this container's file on the generations volume; see `genlog.py`.
+generation_log = GenerationLog(
+    open_sink(os.path.join(GENERATIONS_DIR, stub.name, f"{os.environ.get('MODAL_TASK_ID', os.getpid())}.sqlite")),
+    count_tokens=lambda texts: web_tokenizer().count_tokens(texts),
+    on_flush=generations_volume.commit,
+)
+
+
+# The completion endpoint runs on the tokenizer image too, so prompts that can't fit the context
+# window are rejected (or truncated) before a GPU container is involved.
+budget = ContextBudget(CONTEXT_LENGTH, DEFAULT_MAX_TOKENS)
+
+
+@lru_cache(maxsize=1)
+def web_tokenizer():
+    return CachedTokenizer(load_fast_tokenizer(TOKENIZER_DIR))
+
+
+# Whether a warm container is available, checked alongside each request; see `warmup.py`.
+readiness_probe = ReadinessProbe(
+    lambda: Model().completion_stream.get_current_stats.aio(), stub.warmup_stats, default_cold_start=COLD_START_S
+)
+
+# One handle to the GPU class per web container, shared by all the requests it serves.
+completion_pool = BackendPool(
+    lambda: Model().completion_stream.remote_gen.aio, max_concurrency=10
+)
+
+
+async def backlog():
+    return (await Model().completion_stream.get_current_stats.aio()).backlog
+
+
+# Requests spill to the hosted models in `OVERFLOW_BACKENDS` (from the secret) when the GPU backlog
+# or time to first token is too high; see `providers.py`. Without any, every request stays here.
+router = OverflowRouter(completion_pool.stream, backends_from_env(), backlog)
+
+
+@stub.function(
+    image=tokenizer_image,
+    keep_warm=1,
+    allow_concurrent_inputs=10,
+    timeout=60 * 10,
+    secret=Secret.from_name("llm-playground-secrets"),
+    volumes={GENERATIONS_DIR: generations_volume, TRACES_DIR: traces_volume},
+)
+@web_endpoint(method="POST")
+async def completion(request: Request, payload: Dict[str, Any], token: HTTPAuthorizationCredentials = Depends(auth_scheme)):
+    from urllib.parse import unquote
+
+    from fastapi.responses import StreamingResponse
+
+    started = time.monotonic()
+    trace = tracer.start_trace()
+    root = trace.span("completion", **request_attributes(payload))
+    prompt = payload["prompt"]
+
+    with trace.span("auth", parent=root):
+        if token.credentials != os.environ["AUTH_TOKEN"]:
+            raise HTTPException(
+                status_code=status.HTTP_401_UNAUTHORIZED,
+                detail="Incorrect bearer token",
+                headers={"WWW-Authenticate": "Bearer"},
+            )
+
+    try:
+        n, best_of = parse_candidates(payload)
+        temperature = parse_temperature(payload, best_of)
+        stopping = stopping_options(payload)
+        with trace.span("budget", parent=root) as span:
+            fitted = budget.fit_prompt(
+                web_tokenizer(),
+                unquote(prompt),
+                PROMPT_TEMPLATE,
+                parse_max_tokens(payload),
+                payload.get("truncation", "shrink"),
+            )
+            span.end(prompt_tokens=fitted.prompt_tokens, truncated_tokens=fitted.truncated_tokens)
+    except ContextOverflow as e:
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+
+    encoder = negotiate(request.headers, payload.get("stream_format"), multiplexed=best_of > 1)
+    text = fitted.text if fitted.text is not None else unquote(prompt)
+    # Single uncompressed streams skip the encoder: the container packs each delta into a binary
+    # record (see `records.py`), which is written into the response as it arrived.
+    binary = encoder.raw and best_of == 1
+
+    # Cached answers are only reused for single plain completions: the namespace covers what else
+    # changes the answer, the sampling temperature included (`None` is the model's default).
+    cache = None
+    if payload.get("cache") == "semantic" and best_of == 1 and not stopping:
+        with trace.span("semantic_cache", parent=root) as span:
+            namespace = f"{BASE_MODEL}/{fitted.max_tokens}/{temperature}"
+            cache = await semantic_cache.lookup_or_none(namespace, text, stub.semantic_cache_stats)
+            if cache is not None:
+                span.end(hit=cache.hit, similarity=cache.similarity)
+
+    if cache is not None and cache.hit:
+        dispatch = trace.span("cached", parent=root)
+        deltas = replay(cache, encoder.wants_metadata)
+    else:
+        dispatch = trace.span("remote_gen", parent=root)
+
+        def start(prefix, sent):
+            return router.stream(
+                text,
+                stopping,
+                encoder.wants_metadata,
+                trace_context=trace.context(dispatch),
+                max_tokens=max(1, fitted.max_tokens - sent),
+                n=n,
+                best_of=best_of,
+                prefix=prefix,
+                binary=binary,
+                temperature=temperature,
+            )
+
+        # Single streams cut off by a retiring or failed container resume on another one.
+        deltas = resumable(start) if best_of == 1 else start("", 0)
+        if cache is not None:
+            deltas = semantic_cache.record(cache, deltas)
+        # Identical greedy requests running at the same time share one generation.
+        if temperature == 0:
+            key = flight_key(
+                BASE_MODEL,  text, fitted.max_tokens, stopping, encoder.wants_metadata, binary
+            )
+            deltas = flights.join(key, deltas)
+            await flights.publish(stub.single_flight_stats)
+    # Queued for the background writer once the stream ends; nothing is written on this path.
+    deltas = generation_log.track(
+        deltas,
+        started,
+        request_id=trace.trace_id,
+        model=BASE_MODEL,
+        prompt=text,
+        cached=cache is not None and cache.hit,
+        stream_format=encoder.format,
+        temperature=temperature,
+        max_tokens=fitted.max_tokens,
+        prompt_tokens=fitted.prompt_tokens,
+    )
+    if trace.sampled:
+        deltas = traced_stream(trace, deltas, dispatch, root)
+    if cache is None or not cache.hit:
+        deltas = with_eta(deltas, readiness_probe.check())
+    headers = {**encoder.headers, **fitted.headers(), **(cache.headers() if cache is not None else {})}
+    if binary:
+        return RecordStreamingResponse(deltas, encoder.format, encoder.media_type, headers)
+    return StreamingResponse(encoder.stream(deltas), media_type=encoder.media_type, headers=headers)
 
 
 @stub.function(
@@ -237,4 +806,41 @@ async def stats(token: HTTPAuthorizationCredentials = Depends(auth_scheme)):
         "backlog": stats.backlog,
         "num_total_runners": stats.num_total_runners,
         "model": BASE_MODEL + " (vLLM)",
+        "semantic_cache": await collect_metrics(stub.semantic_cache_stats),
+        "single_flight": await collect_flight_metrics(stub.single_flight_stats),
     }
+
+
+@stub.function(allow_concurrent_inputs=20, timeout=60)
+@web_endpoint()
+async def readiness():
+    return await readiness_probe.check()
+
+
+# ## Autoscaling
+# Every minute, feed the backlog, runner count and token rate into the policy and apply the
+# recommended warm-pool size. Use `python autoscale.py` to tune the policy offline first.
+autoscaler = Autoscaler(AutoscalePolicy(tokens_per_s_per_runner=600.0, min_warm=1))
+
+
+@stub.function(schedule=Period(minutes=1), timeout=60)
+async def autoscale():
+    stats = await Model().completion_stream.get_current_stats.aio()
+    tokens = await drain_token_counts(stub.token_counts)
+    signals = ScalingSignals(
+        backlog=stats.backlog,
+        num_total_runners=stats.num_total_runners,
+        tokens_per_s=tokens / 60,
+    )
+    await autoscaler.load(stub.autoscale_state)
+    decision = autoscaler.step(signals)
+    await autoscaler.save(stub.autoscale_state)
+    autoscaler.apply(Model().completion_stream, decision)
+
+
+# ## Scheduled warmup
+# Shortly before the daily peak, make sure a container has started and warmed up, so the first
+# requests of the peak don't wait for a cold start. `container_idle_timeout` keeps it until they come.
+@stub.function(schedule=Cron(WARMUP_CRON), timeout=60 * 10)
+async def scheduled_warmup():
+    print("Warm container:", await Model().ready.remote.aio())
@@ -9,39 +9,44 @@
 # ## Setup
 #
 # First we import the components we need from `modal`.
-from typing import Dict
+from functools import lru_cache
+from typing import Any, Dict
 
-from fastapi import Depends, HTTPException, status
+from fastapi import Depends, HTTPException, Request, status
 from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
-from modal import Image, Secret, Stub, gpu, method, web_endpoint
+from modal import Dict as ModalDict, Image, Secret, Stub, Volume, gpu, method, web_endpoint
+
+from bench import BenchParams, TransformersEngine, finish_report, parse_batch_sizes, run_benchmark
+from budget import ContextBudget, ContextOverflow, parse_max_tokens
+from embeddings import encode, pack, parse_request
+from pool import BackendPool
+from sampling import parse_candidates, rank, sample_candidates
+from stopping import StoppingEngine, stop_event, stopping_options, transformers_stopping_criteria
+from tokenization import CachedTokenizer
+from transport import negotiate
+from warmup import Readiness, ReadinessProbe, with_eta
+from weights import VOLUME_NAME, WEIGHTS_DIR, ensure
 
 auth_scheme = HTTPBearer()
 
 # ## Define a container image
 #
-# To take advantage of Modal's blazing fast cold-start times, we'll need to download our model weights
-# inside our container image.
-#
-# To do this, we have to define a function that loads both the model and tokenizer using
-# [from_pretrained](https://huggingface.co/docs/transformers/main_classes/model#transformers.PreTrainedModel.from_pretrained).
-# Since HuggingFace stores this model into a local cache, when Modal snapshots the image after running this function,
-# the model weights will be saved and available for use when the container starts up next time.
-
-
+# The container loads the model and tokenizer with
+# [from_pretrained](https://huggingface.co/docs/transformers/main_classes/model#transformers.PreTrainedModel.from_pretrained)
+# from a directory on the shared weights volume.
 BASE_MODEL = "openlm-research/open_llama_7b_400bt_preview"
-
-
-def download_models():
-    from transformers import LlamaForCausalLM, LlamaTokenizer
-
-    LlamaForCausalLM.from_pretrained(BASE_MODEL)
-    LlamaTokenizer.from_pretrained(BASE_MODEL)
+MODEL_REVISION = "main"
+# OpenLLaMA's context window. The web tier fits the user's text inside the prompt template before
+# a GPU container is involved: by default `max_tokens` shrinks to what is left, and with
+# `"truncation": "truncate"` the oldest user tokens are dropped while the template stays.
+budget = ContextBudget(2048, default_max_tokens=128)
+TOKENIZER_DIR = "/tokenizer"
 
 
 # Now, we define our image. We'll use the `debian-slim` base image, and install the dependencies we need
-# using [`pip_install`](/docs/reference/modal.Image#pip_install). At the end, we'll use
-# [`run_function`](/docs/guide/custom-container#running-a-function-as-a-build-step-beta) to run the
-# function defined above as part of the image build.
+# using [`pip_install`](/docs/reference/modal.Image#pip_install). The weights are not part of it: they
+# are stored once on the shared, content-addressed weights volume (see `weights.py`) and paged in
+# lazily when the model loads.
 
 image = (
     # Python 3.11+ not yet supported for torch.compile
@@ -52,12 +57,14 @@ image = (
         "torch~=2.0.0",
         "sentencepiece~=0.1.97",
     )
-    .run_function(download_models)
 )
+weights_volume = Volume.persisted(VOLUME_NAME)
 
 # Let's instantiate and name our [Stub](/docs/guide/apps).
 
 stub = Stub(name="open-llama", image=image)
+# Containers record when they start and how long cold starts take here; see `warmup.py`.
+stub.warmup_stats = ModalDict.new()
 
 
 # ## The model class
@@ -72,16 +79,21 @@ stub = Stub(name="open-llama", image=image)
 # from the `transformers` library. Refer to the documentation for more parameters and tuning.
 
 
-@stub.cls(gpu=gpu.A100(memory=20))
+@stub.cls(gpu=gpu.A100(memory=20), volumes={WEIGHTS_DIR: weights_volume})
 class OpenLlamaModel:
     def __enter__(self):
         import torch
         from transformers import LlamaForCausalLM, LlamaTokenizer
 
-        self.tokenizer = LlamaTokenizer.from_pretrained(BASE_MODEL)
+        self.readiness = Readiness(stub.warmup_stats)
+
+        # Deliberately the slow tokenizer: OpenLLaMA's auto-converted fast tokenizer is known to
+        # tokenize some inputs incorrectly (see the open_llama README).
+        model_dir = ensure(BASE_MODEL, MODEL_REVISION, weights_volume)
+        self.tokenizer = LlamaTokenizer.from_pretrained(model_dir)
 
         model = LlamaForCausalLM.from_pretrained(
-            BASE_MODEL,
+            model_dir,
             torch_dtype=torch.float16,
             device_map="auto",
         )
@@ -90,13 +102,28 @@ class OpenLlamaModel:
 
         model.eval()
         self.model = torch.compile(model)
+        # `sample_candidates` calls the model once per step with a sequence that grows each time,
+        # which would recompile the compiled graph on every step; it runs the module as is.
+        self.eager_model = model
         self.device = "cuda"
 
+        # The first generation compiles the model; do it here rather than in the first request.
+        warmup_ids = self.tokenizer("Hello", return_tensors="pt")["input_ids"].to(self.device)
+        self.readiness.warmup(lambda: self.model.generate(input_ids=warmup_ids, max_new_tokens=4))
+
+    @method()
+    def ready(self):
+        return self.readiness.snapshot()
+
     @method()
     def generate(
         self,
         input,
         max_new_tokens=128,
+        stopping=None,
+        n=1,
+        best_of=None,
+        with_reason=False,
         **kwargs,
     ):
         import torch
@@ -104,8 +131,19 @@ class OpenLlamaModel:
 
         inputs = self.tokenizer(input, return_tensors="pt")
         input_ids = inputs["input_ids"].to(self.device)
+        # The web tier already fitted the prompt; this only catches the token it may have miscounted.
+        max_new_tokens = budget.check(input_ids.shape[1], max_new_tokens).max_tokens
+        prompt_length = input_ids.shape[1]
+        if (best_of or n) > 1:
+            return self.candidates(input_ids, n, best_of or n, max_new_tokens, stopping, **kwargs)
 
         generation_config = GenerationConfig(**kwargs)
+        # The criteria decode the continuation on every step, so they are only installed when needed.
+        criteria = {}
+        if stopping:
+            criteria["stopping_criteria"] = transformers_stopping_criteria(
+                StoppingEngine.from_payload(stopping), self.tokenizer, prompt_length
+            )
         with torch.no_grad():
             generation_output = self.model.generate(
                 input_ids=input_ids,
@@ -113,20 +151,84 @@ class OpenLlamaModel:
                 return_dict_in_generate=True,
                 output_scores=True,
                 max_new_tokens=max_new_tokens,
+                **criteria,
             )
         s = generation_output.sequences[0]
         output = self.tokenizer.decode(s)
-        return output
+        reason = None
+        if stopping:
+            # Generation ended on the step that matched; trim the matched stop text itself.
+            stopper = StoppingEngine.from_payload(stopping)
+            completion, _ = stopper.feed(
+                self.tokenizer.decode(s[prompt_length:], skip_special_tokens=True)
+            )
+            output = self.tokenizer.decode(s[:prompt_length]) + completion + stopper.flush()
+            reason = stopper.reason
+        # `with_reason` also returns why generation stopped, for the web tier to report.
+        return (output, reason) if with_reason else output
         print(f"\033[96m{input}\033[0m")
         print(output.split(input)[1].strip())
 
+    def candidates(self, input_ids, n, best_of, max_new_tokens, stopping=None, **kwargs):
+        """The best `n` of `best_of` sampled outputs, ranked by cumulative logprob, from one prefill."""
+        prompt_length = input_ids.shape[1]
+        criteria = [
+            transformers_stopping_criteria(StoppingEngine.from_payload(stopping), self.tokenizer, prompt_length)
+            for _ in range(best_of if stopping else 0)
+        ]
+        sequences, cumulative_logprobs = sample_candidates(
+            self.eager_model,
+            input_ids,
+            best_of,
+            max_new_tokens,
+            eos_token_id=self.tokenizer.eos_token_id,
+            temperature=kwargs.get("temperature", 1.0),
+            top_k=kwargs.get("top_k", 0),
+            top_p=kwargs.get("top_p", 1.0),
+            should_stop=(lambda i, sequence: criteria[i](sequence[None], None)) if stopping else None,
+        )
+
+        prompt = self.tokenizer.decode(sequences[0, :prompt_length])
+        outputs = []
+        for position, i in enumerate(rank(cumulative_logprobs)[:n]):
+            stopper = StoppingEngine.from_payload(stopping or {})
+            completion, _ = stopper.feed(
+                self.tokenizer.decode(sequences[i, prompt_length:], skip_special_tokens=True)
+            )
+            outputs.append(
+                {
+                    "index": position,
+                    "text": prompt + completion + stopper.flush(),
+                    "cumulative_logprob": cumulative_logprobs[i],
+                    "stop_reason": stopper.reason,
+                }
+            )
+        return outputs
+
+    @method()
+    def embed(self, texts, format="binary", dtype="float32"):
+        # Embeddings reuse the loaded weights: mean-pooled last hidden state, batched by length.
+        vectors = encode(texts, self.tokenizer, self.model, self.device)
+        if format == "json":
+            return vectors.astype(dtype).tolist()
+        return pack(vectors, dtype)
+
+    @method()
+    async def benchmark(self, batch_sizes, max_tokens: int = 64):
+        # Each request generates on its own thread, as `generate` does, so this measures how
+        # concurrent requests share the GPU rather than batched throughput.
+        engine = TransformersEngine(self.model, self.tokenizer, self.device)
+        return await run_benchmark(
+            engine, batch_sizes, BenchParams(max_tokens), model=BASE_MODEL, engine_name="transformers"
+        )
+
 
 # ## Run the model
 # Finally, we define a [`local_entrypoint`](/docs/guide/apps#entrypoints-for-ephemeral-apps) to call our remote function
 # sequentially for a list of inputs. You can run this locally with `modal run openllama.py`.
 prompt_template = (
     "A chat between a curious human user and an artificial intelligence assistant. The assistant give a helpful, detailed, and accurate answer to the user's question. Return your answer in markdown format."
-    "\n\nUser:\n{}\n\nAssistant:\n"
+    "\n\nUser:\n{user}\n\nAssistant:\n"
 )
 
 
@@ -135,7 +237,7 @@ def main():
     input = "How to be good at anything"
     model = OpenLlamaModel()
     model.generate.call(
-        input=prompt_template.format(input),
+        input=prompt_template.format(user=input),
         top_p=0.75,
         top_k=40,
         num_beams=1,
@@ -144,13 +246,58 @@ def main():
     )
 
 
-@stub.function(timeout=600, secret=Secret.from_name("llm-playground-secrets"))
+# Measures tokens/s, time to first token and latency at each batch size; see `bench.py`.
+@stub.local_entrypoint()
+def bench(batch_sizes: str = "1,8", max_tokens: int = 64, output: str = "", baseline: str = "", tolerance: float = 0.1):
+    report = OpenLlamaModel().benchmark.remote(parse_batch_sizes(batch_sizes), max_tokens)
+    finish_report(report, output or f"bench-{stub.name}.json", baseline, tolerance)
+
+
+# The web handlers are async and share one handle per GPU method, so a generation doesn't hold a
+# worker thread of the web container.
+#
+# The generate endpoint runs on an image with just the tokenizer files, so it can fit prompts to
+# the context window before a GPU container is involved.
+def download_tokenizer_to_folder():
+    from huggingface_hub import snapshot_download
+
+    snapshot_download(
+        BASE_MODEL,
+        local_dir=TOKENIZER_DIR,
+        allow_patterns=["tokenizer*", "special_tokens_map.json", "*.model"],
+    )
+
+
+tokenizer_image = (
+    Image.debian_slim(python_version="3.10")
+    .pip_install("transformers~=4.28.1", "sentencepiece~=0.1.97", "huggingface_hub==0.19.4")
+    .run_function(download_tokenizer_to_folder)
+)
+
+
+@lru_cache(maxsize=1)
+def web_tokenizer():
+    from transformers import LlamaTokenizer
+
+    # The same slow tokenizer and BOS id as the model class.
+    tokenizer = LlamaTokenizer.from_pretrained(TOKENIZER_DIR)
+    tokenizer.bos_token_id = 1
+    return CachedTokenizer(tokenizer)
+
+
+generate_pool = BackendPool(lambda: OpenLlamaModel().generate.remote.aio)
+readiness_probe = ReadinessProbe(lambda: OpenLlamaModel().generate.get_current_stats.aio(), stub.warmup_stats, default_cold_start=30)
+embed_pool = BackendPool(lambda: OpenLlamaModel().embed.remote.aio)
+
+
+@stub.function(image=tokenizer_image, timeout=600, secret=Secret.from_name("llm-playground-secrets"))
 @web_endpoint(method="POST")
-def generate(
-    payload: Dict[str, str], token: HTTPAuthorizationCredentials = Depends(auth_scheme)
+async def generate(
+    request: Request,
+    payload: Dict[str, Any],
+    token: HTTPAuthorizationCredentials = Depends(auth_scheme),
 ):
     import os
-    from itertools import chain
 
     from fastapi.responses import StreamingResponse
 
@@ -163,23 +310,85 @@ def generate(
             headers={"WWW-Authenticate": "Bearer"},
         )
 
-    model = OpenLlamaModel()
+    try:
+        n, best_of = parse_candidates(payload)
+        stopping = stopping_options(payload)
+        fitted = budget.fit_prompt(
+            web_tokenizer(), prompt, prompt_template, parse_max_tokens(payload), payload.get("truncation", "shrink")
+        )
+    except ContextOverflow as e:
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+
+    encoder = negotiate(request.headers, payload.get("stream_format"), multiplexed=best_of > 1)
+
+    async def chunks():
+        output = await generate_pool.call(
+            input=prompt_template.format(user=fitted.text if fitted.text is not None else prompt),
+            max_new_tokens=fitted.max_tokens,
+            stopping=stopping,
+            n=n,
+            best_of=best_of,
+            top_p=0.75,
+            top_k=40,
+            num_beams=1,
+            temperature=0.1,
+            do_sample=True,
+            with_reason=best_of == 1,
+        )
+        # Several candidates come back as a ranked list of records, one per candidate, each with
+        # its stop reason.
+        if best_of > 1:
+            for chunk in output:
+                yield chunk
+            return
+        text, reason = output
+        yield text
+        event = stop_event(reason)
+        if event is not None:
+            yield event
+
+    # Instead of a "Loading model" preamble, cold starts are announced with `status` events
+    # carrying an ETA (SSE and NDJSON clients); see `warmup.py`.
     return StreamingResponse(
-        chain(
-            ("Loading model. This usually takes around 20s ...\n\n"),
-            model.generate.call(
-                input=prompt_template.format(prompt),
-                top_p=0.75,
-                top_k=40,
-                num_beams=1,
-                temperature=0.1,
-                do_sample=True,
-            ),
-        ),
-        media_type="text/event-stream",
+        encoder.stream(with_eta(chunks(), readiness_probe.check())),
+        media_type=encoder.media_type,
+        headers={**encoder.headers, **fitted.headers()},
     )
 
 
+# ## Embeddings endpoint
+# Send `{"texts": [...]}` to get one vector per text. By default the response is the compact binary
+# format from `embeddings.py` (`application/octet-stream`, read it with `embeddings.unpack`); pass
+# `"format": "json"` for nested lists, and `"dtype": "float16"` to halve the payload.
+@stub.function(timeout=600, secret=Secret.from_name("llm-playground-secrets"))
+@web_endpoint(method="POST")
+async def embed(
+    payload: Dict[str, Any], token: HTTPAuthorizationCredentials = Depends(auth_scheme)
+):
+    import os
+
+    from fastapi.responses import Response
+
+    if token.credentials != os.environ["AUTH_TOKEN"]:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Incorrect bearer token",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+
+    try:
+        texts, format, dtype = parse_request(payload)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=str(e))
+
+    result = await embed_pool.call(texts, format, dtype)
+    if format == "json":
+        return {"embeddings": result, "dtype": dtype}
+    return Response(content=result, media_type="application/octet-stream")
+
+
 # ## Next steps
 # The above is a simple example of how to run a basic model. Note that OpenLLaMa has not been fine-tuned on an instruction-following dataset,
 # so the results aren't amazing out of the box. Refer to [DoppelBot, our Slack fine-tuning demo](https://github.com/modal-labs/doppel-bot) for how
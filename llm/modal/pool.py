@@ -0,0 +1,181 @@
+# # Reusable, bounded handles from the web tier to the GPU classes
+#
+# Every completion request used to build a fresh `Model()` handle, and the transformers endpoints
+# made blocking `.call`s from sync handlers, holding a worker thread for the whole generation.
+# A `BackendPool` is created once per web container and reused by every request:
+#
+# - the Modal function handle is resolved on first use and kept,
+# - a semaphore bounds how many calls this web container has in flight to the GPU class,
+# - the first item has its own (cold-start sized) timeout, later items an idle timeout, and
+# - connection failures before anything was sent to the client are retried with exponential backoff
+#   and full jitter. Once a delta has been streamed we can't retry transparently, so errors propagate.
+#
+# Timeouts are never retried: by the time one fires the backend has accepted the call and may still
+# be generating (or queued behind a cold start), and a generation isn't idempotent, so a retry would
+# run it twice.
+#
+# Run `python pool.py` to check the timeout handling and measure the per-request overhead the pool
+# adds, against the local stand-in backend from `fake_engine.py`.
+import asyncio
+import random
+from typing import Any, AsyncIterator, Callable, Optional, Tuple, Type
+
+RETRYABLE: Tuple[Type[BaseException], ...] = (asyncio.TimeoutError, ConnectionError, OSError)
+
+
+async def _next_within(items: AsyncIterator[Any], timeout: Optional[float]) -> Any:
+    """`items.__anext__()`, raising `asyncio.TimeoutError` after `timeout` seconds."""
+    if timeout is None:
+        return await items.__anext__()
+    return await asyncio.wait_for(items.__anext__(), timeout)
+
+
+class BackendPool:
+    def __init__(
+        self,
+        connect: Callable[[], Callable[..., Any]],
+        max_concurrency: int = 10,
+        first_item_timeout: Optional[float] = 60 * 5,
+        idle_timeout: Optional[float] = 60,
+        retries: int = 2,
+        backoff: float = 0.5,
+        max_backoff: float = 8.0,
+        retry_on: Tuple[Type[BaseException], ...] = RETRYABLE,
+    ):
+        self._connect = connect
+        self._target: Optional[Callable[..., Any]] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self.max_concurrency = max_concurrency
+        self.first_item_timeout = first_item_timeout
+        self.idle_timeout = idle_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.retry_on = retry_on
+        self.in_flight = 0
+        self.num_retries = 0
+
+    @property
+    def target(self) -> Callable[..., Any]:
+        if self._target is None:
+            self._target = self._connect()
+        return self._target
+
+    @property
+    def semaphore(self) -> asyncio.Semaphore:
+        # Created lazily so it belongs to the event loop serving requests.
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphore
+
+    def backoff_delay(self, attempt: int) -> float:
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2**attempt))
+
+    async def stream(self, *args, **kwargs) -> AsyncIterator[Any]:
+        """Streams the items of a generator method, e.g. `Model().completion_stream`."""
+        async with self.semaphore:
+            self.in_flight += 1
+            try:
+                for attempt in range(self.retries + 1):
+                    started = False
+                    items = self.target(*args, **kwargs).__aiter__()
+                    try:
+                        timeout = self.first_item_timeout
+                        while True:
+                            try:
+                                item = await _next_within(items, timeout)
+                            except StopAsyncIteration:
+                                return
+                            started = True
+                            timeout = self.idle_timeout
+                            yield item
+                    except self.retry_on as e:
+                        if started or attempt == self.retries or isinstance(e, asyncio.TimeoutError):
+                            raise
+                        self.num_retries += 1
+                        delay = self.backoff_delay(attempt)
+                        print(f"Retrying backend call in {delay:.2f}s after {type(e).__name__}: {e}")
+                        await asyncio.sleep(delay)
+                    finally:
+                        aclose = getattr(items, "aclose", None)
+                        if aclose is not None:
+                            await aclose()
+            finally:
+                self.in_flight -= 1
+
+    async def call(self, *args, **kwargs) -> Any:
+        """Awaits a regular method, e.g. `OpenLlamaModel().generate`."""
+        async with self.semaphore:
+            self.in_flight += 1
+            try:
+                for attempt in range(self.retries + 1):
+                    try:
+                        return await asyncio.wait_for(self.target(*args, **kwargs), self.first_item_timeout)
+                    except self.retry_on as e:
+                        if attempt == self.retries or isinstance(e, asyncio.TimeoutError):
+                            raise
+                        self.num_retries += 1
+                        delay = self.backoff_delay(attempt)
+                        print(f"Retrying backend call in {delay:.2f}s after {type(e).__name__}: {e}")
+                        await asyncio.sleep(delay)
+            finally:
+                self.in_flight -= 1
+
+
+async def measure_overhead(num_requests: int = 2000, concurrency: int = 10) -> float:
+    """Mean extra seconds per request when streaming through a `BackendPool` instead of directly."""
+    import time
+
+    from fake_engine import fake_completion_stream
+
+    async def drain(stream):
+        async for _ in stream:
+            pass
+
+    async def run(make_stream) -> float:
+        t0 = time.perf_counter()
+        for i in range(0, num_requests, concurrency):
+            await asyncio.gather(*(drain(make_stream(f"q{j}")) for j in range(i, min(i + concurrency, num_requests))))
+        return time.perf_counter() - t0
+
+    pool = BackendPool(lambda: fake_completion_stream, max_concurrency=concurrency)
+    direct = await run(fake_completion_stream)
+    pooled = await run(pool.stream)
+    return (pooled - direct) / num_requests
+
+
+async def check_timeouts():
+    """A first-item timeout isn't retried, and cancelling a waiting request still cancels it."""
+    calls = []
+
+    async def slow(prompt):
+        calls.append(prompt)
+        await asyncio.sleep(10)
+        yield prompt
+
+    async def drain(stream):
+        async for _ in stream:
+            pass
+
+    pool = BackendPool(lambda: slow, first_item_timeout=0.05, backoff=0)
+    try:
+        await drain(pool.stream("q"))
+    except asyncio.TimeoutError:
+        pass
+    assert calls == ["q"], calls
+
+    pool = BackendPool(lambda: slow, first_item_timeout=5)
+    task = asyncio.ensure_future(drain(pool.stream("q")))
+    await asyncio.sleep(0.05)
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+    assert task.cancelled() and pool.in_flight == 0
+
+
+if __name__ == "__main__":
+    asyncio.run(check_timeouts())
+    overhead = asyncio.run(measure_overhead())
+    print(f"Proxy overhead per request: {overhead * 1e6:.1f}us")
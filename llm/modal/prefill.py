@@ -0,0 +1,245 @@
+# # Pacing long prompt prefills against running streams
+#
+# vLLM 0.2's scheduler prefers prompts: whenever a prompt is waiting and fits, the next engine step
+# prefills every waiting prompt that fits in `max_num_batched_tokens` (at least the context length)
+# and decodes nothing. One user pasting a long document, or a few arriving together, stalls every
+# other stream in the container for the whole prefill, and back-to-back arrivals stall them again
+# on every step.
+#
+# Chunked prefill, splitting one prompt's prefill across steps, is NOT implemented here. It needs
+# attention over a partially cached prompt, which this vLLM version doesn't have. `PrefillPacer`
+# only bounds what the scheduler can do, from outside it:
+#
+# - a prefill step admits waiting prompts only up to `token_budget` prompt tokens (a longer prompt
+#   still runs, but on its own), so a stall is at most one long prompt rather than several;
+# - after a prefill step, at least `min_decode_steps` decode steps run before the next prefill
+#   whenever streams are running, so they keep producing tokens between long prompts.
+#
+# Both are enforced by showing the scheduler only the part of the waiting queue it may admit, so
+# prompts are still admitted in arrival order. Pacing bounds the longest stall to one prompt's
+# prefill; it can't make that prefill shorter, and under steady long-prompt traffic it turns one
+# long stall into several shorter ones. Only true chunked prefill (simulated below) bounds the p99.
+# The transformers apps serve one input per container, so no other stream shares their GPU.
+#
+# The pacer is off by default (`PREFILL_PACING = False` in the apps). It wraps the scheduler's
+# private `_schedule`, and on the simulated engine it cuts the worst stall but makes the long
+# prompts' TTFT p99 and the share of >100 ms gaps worse at rates 1 and 2 below, and the ITL p99
+# worse at rate 1. Turn it on for an app only after `bench_prefill` on that app's engine shows a win.
+# `bench_prefill` installs it for the measurement and removes it again (`uninstall`).
+#
+# Run `python prefill.py` to compare the inter-token latency of short streams while long prompts
+# arrive, under vLLM's policy, pacing, and true chunked prefill, on a simulated engine. On a real
+# engine, `measure_interference` in `bench.py` measures the same (`modal run mistral_vllm.py::bench_prefill`).
+import math
+from typing import Any, Dict, List
+
+
+def _prompt_tokens(seq_group) -> int:
+    return seq_group.get_seqs()[0].get_len()
+
+
+class PrefillPacer:
+    def __init__(self, token_budget: int = 4096, min_decode_steps: int = 8):
+        self.token_budget = token_budget
+        self.min_decode_steps = min_decode_steps
+        self.enabled = True
+        self.decode_steps = min_decode_steps
+        self.counts = {"prefill_steps": 0, "decode_steps": 0, "deferred_prefills": 0, "split_batches": 0}
+        self._installed = None
+
+    def admissible(self, waiting: List[Any], running: int) -> int:
+        """How many prompts from the head of `waiting` the next step may admit."""
+        if not waiting or not self.enabled:
+            return len(waiting)
+        if running and self.decode_steps < self.min_decode_steps:
+            self.counts["deferred_prefills"] += 1
+            return 0
+        admitted, tokens = 1, _prompt_tokens(waiting[0])
+        while admitted < len(waiting) and tokens + _prompt_tokens(waiting[admitted]) <= self.token_budget:
+            tokens += _prompt_tokens(waiting[admitted])
+            admitted += 1
+        if admitted < len(waiting):
+            self.counts["split_batches"] += 1
+        return admitted
+
+    def record(self, prompt_run: bool):
+        if prompt_run:
+            self.decode_steps = 0
+            self.counts["prefill_steps"] += 1
+        else:
+            self.decode_steps += 1
+            self.counts["decode_steps"] += 1
+
+    def install(self, llm_engine) -> "PrefillPacer":
+        """Wraps `llm_engine.scheduler._schedule` so each step sees only the admissible prompts."""
+        scheduler = llm_engine.scheduler
+        schedule = scheduler._schedule
+
+        def paced_schedule():
+            # A list in vLLM 0.2, a deque in 0.3; preempted groups are put back at its front.
+            waiting = list(scheduler.waiting)
+            container = type(scheduler.waiting)
+            admitted = self.admissible(waiting, len(scheduler.running))
+            if admitted == len(waiting):
+                outputs = schedule()
+            else:
+                scheduler.waiting = container(waiting[:admitted])
+                try:
+                    outputs = schedule()
+                finally:
+                    # Whatever is left in the shortened queue (including groups preempted during
+                    # this step) stays ahead of the prompts held back.
+                    scheduler.waiting = container(list(scheduler.waiting) + waiting[admitted:])
+            self.record(outputs.prompt_run)
+            return outputs
+
+        scheduler._schedule = paced_schedule
+        self._installed = (scheduler, schedule)
+        return self
+
+    def uninstall(self):
+        """Puts the scheduler's own `_schedule` back."""
+        if self._installed is not None:
+            scheduler, schedule = self._installed
+            scheduler._schedule = schedule
+            self._installed = None
+
+    @property
+    def installed(self) -> bool:
+        return self._installed is not None
+
+    def metrics(self) -> Dict[str, Any]:
+        return dict(self.counts, token_budget=self.token_budget, min_decode_steps=self.min_decode_steps)
+
+
+class _Prompt:
+    """Stands in for a vLLM `SequenceGroup` in the simulation."""
+
+    def __init__(self, tokens: int, arrived: float):
+        self.tokens = tokens
+        self.arrived = arrived
+        self.prefilled = 0
+
+    def get_seqs(self):
+        return [self]
+
+    def get_len(self) -> int:
+        return self.tokens
+
+
+def simulate(
+    policy: str = "vllm",
+    duration: float = 120.0,
+    short_streams: int = 16,
+    long_rate: float = 1.0,
+    long_tokens=(2000, 8000),
+    short_tokens: int = 300,
+    max_batched_tokens: int = 8192,
+    token_budget: int = 4096,
+    min_decode_steps: int = 8,
+    chunk_tokens: int = 512,
+    step_s: float = 0.012,
+    decode_s_per_seq: float = 0.0002,
+    prefill_s_per_token: float = 0.00006,
+    seed: int = 0,
+) -> Dict[str, float]:
+    """Inter-token latency of `short_streams` steady streams while long prompts arrive.
+
+    A step costs `step_s`, plus `decode_s_per_seq` per decoding sequence and `prefill_s_per_token`
+    per prefilled prompt token. Policies: `vllm` (prefill every waiting prompt that fits, then
+    decode), `paced` (the same behind a `PrefillPacer`) and `chunked` (every step decodes all
+    running sequences and prefills at most `chunk_tokens` prompt tokens, which this vLLM can't do).
+    """
+    import random
+
+    rng = random.Random(seed)
+    t, next_long = 0.0, rng.expovariate(long_rate)
+    waiting: List[_Prompt] = []
+    # Short streams restart as soon as they finish, so there are always `short_streams` of them.
+    short = [{"last": None, "left": rng.randint(1, short_tokens)} for _ in range(short_streams)]
+    gaps: List[float] = []
+    long_ttfts: List[float] = []
+    long_running = 0
+    pacer = PrefillPacer(token_budget, min_decode_steps) if policy == "paced" else None
+
+    while t < duration:
+        while next_long <= t:
+            waiting.append(_Prompt(rng.randint(*long_tokens), next_long))
+            next_long += rng.expovariate(long_rate)
+        running = short_streams + long_running
+
+        prefill_tokens, finished_prefill, decode = 0, [], True
+        if policy == "chunked":
+            budget = chunk_tokens
+            for prompt in waiting:
+                chunk = min(budget, prompt.tokens - prompt.prefilled)
+                prompt.prefilled += chunk
+                prefill_tokens += chunk
+                budget -= chunk
+                if prompt.prefilled == prompt.tokens:
+                    finished_prefill.append(prompt)
+                if not budget:
+                    break
+        else:
+            admitted = pacer.admissible(waiting, running) if pacer is not None else len(waiting)
+            for prompt in waiting[:admitted]:
+                if finished_prefill and prefill_tokens + prompt.tokens > max_batched_tokens:
+                    break
+                prefill_tokens += prompt.tokens
+                finished_prefill.append(prompt)
+            decode = not finished_prefill
+            if pacer is not None:
+                pacer.record(bool(finished_prefill))
+
+        t += step_s + prefill_tokens * prefill_s_per_token + (decode_s_per_seq * running if decode else 0.0)
+        for prompt in finished_prefill:
+            waiting.remove(prompt)
+            long_ttfts.append(t - prompt.arrived)
+            long_running += 1
+        if decode:
+            for stream in short:
+                if stream["last"] is not None:
+                    gaps.append(t - stream["last"])
+                stream["last"] = t
+                stream["left"] -= 1
+                if stream["left"] == 0:
+                    stream.update(last=None, left=short_tokens)
+            # Long prompts generate a few hundred tokens; model their completion as a coin flip.
+            long_running -= sum(rng.random() < 1 / 300 for _ in range(long_running))
+
+    gaps.sort()
+    long_ttfts.sort()
+
+    def quantile(values: List[float], q: float) -> float:
+        return values[min(len(values) - 1, int(math.ceil(q * len(values))) - 1)] if values else 0.0
+
+    return {
+        "itl_p50_ms": quantile(gaps, 0.5) * 1000,
+        "itl_p99_ms": quantile(gaps, 0.99) * 1000,
+        "itl_max_ms": (gaps[-1] if gaps else 0.0) * 1000,
+        "itl_over_100ms": sum(gap > 0.1 for gap in gaps) / max(len(gaps), 1),
+        "short_tokens_per_s": len(gaps) / duration,
+        "long_prompts": len(long_ttfts),
+        "long_ttft_p50_s": quantile(long_ttfts, 0.5),
+        "long_ttft_p99_s": quantile(long_ttfts, 0.99),
+    }
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rates", default="0.5,1,2", help="long prompts per second")
+    parser.add_argument("--token-budget", type=int, default=4096)
+    parser.add_argument("--min-decode-steps", type=int, default=8)
+    parser.add_argument("--chunk-tokens", type=int, default=512)
+    args = parser.parse_args()
+
+    print("rate  policy   ITL p50  ITL p99  ITL max  >100ms  short tok/s  long TTFT p50  p99")
+    for rate in map(float, args.rates.split(",")):
+        for policy in ("vllm", "paced", "chunked"):
+            r = simulate(policy, long_rate=rate, token_budget=args.token_budget, min_decode_steps=args.min_decode_steps, chunk_tokens=args.chunk_tokens)
+            print(
+                f"{rate:4.1f}  {policy:<7} {r['itl_p50_ms']:6.0f}ms {r['itl_p99_ms']:6.0f}ms {r['itl_max_ms']:6.0f}ms "
+                f"{r['itl_over_100ms']:6.1%}  {r['short_tokens_per_s']:11.0f}  {r['long_ttft_p50_s']:12.2f}s {r['long_ttft_p99_s']:5.2f}s"
+            )
@@ -0,0 +1,342 @@
+# # On-demand profiling of the decode loop
+#
+# When throughput drops there was no way to look inside a running container. `Profiler` profiles
+# one for a fixed window and returns:
+#
+# - `collapsed`: CPU stacks of every Python thread, sampled every `interval` seconds, in the
+#   collapsed format of `flamegraph.pl` and speedscope (`frame;frame;frame count` per line);
+# - `chrome_trace`: a Chrome trace (chrome://tracing, Perfetto) from `torch.profiler` with CPU
+#   ops and CUDA kernels, plus one span per engine step named `prefill` or `decode`;
+# - `summary`: sample counts, and count and time of the prefill and decode steps.
+#
+# Nothing is installed while profiling is off: the step hooks (`annotate_vllm_steps` for vLLM
+# engines, `annotate_forward` for transformers models) patch the engine or model only for the
+# window and put the original methods back afterwards, and the sampler thread only exists
+# during the window. One profile runs at a time per container; another one raises `ProfilerBusy`.
+#
+# Run `python profiling.py` to profile a stand-in decode loop.
+import asyncio
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+MAX_SECONDS = 60.0
+
+# A hook installs itself given the spans to record into, and returns a function that uninstalls it.
+Hook = Callable[["StepSpans"], Callable[[], None]]
+
+
+class ProfilerBusy(RuntimeError):
+    pass
+
+
+class StepSpans:
+    """Prefill and decode step spans as Chrome trace events."""
+
+    def __init__(self):
+        self.events: List[Dict[str, Any]] = []
+        self._open = threading.local()
+
+    def begin(self, name: str):
+        stack = self._open.__dict__.setdefault("stack", [])
+        stack.append((name, time.time_ns()))
+
+    def end(self):
+        stack = getattr(self._open, "stack", None)
+        if not stack:
+            return
+        name, start = stack.pop()
+        self.events.append(
+            {
+                "name": name,
+                "cat": "step",
+                "ph": "X",
+                "ts": start / 1000,
+                "dur": (time.time_ns() - start) / 1000,
+                "pid": os.getpid(),
+                "tid": threading.get_ident(),
+            }
+        )
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        steps: Dict[str, Dict[str, float]] = {}
+        for event in self.events:
+            step = steps.setdefault(event["name"], {"count": 0, "total_ms": 0.0})
+            step["count"] += 1
+            step["total_ms"] += event["dur"] / 1000
+        for step in steps.values():
+            step["mean_ms"] = round(step["total_ms"] / step["count"], 3)
+            step["total_ms"] = round(step["total_ms"], 3)
+        return steps
+
+
+def _patch(obj, name: str, replacement) -> Callable[[], None]:
+    """Sets `obj.name`, returning a function that puts back exactly what was there."""
+    had_own = name in vars(obj)
+    original = vars(obj).get(name)
+    setattr(obj, name, replacement)
+
+    def restore():
+        if had_own:
+            setattr(obj, name, original)
+        else:
+            delattr(obj, name)
+
+    return restore
+
+
+def annotate_vllm_steps(llm_engine, spans: StepSpans) -> Callable[[], None]:
+    """Records a span per `LLMEngine` step, named after what the scheduler picked for it.
+
+    In vLLM 0.2 a step either prefills newly scheduled prompts or decodes one token for every
+    running sequence; `SchedulerOutputs.prompt_run` says which.
+    """
+    scheduler = llm_engine.scheduler
+    schedule = scheduler.schedule
+    step_name = "step_async" if hasattr(llm_engine, "step_async") else "step"
+    step = getattr(llm_engine, step_name)
+
+    def scheduled(*args, **kwargs):
+        result = schedule(*args, **kwargs)
+        outputs = result[-1] if isinstance(result, tuple) else result
+        if getattr(outputs, "prompt_run", False):
+            spans.begin("prefill")
+        elif hasattr(outputs, "is_empty") and outputs.is_empty():
+            spans.begin("idle")
+        else:
+            spans.begin("decode")
+        return result
+
+    if asyncio.iscoroutinefunction(step):
+
+        async def stepped(*args, **kwargs):
+            try:
+                return await step(*args, **kwargs)
+            finally:
+                spans.end()
+
+    else:
+
+        def stepped(*args, **kwargs):
+            try:
+                return step(*args, **kwargs)
+            finally:
+                spans.end()
+
+    restores = [_patch(scheduler, "schedule", scheduled), _patch(llm_engine, step_name, stepped)]
+    return lambda: [restore() for restore in reversed(restores)]
+
+
+def annotate_forward(module, spans: StepSpans) -> Callable[[], None]:
+    """Records a span per forward pass of a transformers model: the first one of a `generate` call
+    (no `past_key_values` yet) is the prefill, the rest are decode steps."""
+    forward = module.forward
+
+    def annotated(*args, **kwargs):
+        spans.begin("decode" if kwargs.get("past_key_values") is not None else "prefill")
+        try:
+            return forward(*args, **kwargs)
+        finally:
+            spans.end()
+
+    return _patch(module, "forward", annotated)
+
+
+def _label(code) -> str:
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class StackSampler:
+    """Samples the Python stacks of all other threads from a background thread."""
+
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.stacks: Counter = Counter()
+        self.num_samples = 0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                labels = []
+                while frame is not None:
+                    labels.append(_label(frame.f_code))
+                    frame = frame.f_back
+                labels.append(names.get(ident, str(ident)).replace(";", ":"))
+                self.stacks[";".join(reversed(labels))] += 1
+            self.num_samples += 1
+
+    def collapsed(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+
+class ProfileSession:
+    def __init__(self, hooks: Sequence[Hook], interval: float, use_torch: bool):
+        self.spans = StepSpans()
+        self.sampler = StackSampler(interval)
+        self.hooks = hooks
+        self.use_torch = use_torch
+        self._restore: List[Callable[[], None]] = []
+        self._torch = None
+        self._started = 0.0
+        self.seconds = 0.0
+
+    def start(self):
+        self._started = time.monotonic()
+        if self.use_torch:
+            try:
+                import torch
+            except ImportError:
+                torch = None
+            if torch is not None:
+                activities = [torch.profiler.ProfilerActivity.CPU]
+                if torch.cuda.is_available():
+                    activities.append(torch.profiler.ProfilerActivity.CUDA)
+                self._torch = torch.profiler.profile(activities=activities)
+                self._torch.__enter__()
+        for hook in self.hooks:
+            self._restore.append(hook(self.spans))
+        self.sampler.start()
+
+    def stop(self):
+        self.sampler.stop()
+        for restore in reversed(self._restore):
+            restore()
+        if self._torch is not None:
+            self._torch.__exit__(None, None, None)
+        self.seconds = time.monotonic() - self._started
+
+    def chrome_trace(self) -> Dict[str, Any]:
+        trace: Dict[str, Any] = {"traceEvents": []}
+        if self._torch is not None:
+            import tempfile
+
+            with tempfile.NamedTemporaryFile(suffix=".json") as f:
+                self._torch.export_chrome_trace(f.name)
+                with open(f.name) as exported:
+                    trace = json.load(exported)
+        # torch's timestamps are relative to `baseTimeNanoseconds` when it reports one.
+        base_us = trace.get("baseTimeNanoseconds", 0) / 1000
+        for event in self.spans.events:
+            trace["traceEvents"].append(dict(event, ts=event["ts"] - base_us))
+        return trace
+
+    def result(self) -> Dict[str, Any]:
+        return {
+            "collapsed": self.sampler.collapsed(),
+            "chrome_trace": self.chrome_trace(),
+            "summary": {
+                "seconds": round(self.seconds, 3),
+                "samples": self.sampler.num_samples,
+                "interval_s": self.sampler.interval,
+                "torch_profiler": self._torch is not None,
+                "steps": self.spans.summary(),
+            },
+        }
+
+
+class Profiler:
+    """Runs at most one `ProfileSession` at a time in a container."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+
+    def session(self, hooks: Sequence[Hook] = (), interval: float = 0.01, use_torch: bool = True) -> ProfileSession:
+        if not self._lock.acquire(blocking=False):
+            raise ProfilerBusy("A profile is already running in this container")
+        session = ProfileSession(hooks, interval, use_torch)
+        try:
+            session.start()
+        except BaseException:
+            self._lock.release()
+            raise
+        return session
+
+    def finish(self, session: ProfileSession) -> Dict[str, Any]:
+        try:
+            session.stop()
+        finally:
+            self._lock.release()
+        return session.result()
+
+    async def run(self, seconds: float, hooks: Sequence[Hook] = (), interval: float = 0.01, use_torch: bool = True) -> Dict[str, Any]:
+        """Profiles whatever the container does for `seconds`, e.g. its engine serving live requests."""
+        seconds = min(seconds, MAX_SECONDS)
+        session = self.session(hooks, interval, use_torch)
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            result = self.finish(session)
+        return result
+
+    def run_sync(self, seconds: float, workload: Callable[[], Any], hooks: Sequence[Hook] = (), interval: float = 0.01, use_torch: bool = True) -> Dict[str, Any]:
+        """Profiles `workload`, called repeatedly for `seconds`, for containers that serve one input at a time."""
+        deadline = time.monotonic() + min(seconds, MAX_SECONDS)
+        session = self.session(hooks, interval, use_torch)
+        try:
+            while time.monotonic() < deadline:
+                workload()
+        finally:
+            result = self.finish(session)
+        return result
+
+
+def write_profile(result: Dict[str, Any], output: str = "profile"):
+    """Writes `<output>.folded` (for `flamegraph.pl` or speedscope) and `<output>.trace.json`."""
+    with open(f"{output}.folded", "w") as f:
+        f.write(result["collapsed"])
+    with open(f"{output}.trace.json", "w") as f:
+        json.dump(result["chrome_trace"], f)
+    print(json.dumps(result["summary"], indent=2))
+    print(f"Wrote {output}.folded and {output}.trace.json")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seconds", type=float, default=1.0)
+    parser.add_argument("--output", help="write <output>.folded and <output>.trace.json")
+    args = parser.parse_args()
+
+    class ToyModel:
+        """A decode loop with a slow first step and a cheap one per token, like a real model."""
+
+        def forward(self, input_ids, past_key_values=None):
+            deadline = time.perf_counter() + (0.02 if past_key_values is None else 0.002)
+            while time.perf_counter() < deadline:
+                pass
+            return len(input_ids)
+
+        def generate(self, input_ids, max_new_tokens=32):
+            past = None
+            for _ in range(max_new_tokens):
+                self.forward(input_ids, past_key_values=past)
+                past = True
+
+    model = ToyModel()
+    result = Profiler().run_sync(args.seconds, lambda: model.generate([1, 2, 3]), [lambda spans: annotate_forward(model, spans)])
+    assert "forward" not in vars(model), "hooks were not removed"
+    if args.output:
+        write_profile(result, args.output)
+    else:
+        print(json.dumps(result["summary"], indent=2))
+        print(result["collapsed"][:1000])
@@ -0,0 +1,414 @@
+# # Remote provider backends and overflow routing
+#
+# The web tier only knew one backend: the GPU class behind `completion_pool`. This module adds
+# hosted models (OpenAI, Anthropic, Cohere, a Hugging Face text-generation-inference endpoint)
+# behind the same contract as `completion_stream`: an async generator of text deltas, or of
+# `{"text": ..., "t": ...}` records with `metadata`. The stopping options are applied locally with
+# `StoppingEngine`, as our own models do, so `stop_regex` and JSON constraints work everywhere.
+#
+# `HttpStreamingBackend` is the one adapter they all use. It keeps an `aiohttp` session per web
+# container, with a bounded keep-alive connection pool, and parses SSE or NDJSON response streams;
+# the provider presets only build the payload and pick the text out of each event.
+#
+# `OverflowRouter` decides per request where to send it:
+#
+# - to the primary (Modal) backend normally;
+# - to the first overflow backend that meets the latency SLO when the primary backlog from
+#   `get_current_stats` is above `max_backlog`, or when the primary's recent time to first token
+#   is above `ttft_slo_s` (a measurement older than `latency_window` no longer counts, so the
+#   primary gets traffic again and is re-measured);
+# - to an overflow backend when the primary fails before sending anything.
+#
+# Requests that only our models can serve (LoRA adapters, `n`/`best_of` > 1, resumes on providers
+# that can't continue a prefix) always go to the primary. Overflow backends are configured with
+# environment variables, see `backends_from_env`; with none configured the router is a pass-through.
+#
+# Run `python providers.py` to route requests between a stand-in primary and a local mock
+# OpenAI-style streaming server.
+import json
+import os
+import time
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Mapping, Optional, Sequence
+
+from pool import RETRYABLE
+from stopping import StoppingEngine, stop_event
+
+DEFAULT_MAX_TOKENS = 1024
+
+
+class HttpStreamingBackend:
+    """Streams completions from an HTTP endpoint that answers with SSE or NDJSON events."""
+
+    def __init__(
+        self,
+        name: str,
+        url: str,
+        build_payload: Callable[[str, Dict[str, Any]], Dict[str, Any]],
+        extract: Callable[[Dict[str, Any]], Optional[str]],
+        headers: Optional[Mapping[str, str]] = None,
+        format: str = "sse",
+        supports_prefix: bool = False,
+        max_connections: int = 20,
+        connect_timeout: float = 10.0,
+        read_timeout: float = 60.0,
+    ):
+        self.name = name
+        self.url = url
+        self.build_payload = build_payload
+        self.extract = extract
+        self.headers = dict(headers or {})
+        self.format = format
+        self.supports_prefix = supports_prefix
+        self.max_connections = max_connections
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self._session = None
+
+    @property
+    def session(self):
+        # Created on first use, inside the event loop serving requests, and reused after that.
+        if self._session is None or self._session.closed:
+            import aiohttp
+
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_connections, keepalive_timeout=30),
+                timeout=aiohttp.ClientTimeout(total=None, sock_connect=self.connect_timeout, sock_read=self.read_timeout),
+            )
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+
+    async def _events(self, response) -> AsyncIterator[Dict[str, Any]]:
+        async for raw in response.content:
+            line = raw.decode("utf-8").strip()
+            if self.format == "sse":
+                if not line.startswith("data:"):
+                    continue
+                line = line[len("data:") :].strip()
+                if line == "[DONE]":
+                    return
+            if line:
+                yield json.loads(line)
+
+    async def completion_stream(
+        self, prompt: str, stopping=None, metadata: bool = False, max_tokens: Optional[int] = None, prefix: str = "", **ignored
+    ) -> AsyncIterator[Any]:
+        import aiohttp
+
+        stopping = stopping or {}
+        stopper = StoppingEngine.from_payload(stopping)
+        options = {"max_tokens": max_tokens or DEFAULT_MAX_TOKENS, "stop": stopping.get("stop"), "prefix": prefix}
+        t0 = time.time()
+        try:
+            async with self.session.post(self.url, json=self.build_payload(prompt, options), headers=self.headers) as response:
+                if response.status == 429 or response.status >= 500:
+                    raise ConnectionError(f"{self.name} returned {response.status}: {(await response.text())[:200]}")
+                if response.status >= 400:
+                    raise ValueError(f"{self.name} returned {response.status}: {(await response.text())[:200]}")
+                async for event in self._events(response):
+                    text = self.extract(event)
+                    if not text:
+                        continue
+                    text, stopped = stopper.feed(text)
+                    if text:
+                        yield {"text": text, "t": round(time.time() - t0, 4), "backend": self.name} if metadata else text
+                    if stopped:
+                        break
+        except aiohttp.ClientError as e:
+            raise ConnectionError(f"{self.name}: {e}") from e
+        tail = stopper.flush()
+        if tail:
+            yield {"text": tail, "t": round(time.time() - t0, 4), "backend": self.name} if metadata else tail
+        event = stop_event(stopper.reason)
+        if event is not None:
+            yield event
+
+
+def _stop_list(stop) -> Optional[List[str]]:
+    if not stop:
+        return None
+    return [stop] if isinstance(stop, str) else list(stop)
+
+
+def openai_backend(api_key: str, model: str = "gpt-3.5-turbo", base_url: str = "https://api.openai.com/v1", **kwargs) -> HttpStreamingBackend:
+    """OpenAI, or any server with an OpenAI-compatible `/chat/completions` (vLLM, TGI, ...)."""
+
+    def build(prompt: str, options: Dict[str, Any]) -> Dict[str, Any]:
+        payload = {
+            "model": model,
+            "messages": [{"role": "user", "content": prompt}],
+            "max_tokens": options["max_tokens"],
+            "stream": True,
+        }
+        if options["stop"]:
+            payload["stop"] = _stop_list(options["stop"])[:4]
+        return payload
+
+    def extract(event: Dict[str, Any]) -> Optional[str]:
+        choices = event.get("choices") or [{}]
+        return (choices[0].get("delta") or {}).get("content")
+
+    return HttpStreamingBackend(
+        "openai", f"{base_url}/chat/completions", build, extract, headers={"Authorization": f"Bearer {api_key}"}, **kwargs
+    )
+
+
+def anthropic_backend(api_key: str, model: str = "claude-3-haiku-20240307", **kwargs) -> HttpStreamingBackend:
+    """Anthropic's Messages API. A resumed request continues from a prefilled assistant turn."""
+
+    def build(prompt: str, options: Dict[str, Any]) -> Dict[str, Any]:
+        messages = [{"role": "user", "content": prompt}]
+        if options["prefix"]:
+            messages.append({"role": "assistant", "content": options["prefix"].rstrip()})
+        payload = {"model": model, "messages": messages, "max_tokens": options["max_tokens"], "stream": True}
+        if options["stop"]:
+            payload["stop_sequences"] = _stop_list(options["stop"])
+        return payload
+
+    def extract(event: Dict[str, Any]) -> Optional[str]:
+        if event.get("type") == "content_block_delta":
+            return event["delta"].get("text")
+        return None
+
+    headers = {"x-api-key": api_key, "anthropic-version": "2023-06-01"}
+    return HttpStreamingBackend(
+        "anthropic", "https://api.anthropic.com/v1/messages", build, extract, headers=headers, supports_prefix=True, **kwargs
+    )
+
+
+def cohere_backend(api_key: str, model: str = "command", **kwargs) -> HttpStreamingBackend:
+    """Cohere's chat endpoint, which streams NDJSON events."""
+
+    def build(prompt: str, options: Dict[str, Any]) -> Dict[str, Any]:
+        payload = {"model": model, "message": prompt, "max_tokens": options["max_tokens"], "stream": True}
+        if options["stop"]:
+            payload["stop_sequences"] = _stop_list(options["stop"])
+        return payload
+
+    def extract(event: Dict[str, Any]) -> Optional[str]:
+        return event.get("text") if event.get("event_type") == "text-generation" else None
+
+    return HttpStreamingBackend(
+        "cohere", "https://api.cohere.ai/v1/chat", build, extract, headers={"Authorization": f"Bearer {api_key}"}, format="ndjson", **kwargs
+    )
+
+
+def huggingface_backend(url: str, token: Optional[str] = None, **kwargs) -> HttpStreamingBackend:
+    """A text-generation-inference server or Inference Endpoint (`.../generate_stream`).
+
+    These continue raw text, so a resumed request just appends the prefix to the prompt.
+    """
+
+    def build(prompt: str, options: Dict[str, Any]) -> Dict[str, Any]:
+        parameters = {"max_new_tokens": options["max_tokens"]}
+        if options["stop"]:
+            parameters["stop"] = _stop_list(options["stop"])
+        return {"inputs": prompt + options["prefix"], "parameters": parameters}
+
+    def extract(event: Dict[str, Any]) -> Optional[str]:
+        token = event.get("token") or {}
+        return None if token.get("special") else token.get("text")
+
+    headers = {"Authorization": f"Bearer {token}"} if token else {}
+    return HttpStreamingBackend(
+        "huggingface", url.rstrip("/") + "/generate_stream", build, extract, headers=headers, supports_prefix=True, **kwargs
+    )
+
+
+def backends_from_env(env: Mapping[str, str] = os.environ) -> List[HttpStreamingBackend]:
+    """Overflow backends listed in `OVERFLOW_BACKENDS` (e.g. "openai,anthropic"), in that order.
+
+    Each one needs its key (`OPENAI_API_KEY`, `ANTHROPIC_API_KEY`, `COHERE_API_KEY`, or
+    `HF_INFERENCE_URL` with an optional `HF_TOKEN`); the model can be set with `<NAME>_MODEL`.
+    """
+    backends = []
+    for name in filter(None, (n.strip() for n in env.get("OVERFLOW_BACKENDS", "").split(","))):
+        model = {"model": env[f"{name.upper()}_MODEL"]} if f"{name.upper()}_MODEL" in env else {}
+        if name == "openai":
+            backends.append(openai_backend(env["OPENAI_API_KEY"], base_url=env.get("OPENAI_BASE_URL", "https://api.openai.com/v1"), **model))
+        elif name == "anthropic":
+            backends.append(anthropic_backend(env["ANTHROPIC_API_KEY"], **model))
+        elif name == "cohere":
+            backends.append(cohere_backend(env["COHERE_API_KEY"], **model))
+        elif name == "huggingface":
+            backends.append(huggingface_backend(env["HF_INFERENCE_URL"], env.get("HF_TOKEN")))
+        else:
+            raise ValueError(f"Unknown overflow backend {name!r}")
+    return backends
+
+
+@dataclass
+class OverflowPolicy:
+    max_backlog: int = 20
+    ttft_slo_s: float = 10.0
+    latency_window: float = 60.0
+    stats_ttl: float = 5.0
+    alpha: float = 0.2
+
+
+class OverflowRouter:
+    def __init__(
+        self,
+        primary: Callable[..., AsyncIterator[Any]],
+        overflow: Sequence[HttpStreamingBackend] = (),
+        backlog: Optional[Callable[[], Awaitable[int]]] = None,
+        policy: Optional[OverflowPolicy] = None,
+    ):
+        self.primary = primary
+        self.overflow = list(overflow)
+        self.backlog = backlog
+        self.policy = policy or OverflowPolicy()
+        self.ttft: Dict[str, tuple] = {}  # backend name -> (EWMA seconds, measured at)
+        self.routed: Dict[str, int] = {}
+        self.reasons: Dict[str, int] = {}
+        self._backlog: Optional[int] = None
+        self._backlog_at = 0.0
+
+    def record_ttft(self, name: str, seconds: float):
+        previous = self.recent_ttft(name)
+        if previous is not None:
+            seconds = (1 - self.policy.alpha) * previous + self.policy.alpha * seconds
+        self.ttft[name] = (seconds, time.monotonic())
+
+    def recent_ttft(self, name: str) -> Optional[float]:
+        ewma, at = self.ttft.get(name, (None, 0.0))
+        return ewma if time.monotonic() - at <= self.policy.latency_window else None
+
+    async def current_backlog(self) -> int:
+        if self.backlog is None:
+            return 0
+        now = time.monotonic()
+        if self._backlog is None or now - self._backlog_at >= self.policy.stats_ttl:
+            try:
+                self._backlog = await self.backlog()
+            except Exception as e:  # No stats means no reason to spill.
+                print(f"Could not read the primary backlog: {e}")
+                self._backlog = 0
+            self._backlog_at = now
+        return self._backlog
+
+    def _candidates(self, prefix: str) -> List[HttpStreamingBackend]:
+        slo = self.policy.ttft_slo_s
+        return [
+            b
+            for b in self.overflow
+            if (not prefix or b.supports_prefix) and (self.recent_ttft(b.name) or 0.0) <= slo
+        ]
+
+    async def choose(self, prefix: str = "", eligible: bool = True) -> Optional[HttpStreamingBackend]:
+        """The overflow backend to use, or None for the primary."""
+        if not eligible or not self.overflow:
+            return None
+        reason = None
+        backlog = await self.current_backlog()
+        primary_ttft = self.recent_ttft("primary")
+        if backlog > self.policy.max_backlog:
+            reason = "backlog"
+        elif primary_ttft is not None and primary_ttft > self.policy.ttft_slo_s:
+            reason = "latency"
+        candidates = self._candidates(prefix) if reason else []
+        if not candidates:
+            return None
+        self.reasons[reason] = self.reasons.get(reason, 0) + 1
+        return candidates[0]
+
+    async def _measured(self, name: str, deltas: AsyncIterator[Any], sent: List[int]) -> AsyncIterator[Any]:
+        t0 = time.monotonic()
+        self.routed[name] = self.routed.get(name, 0) + 1
+        async for delta in deltas:
+            if not sent[0]:
+                self.record_ttft(name, time.monotonic() - t0)
+            sent[0] += 1
+            yield delta
+
+    async def stream(self, prompt: str, stopping=None, metadata: bool = False, *args, **kwargs) -> AsyncIterator[Any]:
+        """`completion_pool.stream`'s signature; extra arguments only the primary understands."""
+        eligible = not any(args) and kwargs.get("n", 1) == 1 and (kwargs.get("best_of") or 1) == 1
+        prefix = kwargs.get("prefix", "")
+        backend = await self.choose(prefix, eligible)
+        sent = [0]
+        if backend is not None:
+            deltas = backend.completion_stream(prompt, stopping, metadata, max_tokens=kwargs.get("max_tokens"), prefix=prefix)
+            async for delta in self._measured(backend.name, deltas, sent):
+                yield delta
+            return
+
+        try:
+            async for delta in self._measured("primary", self.primary(prompt, stopping, metadata, *args, **kwargs), sent):
+                yield delta
+            return
+        except RETRYABLE as e:
+            candidates = self._candidates(prefix) if eligible and not sent[0] else []
+            if not candidates:
+                raise
+            print(f"Primary failed before streaming ({type(e).__name__}: {e}), spilling to {candidates[0].name}")
+            self.reasons["failure"] = self.reasons.get("failure", 0) + 1
+        deltas = candidates[0].completion_stream(prompt, stopping, metadata, max_tokens=kwargs.get("max_tokens"), prefix=prefix)
+        async for delta in self._measured(candidates[0].name, deltas, sent):
+            yield delta
+
+    def metrics(self) -> Dict[str, Any]:
+        return {
+            "routed": dict(self.routed),
+            "overflow_reasons": dict(self.reasons),
+            "ttft_s": {name: round(ewma, 3) for name, (ewma, _) in self.ttft.items()},
+            "backlog": self._backlog,
+        }
+
+
+async def _demo():
+    """Routes requests between a stand-in primary and a mock OpenAI-style server on localhost."""
+    import asyncio
+
+    from aiohttp import web
+
+    from fake_engine import ANSWER, fake_completion_stream, fake_tokenize
+
+    async def chat_completions(request):
+        payload = await request.json()
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        for piece in fake_tokenize(ANSWER)[: payload["max_tokens"]]:
+            event = {"choices": [{"delta": {"content": piece}}]}
+            await response.write(f"data: {json.dumps(event)}\n\n".encode())
+        await response.write(b"data: [DONE]\n\n")
+        return response
+
+    app = web.Application()
+    app.router.add_post("/v1/chat/completions", chat_completions)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+
+    backlog = [0]
+
+    async def read_backlog():
+        return backlog[0]
+
+    mock = openai_backend("test-key", model="mock", base_url=f"http://127.0.0.1:{port}/v1")
+    router = OverflowRouter(fake_completion_stream, [mock], read_backlog, OverflowPolicy(max_backlog=5, stats_ttl=0))
+    try:
+        async def complete(question: str) -> str:
+            return "".join([delta async for delta in router.stream(question)])
+
+        for level in (0, 50):
+            backlog[0] = level
+            texts = await asyncio.gather(*(complete(f"Question {i}") for i in range(4)))
+            assert all(text == ANSWER for text in texts), texts
+            print(f"backlog {level:>3}: {texts[0][:60]!r}...")
+        print(json.dumps(router.metrics()))
+        assert router.routed == {"primary": 4, "openai": 4}, router.routed
+    finally:
+        await mock.close()
+        await runner.cleanup()
+
+
+if __name__ == "__main__":
+    import asyncio
+
+    asyncio.run(_demo())
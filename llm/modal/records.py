@@ -0,0 +1,311 @@
+# # Binary token records between the GPU containers and the web tier
+#
+# Every delta used to cross Modal's remote generator as a `str` (or a dict with its token ids),
+# and the web tier then re-encoded it through `StreamEncoder.stream`, an async generator per
+# response. For single streams in the `text`, `sse` and `records` formats, the container now packs
+# each delta into one compact record:
+#
+#     kind (uint8) | token count (uint16 LE) | text length (uint32 LE) | t (float32 LE) | token ids (uint32 LE each) | UTF-8 text
+#
+# `kind` is `DELTA` for generated text, `EVENT` for out-of-band events such as cold-start ETAs, and
+# `JSON` for other JSON records (the text is then the JSON document); `t` is seconds since the
+# request started.
+#
+# `RecordStreamingResponse` writes records into the response directly from the ASGI `send`
+# loop, without a wrapper generator: in the `records` format (`Accept: application/x-llm-records`)
+# each record goes out as the bytes object it arrived as, in `text` only its UTF-8 slice is sent,
+# and `sse` frames that slice without decoding it. Clients read record streams with
+# `RecordReader`. The response can't reuse one preallocated buffer across chunks, because Modal's
+# ASGI bridge queues and serializes the message bodies after `send` returns.
+#
+# Like `embeddings.py`, this module imports nothing beyond the standard library at import time
+# (Starlette only if it's installed), so clients can use it to unpack streams.
+#
+# Run `python records.py` to check that what the response writes reads back through `RecordReader`,
+# and to compare the CPU time the web tier spends per token on each path.
+import asyncio
+import json
+import struct
+from typing import Any, AsyncIterator, Dict, Iterator, List, Mapping, Optional, Sequence, Tuple, Union
+
+try:
+    from starlette.responses import Response
+except ImportError:  # Only the web tier sends responses; containers and clients pack and unpack.
+    Response = object
+
+MEDIA_TYPE = "application/x-llm-records"
+HEADER = struct.Struct("<BHIf")
+DELTA, EVENT, JSON = 0, 1, 2
+FORMATS = ("text", "sse", "records")
+
+
+def pack(text: str, token_ids: Sequence[int] = (), t: float = 0.0) -> bytes:
+    data = text.encode("utf-8")
+    return HEADER.pack(DELTA, len(token_ids), len(data), t) + struct.pack(f"<{len(token_ids)}I", *token_ids) + data
+
+
+def _pack_json(kind: int, record: Mapping[str, Any], t: float = 0.0) -> bytes:
+    data = json.dumps(record, separators=(",", ":")).encode("utf-8")
+    return HEADER.pack(kind, 0, len(data), t) + data
+
+
+def to_record(delta: Union[bytes, str, Dict[str, Any]]) -> bytes:
+    """Packs a delta in any of the forms the completion streams yield; records pass through."""
+    if isinstance(delta, bytes):
+        return delta
+    if isinstance(delta, str):
+        return pack(delta)
+    if "event" in delta:
+        return _pack_json(EVENT, delta)
+    if "index" in delta or "text" not in delta:
+        return _pack_json(JSON, delta)
+    return pack(delta["text"], delta.get("token_ids", ()), delta.get("t", 0.0))
+
+
+def unpack(data: bytes, offset: int = 0) -> Tuple[Dict[str, Any], int]:
+    """The record at `offset` and the offset of the next one."""
+    kind, count, length, t = HEADER.unpack_from(data, offset)
+    start = offset + HEADER.size + 4 * count
+    text = bytes(data[start : start + length]).decode("utf-8")
+    if kind != DELTA:
+        return json.loads(text), start + length
+    token_ids = list(struct.unpack_from(f"<{count}I", data, offset + HEADER.size))
+    return {"text": text, "token_ids": token_ids, "t": round(t, 4)}, start + length
+
+
+def text_bytes(record: bytes) -> bytes:
+    """The UTF-8 text of a `DELTA` record, or `b""` for any other kind."""
+    kind, count, _, _ = HEADER.unpack_from(record)
+    return record[HEADER.size + 4 * count :] if kind == DELTA else b""
+
+
+def num_tokens(delta: Union[bytes, str, Dict[str, Any]]) -> int:
+    """Token ids carried by a delta, where the stream format includes them."""
+    if isinstance(delta, dict):
+        return len(delta.get("token_ids", ()))
+    if isinstance(delta, bytes):
+        return HEADER.unpack_from(delta)[1]
+    return 0
+
+
+def record_text(record: bytes) -> str:
+    return text_bytes(record).decode("utf-8")
+
+
+def iter_records(data: bytes) -> Iterator[Dict[str, Any]]:
+    offset = 0
+    while offset < len(data):
+        record, offset = unpack(data, offset)
+        yield record
+
+
+class RecordReader:
+    """Splits a `records` response into records as chunks arrive, whatever their boundaries."""
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, chunk: bytes) -> List[Dict[str, Any]]:
+        self.buffer += chunk
+        records, offset = [], 0
+        while len(self.buffer) - offset >= HEADER.size:
+            _, count, length, _ = HEADER.unpack_from(self.buffer, offset)
+            end = offset + HEADER.size + 4 * count + length
+            if end > len(self.buffer):
+                break
+            records.append(unpack(self.buffer, offset)[0])
+            offset = end
+        del self.buffer[:offset]
+        return records
+
+
+def frame(delta: Union[bytes, str, Dict[str, Any]], format: str) -> bytes:
+    """The bytes to send for `delta` in a `text`, `sse` or `records` stream.
+
+    Matches `StreamEncoder` for those formats, but works on the record's bytes without decoding them.
+    """
+    record = to_record(delta)
+    if format == "records":
+        return record
+    kind, count, _, _ = HEADER.unpack_from(record)
+    body = record[HEADER.size + 4 * count :]
+    if kind == EVENT:
+        if format == "text":
+            return b""
+        event = json.loads(body)
+        name = event.pop("event")
+        return f"event: {name}\ndata: {json.dumps(event, separators=(',', ':'))}\n\n".encode("utf-8")
+    if format == "sse":
+        return b"".join(b"data: " + line + b"\n" for line in body.split(b"\n")) + b"\n"
+    return body
+
+
+async def _disconnected(receive):
+    while (await receive())["type"] != "http.disconnect":
+        pass
+
+
+class RecordStreamingResponse(Response):
+    """Streams `deltas` (usually records) in `format`, sending each one from the ASGI loop itself."""
+
+    def __init__(self, deltas: AsyncIterator[Any], format: str = "records", media_type: str = MEDIA_TYPE, headers: Optional[Mapping[str, str]] = None):
+        if format not in FORMATS:
+            raise ValueError(f"Records can't be written as {format!r}")
+        self.deltas = deltas
+        self.format = format
+        self.status_code = 200
+        self.media_type = media_type
+        self.background = None
+        headers = {**(headers or {}), "content-type": media_type}
+        self.raw_headers = [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in headers.items()]
+
+    async def _write(self, send):
+        format = self.format
+        async for delta in self.deltas:
+            body = frame(delta, format)
+            if body:
+                await send({"type": "http.response.body", "body": body, "more_body": True})
+        await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+    async def __call__(self, scope, receive, send):
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        # A client that goes away cancels the stream, which cancels the generation upstream.
+        writer = asyncio.ensure_future(self._write(send))
+        disconnect = asyncio.ensure_future(_disconnected(receive))
+        try:
+            await asyncio.wait({writer, disconnect}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in (writer, disconnect):
+                if not task.done():
+                    task.cancel()
+            await asyncio.wait({writer})
+        if not writer.cancelled():
+            writer.result()
+        if self.background is not None:
+            await self.background()
+
+
+async def proxy_cpu_per_token(format: str, lean: bool, num_tokens: int = 20000) -> float:
+    """CPU seconds the web tier spends per token, from the backend stream to the ASGI `send`.
+
+    The deltas go through the same resume and ETA wrappers as in the endpoints; the legacy path
+    then goes through `StreamEncoder.stream` and Starlette's `StreamingResponse`.
+    """
+    import random
+    import time
+
+    from lifecycle import resumable
+    from transport import StreamEncoder
+    from warmup import with_eta
+
+    random.seed(0)
+    words = "the fox saw some grapes hanging from a high vine and tried to reach them but could not".split()
+    texts = [" " + random.choice(words) for _ in range(num_tokens)]
+    if lean:
+        deltas = [pack(text, [random.randrange(32000)], 0.01 * i) for i, text in enumerate(texts)]
+    elif format == "ndjson":
+        deltas = [{"text": text, "token_ids": [random.randrange(32000)], "t": 0.01 * i} for i, text in enumerate(texts)]
+    else:
+        deltas = texts
+
+    async def backend(prefix, sent):
+        for delta in deltas:
+            yield delta
+
+    async def ready():
+        return {"ready": True}
+
+    sent = [0]
+
+    async def send(message):
+        sent[0] += len(message.get("body", b""))
+
+    async def receive():
+        await asyncio.get_running_loop().create_future()
+
+    stream = with_eta(resumable(backend), ready())
+    t0 = time.process_time()
+    if lean:
+        await RecordStreamingResponse(stream, format)({"type": "http"}, receive, send)
+    else:
+        from starlette.responses import StreamingResponse
+
+        encoder = StreamEncoder(format)
+        await StreamingResponse(encoder.stream(stream), media_type=encoder.media_type)({"type": "http"}, receive, send)
+    return (time.process_time() - t0) / num_tokens
+
+
+async def check():
+    """Deltas written by `RecordStreamingResponse` read back the same, whatever the chunk boundaries."""
+    import random
+
+    from transport import StreamEncoder
+
+    deltas = [
+        pack("Once", [101], 0.01),
+        "upon a tíme 🦊",
+        {"text": "\nthere", "token_ids": [7, 8], "t": 0.25},
+        {"event": "status", "state": "cold", "eta_s": 12.0},
+        {"index": 1, "text": "candidate"},
+        {"ranking": [1, 0], "cumulative_logprobs": [-0.5, -1.5]},
+        pack(""),
+    ]
+    expected = [
+        {"text": "Once", "token_ids": [101], "t": 0.01},
+        {"text": "upon a tíme 🦊", "token_ids": [], "t": 0.0},
+        {"text": "\nthere", "token_ids": [7, 8], "t": 0.25},
+        {"event": "status", "state": "cold", "eta_s": 12.0},
+        {"index": 1, "text": "candidate"},
+        {"ranking": [1, 0], "cumulative_logprobs": [-0.5, -1.5]},
+        {"text": "", "token_ids": [], "t": 0.0},
+    ]
+    assert [num_tokens(to_record(delta)) for delta in deltas[:3]] == [1, 0, 2]
+    assert record_text(to_record(deltas[1])) == deltas[1] and record_text(to_record(deltas[3])) == ""
+
+    async def write(format: str) -> bytes:
+        async def stream():
+            for delta in deltas:
+                yield delta
+
+        async def receive():
+            await asyncio.get_running_loop().create_future()
+
+        body = bytearray()
+
+        async def send(message):
+            body.extend(message.get("body", b""))
+
+        await RecordStreamingResponse(stream(), format)({"type": "http"}, receive, send)
+        return bytes(body)
+
+    data = await write("records")
+    assert list(iter_records(data)) == expected
+    assert data == StreamEncoder("records").encode(*deltas)
+    random.seed(0)
+    for _ in range(20):
+        reader, received, offset = RecordReader(), [], 0
+        while offset < len(data):
+            size = random.randint(1, 16)
+            received += reader.feed(data[offset : offset + size])
+            offset += size
+        assert received == expected and not reader.buffer, received
+
+    # The other formats frame the same bytes as `StreamEncoder`, without decoding the records.
+    for format in ("text", "sse"):
+        legacy = StreamEncoder(format)
+        unpacked = [unpack(delta)[0] if isinstance(delta, bytes) else delta for delta in deltas]
+        assert await write(format) == legacy.encode(*unpacked), format
+    try:
+        RecordStreamingResponse(None, "ndjson")
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("accepted a format records can't be written as")
+
+
+if __name__ == "__main__":
+    asyncio.run(check())
+    print("record checks passed")
+    for format, lean in [("text", False), ("text", True), ("sse", False), ("sse", True), ("ndjson", False), ("records", True)]:
+        cpu = asyncio.run(proxy_cpu_per_token(format, lean))
+        print(f"{format:>8} {'records' if lean else 'legacy':>8}: {cpu * 1e6:6.2f} us CPU per token")
@@ -0,0 +1,319 @@
+# # Parallel sampling: `n` and `best_of`
+#
+# Asking for several alternative completions used to mean sending N requests, each prefilling the
+# same prompt again. With `"n"` (candidates returned) and `"best_of"` (candidates sampled, `>= n`)
+# in the payload, one request samples all candidates from a single prefill of the prompt:
+#
+# - vLLM forks the sequence group after the prompt, so the KV cache of the prompt is shared.
+#   `CandidateMux` turns its per-step outputs into records tagged with the candidate `index`,
+#   runs stopping per candidate, and ends with a ranking record.
+# - The transformers path (`sample_candidates`) runs the prompt once with `use_cache=True`, tiles
+#   its KV cache `best_of` times and decodes all candidates as one batch.
+#
+# Candidates are ranked by cumulative logprob. With `best_of == n` every candidate streams as it
+# is generated, and the last record is `{"ranking": [index, ...], "cumulative_logprobs": [...]}`,
+# best first, with each candidate's stop reason (`"stop"`, `"json_invalid"`, ...) in `"stop_reasons"`.
+# With `best_of > n` the losers should never reach the client, so nothing streams
+# until all candidates are done; then the best `n` are sent whole, re-indexed by rank.
+#
+# Records are dicts, so multiplexed streams are sent as NDJSON (or as JSON in SSE `data:` lines).
+#
+# Run `python sampling.py` to check the request parsing and `CandidateMux` against fake vLLM
+# outputs, and, with torch and transformers installed, `sample_candidates` against greedy
+# `generate` on a tiny random GPT-2.
+import math
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from budget import positive_int
+from stopping import StoppingEngine
+
+MAX_CANDIDATES = 8
+
+
+def parse_candidates(payload: Dict[str, Any]) -> Tuple[int, int]:
+    """`(n, best_of)` from a request payload, validated."""
+    n = positive_int(payload, "n") or 1
+    best_of = positive_int(payload, "best_of") or n
+    if best_of < n:
+        raise ValueError(f"Need 1 <= n <= best_of, got n={n}, best_of={best_of}")
+    if best_of > MAX_CANDIDATES:
+        raise ValueError(f"best_of={best_of} is above the limit of {MAX_CANDIDATES}")
+    return n, best_of
+
+
+def parse_temperature(payload: Dict[str, Any], best_of: int = 1) -> Optional[float]:
+    """The requested sampling temperature, validated, or None for the model's default. 0 is greedy."""
+    temperature = payload.get("temperature")
+    if temperature is None:
+        return None
+    if isinstance(temperature, bool) or not isinstance(temperature, (int, float)) or not math.isfinite(temperature):
+        raise ValueError(f"temperature must be a finite number, got {temperature!r}")
+    if temperature < 0:
+        raise ValueError(f"temperature must be >= 0, got {temperature}")
+    temperature = float(temperature)
+    if temperature == 0 and best_of > 1:
+        raise ValueError("Greedy decoding (temperature 0) has a single candidate, best_of must be 1")
+    return temperature
+
+
+def rank(cumulative_logprobs: Sequence[float]) -> List[int]:
+    """Candidate indexes ordered best first."""
+    return sorted(range(len(cumulative_logprobs)), key=lambda i: cumulative_logprobs[i], reverse=True)
+
+
+class CandidateMux:
+    """Demultiplexes vLLM `RequestOutput.outputs` for `best_of` candidates into indexed records."""
+
+    def __init__(self, n: int, best_of: int, stopping: Optional[Dict[str, Any]] = None):
+        self.n = n
+        self.best_of = best_of
+        self.streaming = best_of == n
+        self.stoppers = [StoppingEngine.from_payload(stopping or {}) for _ in range(best_of)]
+        self.texts = [""] * best_of
+        self.token_ids: List[List[int]] = [[] for _ in range(best_of)]
+        self.cumulative_logprobs = [0.0] * best_of
+        self.done = [False] * best_of
+        self._seen_text = [0] * best_of
+        self._seen_tokens = [0] * best_of
+
+    @property
+    def all_done(self) -> bool:
+        return all(self.done)
+
+    @property
+    def num_tokens(self) -> int:
+        return sum(len(ids) for ids in self.token_ids)
+
+    def feed(self, outputs: Iterable[Any]) -> List[Dict[str, Any]]:
+        """Records to send for one engine step."""
+        records = []
+        for output in outputs:
+            i = output.index
+            if self.done[i] or (output.text and output.text[-1] == "\ufffd"):
+                continue
+            delta = output.text[self._seen_text[i] :]
+            new_ids = list(output.token_ids[self._seen_tokens[i] :])
+            self._seen_text[i] = len(output.text)
+            self._seen_tokens[i] = len(output.token_ids)
+            self.cumulative_logprobs[i] = output.cumulative_logprob
+            self.token_ids[i].extend(new_ids)
+
+            text, stopped = self.stoppers[i].feed(delta)
+            if stopped or output.finish_reason:
+                text += self.stoppers[i].flush()
+                self.done[i] = True
+            self.texts[i] += text
+            if self.streaming and (text or new_ids):
+                records.append({"index": i, "text": text, "token_ids": new_ids})
+        return records
+
+    def finish(self) -> List[Dict[str, Any]]:
+        """Flushes what candidates held back, then the ranking (or the best `n` when buffering)."""
+        records = []
+        for i, stopper in enumerate(self.stoppers):
+            if not self.done[i]:
+                tail = stopper.flush()
+                self.texts[i] += tail
+                self.done[i] = True
+                if self.streaming and tail:
+                    records.append({"index": i, "text": tail, "token_ids": []})
+
+        order = rank(self.cumulative_logprobs)
+        if self.streaming:
+            records.append(
+                {
+                    "ranking": order,
+                    "cumulative_logprobs": [self.cumulative_logprobs[i] for i in order],
+                    "stop_reasons": [self.stoppers[i].reason for i in order],
+                }
+            )
+            return records
+        for position, i in enumerate(order[: self.n]):
+            records.append(
+                {
+                    "index": position,
+                    "text": self.texts[i],
+                    "token_ids": self.token_ids[i],
+                    "cumulative_logprob": self.cumulative_logprobs[i],
+                    "stop_reason": self.stoppers[i].reason,
+                }
+            )
+        return records
+
+    async def run(self, result_generator) -> Any:
+        """Yields the records for a vLLM result stream, stopping once every candidate is done."""
+        async for output in result_generator:
+            for record in self.feed(output.outputs):
+                yield record
+            if self.all_done:
+                break
+        for record in self.finish():
+            yield record
+
+
+def expand_cache(past, n: int):
+    """Tiles a batch-of-one KV cache `n` times along the batch dimension.
+
+    Tiling (rather than `repeat_interleave`) is also right for caches that fold the heads into the
+    batch dimension, as Falcon's does, since there is only one prompt.
+    """
+    import torch
+
+    if isinstance(past, torch.Tensor):
+        return past.repeat(n, *([1] * (past.dim() - 1)))
+    return type(past)(expand_cache(p, n) for p in past)
+
+
+def _filter_logits(logits, top_k: int = 0, top_p: float = 1.0):
+    import torch
+
+    if top_k > 0:
+        kth = torch.topk(logits, min(top_k, logits.shape[-1])).values[:, -1:]
+        logits = logits.masked_fill(logits < kth, float("-inf"))
+    if top_p < 1.0:
+        sorted_logits, order = torch.sort(logits, descending=True)
+        probs = torch.softmax(sorted_logits, dim=-1)
+        # Drop tokens once the mass before them already reaches `top_p`; the top token always stays.
+        remove = probs.cumsum(dim=-1) - probs >= top_p
+        sorted_logits = sorted_logits.masked_fill(remove, float("-inf"))
+        logits = torch.full_like(logits, float("-inf")).scatter(-1, order, sorted_logits)
+    return logits
+
+
+def sample_candidates(
+    model,
+    input_ids,
+    best_of: int,
+    max_new_tokens: int,
+    eos_token_id: Optional[int] = None,
+    temperature: float = 1.0,
+    top_k: int = 0,
+    top_p: float = 1.0,
+    should_stop=None,
+):
+    """Samples `best_of` continuations of one prompt with a single prefill.
+
+    Returns `(sequences, cumulative_logprobs)`; `sequences` include the prompt and are padded with
+    `eos_token_id` after a candidate ends. `should_stop(i, sequence)` ends candidate `i` early.
+    """
+    import torch
+
+    with torch.no_grad():
+        prefill = model(input_ids=input_ids, use_cache=True)
+        past = expand_cache(prefill.past_key_values, best_of)
+        logits = prefill.logits[:, -1, :].expand(best_of, -1)
+
+        device = input_ids.device
+        sequences = input_ids.repeat(best_of, 1)
+        attention_mask = torch.ones_like(sequences)
+        cumulative = torch.zeros(best_of, device=device)
+        finished = torch.zeros(best_of, dtype=torch.bool, device=device)
+        pad = eos_token_id if eos_token_id is not None else 0
+
+        for _ in range(max_new_tokens):
+            logprobs = torch.log_softmax(logits.float() / max(temperature, 1e-5), dim=-1)
+            probs = torch.softmax(_filter_logits(logprobs, top_k, top_p), dim=-1)
+            next_tokens = torch.multinomial(probs, num_samples=1).squeeze(-1)
+            token_logprobs = logprobs.gather(-1, next_tokens[:, None]).squeeze(-1)
+
+            next_tokens = torch.where(finished, torch.full_like(next_tokens, pad), next_tokens)
+            cumulative += torch.where(finished, torch.zeros_like(token_logprobs), token_logprobs)
+            sequences = torch.cat([sequences, next_tokens[:, None]], dim=-1)
+            attention_mask = torch.cat([attention_mask, torch.ones_like(next_tokens[:, None])], dim=-1)
+
+            if eos_token_id is not None:
+                finished |= next_tokens == eos_token_id
+            if should_stop is not None:
+                for i in range(best_of):
+                    if not finished[i] and should_stop(i, sequences[i]):
+                        finished[i] = True
+            if finished.all():
+                break
+
+            out = model(
+                input_ids=next_tokens[:, None],
+                past_key_values=past,
+                attention_mask=attention_mask,
+                use_cache=True,
+            )
+            past = out.past_key_values
+            logits = out.logits[:, -1, :]
+
+    return sequences, cumulative.tolist()
+
+
+def check():
+    from types import SimpleNamespace
+
+    assert parse_candidates({}) == (1, 1)
+    assert parse_candidates({"n": 2}) == (2, 2) and parse_candidates({"n": 2, "best_of": 4}) == (2, 4)
+    for bad in ({"n": 0}, {"n": -1}, {"n": 1.5}, {"n": "2"}, {"n": True}, {"n": 3, "best_of": 2}, {"best_of": 9}):
+        try:
+            parse_candidates(bad)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError(f"accepted {bad}")
+    assert parse_temperature({}) is None and parse_temperature({"temperature": 0}) == 0.0
+    assert parse_temperature({"temperature": 0.7}, best_of=4) == 0.7
+    for bad, best_of in ((float("nan"), 1), (float("inf"), 1), (-0.5, 1), ("hot", 1), (True, 1), (0, 2)):
+        try:
+            parse_temperature({"temperature": bad}, best_of)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError(f"accepted temperature={bad!r} with best_of={best_of}")
+
+    def step(*outputs):
+        """Fake vLLM `CompletionOutput`s from `(index, text, token_ids, cumulative_logprob, finish_reason)`."""
+        return [
+            SimpleNamespace(index=i, text=text, token_ids=ids, cumulative_logprob=logprob, finish_reason=reason)
+            for i, text, ids, logprob, reason in outputs
+        ]
+
+    # Streaming: every candidate's deltas, stopping per candidate, then the ranking.
+    mux = CandidateMux(2, 2, {"stop": ["."]})
+    records = mux.feed(step((0, "Hi", [1], -0.5, None), (1, "Yo", [2], -0.1, None)))
+    assert records == [{"index": 0, "text": "Hi", "token_ids": [1]}, {"index": 1, "text": "Yo", "token_ids": [2]}]
+    records = mux.feed(step((0, "Hi. Bye", [1, 3, 4], -1.0, None), (1, "Yo\ufffd", [2, 5], -0.2, None)))
+    assert records == [{"index": 0, "text": "", "token_ids": [3, 4]}] and mux.done == [True, False], records
+    records = mux.feed(step((1, "Yo!", [2, 5], -0.3, "stop")))
+    assert mux.all_done and mux.texts == ["Hi", "Yo!"] and mux.num_tokens == 5, mux.texts
+    ranking = mux.finish()[-1]
+    assert ranking == {"ranking": [1, 0], "cumulative_logprobs": [-0.3, -1.0], "stop_reasons": [None, "stop"]}, ranking
+
+    # Buffering: nothing streams, and only the best `n` come back, re-indexed by rank.
+    mux = CandidateMux(1, 3)
+    assert mux.feed(step((0, "a", [1], -2.0, "length"), (1, "b", [2], -0.5, "length"), (2, "c", [3], -1.0, None))) == []
+    assert mux.finish() == [{"index": 0, "text": "b", "token_ids": [2], "cumulative_logprob": -0.5, "stop_reason": None}]
+
+    try:
+        import torch
+        from transformers import GPT2Config, GPT2LMHeadModel
+    except ImportError:
+        print("torch or transformers not installed, skipping sample_candidates")
+        return
+
+    torch.manual_seed(0)
+    model = GPT2LMHeadModel(GPT2Config(vocab_size=64, n_positions=64, n_embd=32, n_layer=2, n_head=2, bos_token_id=0, eos_token_id=None)).eval()
+    input_ids = torch.tensor([[5, 9, 3, 17]])
+    # Near-zero temperature is greedy: every candidate matches `generate`, so the tiled cache is right.
+    sequences, cumulative = sample_candidates(model, input_ids, 3, 8, temperature=0)
+    expected = model.generate(input_ids, do_sample=False, max_new_tokens=8, pad_token_id=0)
+    assert sequences.shape == (3, 12) and all(torch.equal(row, expected[0]) for row in sequences), sequences
+    assert len(cumulative) == 3 and len(set(cumulative)) == 1
+
+    # Candidates end on EOS; a candidate that stops early is padded and stops adding logprob.
+    eos = int(expected[0, 4])
+    sequences, _ = sample_candidates(model, input_ids, 2, 8, eos_token_id=eos, temperature=0)
+    assert sequences.shape == (2, 5) and (sequences[:, -1] == eos).all(), sequences
+    sequences, cumulative = sample_candidates(model, input_ids, 2, 8, should_stop=lambda i, sequence: i == 1)
+    assert sequences.shape == (2, 12) and (sequences[1, 5:] == 0).all() and cumulative[1] > cumulative[0]
+
+    sequences, cumulative = sample_candidates(model, input_ids, 4, 6, temperature=1.0, top_k=8, top_p=0.9)
+    assert sequences.shape == (4, 10) and torch.equal(sequences[:, :4], input_ids.repeat(4, 1))
+
+
+if __name__ == "__main__":
+    check()
+    print("sampling checks passed")
@@ -0,0 +1,401 @@
+# # Semantic response cache
+#
+# Playground prompts are often paraphrases of each other ("What is the fable involving a fox and
+# grapes?", "What is the story about the fox and grapes?"), which an exact-match cache misses.
+# `SemanticCache` embeds the prompt, looks for a cached prompt whose embedding has a cosine
+# similarity of at least `threshold`, and returns that answer without dispatching to a GPU.
+#
+# - Each namespace (model, adapter, generation length and temperature) has its own `VectorIndex`:
+#   a preallocated NumPy matrix of unit vectors searched with one matrix-vector product. Entries
+#   expire after `ttl` seconds, and a full index evicts its least recently used entry.
+# - Identical prompts hit through a dict before anything is embedded.
+# - Only streams that complete are stored, so a cancelled or failed generation is never replayed.
+# - Hit/miss/store/eviction counts are kept per namespace. `publish` writes them to a Modal `Dict`
+#   under this container's key, so the `stats` endpoint can sum them across web containers.
+#
+# The cache is opt-in per request (`"cache": "semantic"`). It lives in the memory of each web
+# container, and lookups fail open: if embedding fails, the request is served normally.
+#
+# Run `python semcache.py` to check hits, misses, eviction and expiry with `hashing_embed`.
+import hashlib
+import os
+import time
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Sequence
+
+from lifecycle import delta_text
+
+EMBEDDER_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+EMBEDDER_DIR = "/embedder"
+DEFAULT_THRESHOLD = 0.9
+MAX_PUBLISHERS = 100
+
+
+async def _store_get_aio(store, key: str, default=None):
+    try:
+        return await store.get.aio(key)
+    except KeyError:
+        return default
+
+
+def _digest(text: str) -> str:
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+class VectorIndex:
+    """Fixed-capacity cosine-similarity index over unit vectors, with LRU eviction and expiry."""
+
+    def __init__(self, dim: int, capacity: int = 1024, ttl: Optional[float] = None):
+        import numpy as np
+
+        self.vectors = np.zeros((capacity, dim), dtype=np.float32)
+        self.occupied = np.zeros(capacity, dtype=bool)
+        self.created = np.zeros(capacity)
+        self.last_used = np.zeros(capacity)
+        self.values: List[Any] = [None] * capacity
+        self.keys: List[Optional[str]] = [None] * capacity
+        self.ttl = ttl
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return int(self.occupied.sum())
+
+    def _free(self, slot: int):
+        self.occupied[slot] = False
+        self.values[slot] = None
+        self.keys[slot] = None
+
+    def expire(self, now: float) -> int:
+        if self.ttl is None:
+            return 0
+        expired = (self.occupied & (self.created < now - self.ttl)).nonzero()[0]
+        for slot in expired:
+            self._free(slot)
+        self.evictions += len(expired)
+        return len(expired)
+
+    def search(self, vector, now: Optional[float] = None):
+        """`(slot, similarity)` of the closest live entry, or `(None, -1.0)` when empty."""
+        import numpy as np
+
+        now = time.time() if now is None else now
+        self.expire(now)
+        if not self.occupied.any():
+            return None, -1.0
+        scores = self.vectors @ vector
+        scores[~self.occupied] = -np.inf
+        slot = int(scores.argmax())
+        return slot, float(scores[slot])
+
+    def get(self, slot: int, now: Optional[float] = None) -> Any:
+        self.last_used[slot] = time.time() if now is None else now
+        return self.values[slot]
+
+    def add(self, vector, value: Any, key: Optional[str] = None, now: Optional[float] = None) -> Optional[str]:
+        """Stores `value`, returning the key of the entry it evicted, if any."""
+        now = time.time() if now is None else now
+        free = (~self.occupied).nonzero()[0]
+        evicted = None
+        if len(free):
+            slot = int(free[0])
+        else:
+            slot = int(self.last_used.argmin())
+            evicted = self.keys[slot]
+            self.evictions += 1
+        self.vectors[slot] = vector
+        self.occupied[slot] = True
+        self.created[slot] = self.last_used[slot] = now
+        self.values[slot] = value
+        self.keys[slot] = key
+        return evicted
+
+
+@dataclass
+class CacheLookup:
+    namespace: str
+    prompt: str
+    answer: Optional[str] = None
+    similarity: float = 0.0
+    vector: Any = None
+
+    @property
+    def hit(self) -> bool:
+        return self.answer is not None
+
+    def headers(self) -> Dict[str, str]:
+        headers = {"X-Cache": "hit" if self.hit else "miss"}
+        if self.hit:
+            headers["X-Cache-Similarity"] = f"{self.similarity:.3f}"
+        return headers
+
+
+class SemanticCache:
+    """Per-namespace semantic caches sharing one `embed(texts) -> unit vectors` function."""
+
+    def __init__(
+        self,
+        embed: Callable[[List[str]], Awaitable[Any]],
+        threshold: float = DEFAULT_THRESHOLD,
+        capacity: int = 1024,
+        ttl: Optional[float] = 24 * 3600,
+        publish_interval: float = 10.0,
+    ):
+        self.embed = embed
+        self.threshold = threshold
+        self.capacity = capacity
+        self.ttl = ttl
+        self.publish_interval = publish_interval
+        self.indexes: Dict[str, VectorIndex] = {}
+        self.exact: Dict[str, Dict[str, int]] = {}
+        self.counts: Dict[str, Dict[str, int]] = {}
+        self._published_at = 0.0
+
+    def _count(self, namespace: str, name: str, value: int = 1):
+        counts = self.counts.setdefault(namespace, {"lookups": 0, "hits": 0, "exact_hits": 0, "misses": 0, "stores": 0})
+        counts[name] += value
+
+    async def lookup(self, namespace: str, prompt: str) -> CacheLookup:
+        self._count(namespace, "lookups")
+        result = CacheLookup(namespace, prompt)
+        index = self.indexes.get(namespace)
+        if index is not None:
+            index.expire(time.time())
+        slot = self.exact.get(namespace, {}).get(_digest(prompt))
+        if index is not None and slot is not None and index.occupied[slot] and index.keys[slot] == _digest(prompt):
+            self._count(namespace, "hits")
+            self._count(namespace, "exact_hits")
+            result.answer, result.similarity = index.get(slot), 1.0
+            return result
+
+        result.vector = (await self.embed([prompt]))[0]
+        if index is not None:
+            slot, similarity = index.search(result.vector)
+            if slot is not None and similarity >= self.threshold:
+                self._count(namespace, "hits")
+                result.answer, result.similarity = index.get(slot), similarity
+                return result
+        self._count(namespace, "misses")
+        return result
+
+    def store(self, lookup: CacheLookup, answer: str):
+        if lookup.vector is None or not answer:
+            return
+        index = self.indexes.get(lookup.namespace)
+        if index is None:
+            index = self.indexes[lookup.namespace] = VectorIndex(len(lookup.vector), self.capacity, self.ttl)
+        exact = self.exact.setdefault(lookup.namespace, {})
+        key = _digest(lookup.prompt)
+        evicted = index.add(lookup.vector, answer, key)
+        if evicted is not None:
+            exact.pop(evicted, None)
+        exact[key] = index.keys.index(key)
+        self._count(lookup.namespace, "stores")
+
+    async def record(self, lookup: CacheLookup, deltas: AsyncIterator[Any]) -> AsyncIterator[Any]:
+        """Re-yields `deltas`, storing their text once the stream has completed."""
+        parts = []
+        async for delta in deltas:
+            parts.append(delta)
+            yield delta
+        self.store(lookup, "".join(map(delta_text, parts)))
+
+    def metrics(self) -> Dict[str, Dict[str, Any]]:
+        metrics = {}
+        for namespace, counts in self.counts.items():
+            index = self.indexes.get(namespace)
+            metrics[namespace] = dict(
+                counts,
+                hit_rate=round(counts["hits"] / counts["lookups"], 4) if counts["lookups"] else 0.0,
+                entries=len(index) if index is not None else 0,
+                evictions=index.evictions if index is not None else 0,
+            )
+        return metrics
+
+    async def lookup_or_none(self, namespace: str, prompt: str, store=None) -> Optional[CacheLookup]:
+        """`lookup` that fails open, then publishes the metrics to `store`."""
+        try:
+            return await self.lookup(namespace, prompt)
+        except Exception as e:
+            print(f"Semantic cache lookup failed, serving uncached: {e}")
+            return None
+        finally:
+            await self.publish(store)
+
+    async def publish(self, store, force: bool = False):
+        """Writes `metrics()` to the Modal `Dict` `store` at most every `publish_interval` seconds.
+
+        Each container writes under its own key and lists that key under `"containers"` (the last
+        `MAX_PUBLISHERS` of them), which `collect_metrics` reads back.
+        """
+        now = time.monotonic()
+        if store is None or (not force and now - self._published_at < self.publish_interval):
+            return
+        self._published_at = now
+        key = os.environ.get("MODAL_TASK_ID", str(os.getpid()))
+        try:
+            await store.put.aio(key, self.metrics())
+            containers = await _store_get_aio(store, "containers", [])
+            if key not in containers:
+                await store.put.aio("containers", (containers + [key])[-MAX_PUBLISHERS:])
+        except Exception as e:  # Metrics must never fail a request.
+            print(f"Could not publish semantic cache metrics: {e}")
+
+
+async def collect_metrics(store) -> Dict[str, Dict[str, Any]]:
+    """The metrics published by all web containers, summed per namespace."""
+    containers = await _store_get_aio(store, "containers", [])
+    return merge_metrics([await _store_get_aio(store, key, {}) for key in containers])
+
+
+def merge_metrics(per_container: Sequence[Dict[str, Dict[str, Any]]]) -> Dict[str, Dict[str, Any]]:
+    """Sums the `metrics()` of several containers, recomputing the hit rates."""
+    merged: Dict[str, Dict[str, Any]] = {}
+    for metrics in per_container:
+        for namespace, counts in metrics.items():
+            total = merged.setdefault(namespace, {})
+            for name, value in counts.items():
+                if name != "hit_rate":
+                    total[name] = total.get(name, 0) + value
+    for total in merged.values():
+        total["hit_rate"] = round(total["hits"] / total["lookups"], 4) if total.get("lookups") else 0.0
+    return merged
+
+
+async def replay(lookup: CacheLookup, metadata: bool = False) -> AsyncIterator[Any]:
+    """The cached answer as a one-delta stream."""
+    if metadata:
+        yield {"text": lookup.answer, "cached": True, "similarity": round(lookup.similarity, 4)}
+    else:
+        yield lookup.answer
+
+
+def download_embedder():
+    from huggingface_hub import snapshot_download
+
+    snapshot_download(EMBEDDER_MODEL, local_dir=EMBEDDER_DIR)
+
+
+class SentenceEmbedder:
+    """Unit-length sentence embeddings on CPU, for a small image next to the web tier."""
+
+    def __init__(self, path: str = EMBEDDER_DIR):
+        from sentence_transformers import SentenceTransformer
+
+        self.model = SentenceTransformer(path, device="cpu")
+
+    def embed(self, texts: Sequence[str]):
+        return self.model.encode(list(texts), normalize_embeddings=True, convert_to_numpy=True)
+
+
+def hashing_embed(texts: Sequence[str], dim: int = 512, n: int = 3):
+    """Unit vectors of hashed character n-grams: a dependency-free stand-in for local runs."""
+    import numpy as np
+
+    vectors = np.zeros((len(texts), dim), dtype=np.float32)
+    for row, text in enumerate(texts):
+        text = f" {text.lower()} "
+        for i in range(len(text) - n + 1):
+            bucket = int.from_bytes(hashlib.blake2b(text[i : i + n].encode(), digest_size=4).digest(), "little")
+            vectors[row, bucket % dim] += 1.0
+        norm = np.linalg.norm(vectors[row])
+        if norm:
+            vectors[row] /= norm
+    return vectors
+
+
+async def check():
+    from types import SimpleNamespace
+
+    import numpy as np
+
+    # The index: nearest live entry, LRU eviction when full, expiry after `ttl`.
+    index = VectorIndex(dim=512, capacity=2, ttl=100)
+    fox, grapes, sky = hashing_embed(["the fox and the grapes", "sour grapes", "why is the sky blue"])
+    assert index.search(fox, now=0) == (None, -1.0)
+    assert index.add(fox, "fable", "fox", now=0) is None and index.add(grapes, "idiom", "grapes", now=1) is None
+    slot, similarity = index.search(fox, now=2)
+    assert index.get(slot, now=2) == "fable" and abs(similarity - 1.0) < 1e-5
+    assert index.add(sky, "scattering", "sky", now=3) == "grapes" and index.evictions == 1
+    assert index.values[index.search(fox, now=4)[0]] == "fable"
+    assert index.search(fox, now=200) == (None, -1.0) and len(index) == 0 and index.evictions == 3
+
+    async def embed(texts):
+        embedded.extend(texts)
+        return hashing_embed(texts)
+
+    async def answer(text):
+        for word in text.split(" "):
+            yield word + " "
+
+    embedded: List[str] = []
+    cache = SemanticCache(embed, threshold=0.7, capacity=2)
+    paraphrases = ("What is the fable about the fox and the grapes?", "What's the fable about the fox and grapes?")
+    lookup = await cache.lookup("m/64", paraphrases[0])
+    assert not lookup.hit and lookup.headers() == {"X-Cache": "miss"}
+    assert "".join([delta async for delta in cache.record(lookup, answer("Sour grapes."))]) == "Sour grapes. "
+
+    # The same prompt hits without embedding it; a paraphrase hits by similarity.
+    embedded.clear()
+    assert (await cache.lookup("m/64", paraphrases[0])).similarity == 1.0 and embedded == []
+    lookup = await cache.lookup("m/64", paraphrases[1])
+    assert lookup.hit and lookup.answer == "Sour grapes. " and 0.7 <= lookup.similarity < 1.0, lookup.similarity
+    assert [delta async for delta in replay(lookup, metadata=True)][0]["cached"] is True
+    # Other namespaces and unrelated prompts miss.
+    assert not (await cache.lookup("m/128", paraphrases[0])).hit
+    assert not (await cache.lookup("m/64", "Why is the sky blue?")).hit
+
+    # A stream that fails is never stored.
+    async def failing():
+        yield "partial"
+        raise ConnectionError("backend went away")
+
+    lookup = await cache.lookup("m/64", "Why is the sky blue?")
+    try:
+        async for _ in cache.record(lookup, failing()):
+            pass
+    except ConnectionError:
+        pass
+    assert not (await cache.lookup("m/64", "Why is the sky blue?")).hit
+
+    # Eviction drops the exact-match entry too.
+    for prompt in ("Why is the sky blue?", "How do rainbows form?"):
+        cache.store(await cache.lookup("m/64", prompt), "Light.")
+    assert not (await cache.lookup("m/64", paraphrases[0])).hit
+    assert _digest(paraphrases[0]) not in cache.exact["m/64"]
+
+    metrics = cache.metrics()["m/64"]
+    assert metrics["stores"] == 3 and metrics["evictions"] == 1 and metrics["entries"] == 2, metrics
+    assert metrics["hits"] == 2 and metrics["exact_hits"] == 1 and metrics["lookups"] == 9, metrics
+
+    # Lookups fail open, and metrics from several containers add up.
+    async def broken(texts):
+        raise RuntimeError("embedder down")
+
+    assert await SemanticCache(broken).lookup_or_none("m/64", "anything") is None
+    merged = merge_metrics([cache.metrics(), cache.metrics()])
+    assert merged["m/64"]["lookups"] == 18 and merged["m/64"]["hit_rate"] == metrics["hit_rate"]
+
+    class FakeDict(dict):
+        def __init__(self):
+            super().__init__()
+
+            async def get_aio(key):
+                return self[key]
+
+            async def put_aio(key, value):
+                self[key] = value
+
+            self.get = SimpleNamespace(aio=get_aio)
+            self.put = SimpleNamespace(aio=put_aio)
+
+    store = FakeDict()
+    await cache.publish(store, force=True)
+    assert (await collect_metrics(store))["m/64"]["lookups"] == 9
+    assert np.isclose(np.linalg.norm(hashing_embed(["x"])[0]), 1.0)
+
+
+if __name__ == "__main__":
+    import asyncio
+
+    asyncio.run(check())
+    print("semantic cache checks passed")
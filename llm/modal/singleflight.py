@@ -0,0 +1,246 @@
+# # Single-flight generation for identical concurrent requests
+#
+# When several users (or a client retrying) send the same prompt at the same moment, each request
+# used to start its own generation on the GPU. For deterministic requests (greedy, one candidate)
+# the answers are identical, so `SingleFlight` runs one:
+#
+# - The first request for a key starts a flight: a task that reads the backend stream and fans
+#   every delta out to the flight's subscribers.
+# - Requests for the same key while it runs subscribe to it. A late joiner first gets the backlog
+#   of deltas sent so far, then follows along live.
+# - Each subscriber has a bounded buffer (`buffer_size` deltas). A subscriber that falls that far
+#   behind is dropped with `SlowSubscriber` instead of holding the others back.
+# - The generation is cancelled when its last subscriber goes away. Once it has produced more than
+#   `max_backlog` deltas, the flight stops keeping a backlog and new requests start a fresh one.
+#
+# Counts of flights, coalesced requests and the deltas and tokens they didn't have to generate are
+# kept in `metrics()`. `publish` writes them to a Modal `Dict` under this container's key, so the
+# `stats` endpoint can sum them across web containers.
+#
+# Run `python singleflight.py` to coalesce concurrent and late requests on a stand-in engine.
+import asyncio
+import hashlib
+import json
+import os
+import time
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+from records import num_tokens
+
+MAX_PUBLISHERS = 100
+
+
+class SlowSubscriber(Exception):
+    """A subscriber fell `buffer_size` deltas behind its flight."""
+
+
+class _End:
+    def __init__(self, error: Optional[BaseException] = None):
+        self.error = error
+
+
+def flight_key(*parts: Any) -> str:
+    """A key for everything that determines the answer (model, prompt, options, stream format)."""
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class _Subscriber:
+    def __init__(self, buffer_size: int, leader: bool):
+        # One slot above the bound, so the end of the stream always fits.
+        self.queue: asyncio.Queue = asyncio.Queue(buffer_size + 1)
+        self.buffer_size = buffer_size
+        self.leader = leader
+        self.lagged = False
+
+
+class _Flight:
+    def __init__(self, key: str):
+        self.key = key
+        self.subscribers: List[_Subscriber] = []
+        self.backlog: Optional[List[Any]] = []
+        self.task: Optional[asyncio.Task] = None
+        self.started = time.monotonic()
+
+
+class SingleFlight:
+    def __init__(self, buffer_size: int = 1024, max_backlog: int = 8192, publish_interval: float = 10.0):
+        self.buffer_size = buffer_size
+        self.max_backlog = max_backlog
+        self.publish_interval = publish_interval
+        self.flights: Dict[str, _Flight] = {}
+        self.counts = {
+            "flights": 0,  # generations started
+            "coalesced": 0,  # requests served by another request's generation
+            "late_joins": 0,  # coalesced after the first delta
+            "deltas_generated": 0,
+            "deltas_saved": 0,  # deltas sent to coalesced requests
+            "tokens_generated": 0,
+            "tokens_saved": 0,
+            "slow_subscribers": 0,
+            "cancelled": 0,  # flights whose subscribers all went away
+        }
+        self._published_at = 0.0
+
+    def _offer(self, flight: _Flight, subscriber: _Subscriber, delta: Any):
+        if subscriber.queue.qsize() >= subscriber.buffer_size:
+            subscriber.lagged = True
+            flight.subscribers.remove(subscriber)
+            self.counts["slow_subscribers"] += 1
+            return
+        subscriber.queue.put_nowait(delta)
+
+    async def _pump(self, flight: _Flight, deltas: AsyncIterator[Any]):
+        end = _End()
+        try:
+            async for delta in deltas:
+                tokens = num_tokens(delta)
+                self.counts["deltas_generated"] += 1
+                self.counts["tokens_generated"] += tokens
+                if flight.backlog is not None:
+                    flight.backlog.append(delta)
+                    if len(flight.backlog) > self.max_backlog:
+                        flight.backlog = None
+                        self._close(flight)
+                for subscriber in list(flight.subscribers):
+                    if not subscriber.leader:
+                        self.counts["deltas_saved"] += 1
+                        self.counts["tokens_saved"] += tokens
+                    self._offer(flight, subscriber, delta)
+        except asyncio.CancelledError:
+            self.counts["cancelled"] += 1
+            raise
+        except Exception as e:  # Every subscriber sees the failure.
+            end = _End(e)
+        finally:
+            self._close(flight)
+        for subscriber in flight.subscribers:
+            subscriber.queue.put_nowait(end)
+
+    def _close(self, flight: _Flight):
+        """Stops new requests from joining `flight`."""
+        if self.flights.get(flight.key) is flight:
+            del self.flights[flight.key]
+
+    def _leave(self, flight: _Flight, subscriber: _Subscriber):
+        if subscriber in flight.subscribers:
+            flight.subscribers.remove(subscriber)
+        if not flight.subscribers and flight.task is not None and not flight.task.done():
+            self._close(flight)
+            flight.task.cancel()
+
+    async def join(self, key: str, deltas: AsyncIterator[Any]) -> AsyncIterator[Any]:
+        """Streams `deltas`, or the flight already running for `key`, in which case `deltas` is unused."""
+        flight = self.flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = self.flights[key] = _Flight(key)
+            self.counts["flights"] += 1
+        else:
+            self.counts["coalesced"] += 1
+            self.counts["late_joins"] += bool(flight.backlog)
+        subscriber = _Subscriber(self.buffer_size, leader)
+        replay = list(flight.backlog or ())
+        flight.subscribers.append(subscriber)
+        if leader:
+            flight.task = asyncio.ensure_future(self._pump(flight, deltas))
+
+        try:
+            aclose = getattr(deltas, "aclose", None)
+            if not leader and aclose is not None:
+                await aclose()
+            for delta in replay:
+                yield delta
+            if not leader:
+                self.counts["deltas_saved"] += len(replay)
+                self.counts["tokens_saved"] += sum(map(num_tokens, replay))
+            while True:
+                if subscriber.lagged and subscriber.queue.empty():
+                    raise SlowSubscriber(f"Fell {self.buffer_size} deltas behind the shared generation")
+                delta = await subscriber.queue.get()
+                if isinstance(delta, _End):
+                    if delta.error is not None:
+                        raise delta.error
+                    return
+                yield delta
+        finally:
+            self._leave(flight, subscriber)
+
+    def metrics(self) -> Dict[str, Any]:
+        counts = dict(self.counts, in_flight=len(self.flights))
+        requests = counts["flights"] + counts["coalesced"]
+        counts["coalesced_rate"] = round(counts["coalesced"] / requests, 4) if requests else 0.0
+        return counts
+
+    async def publish(self, store, force: bool = False):
+        """Writes `metrics()` to the Modal `Dict` `store` at most every `publish_interval` seconds."""
+        now = time.monotonic()
+        if store is None or (not force and now - self._published_at < self.publish_interval):
+            return
+        self._published_at = now
+        key = os.environ.get("MODAL_TASK_ID", str(os.getpid()))
+        try:
+            await store.put.aio(key, self.metrics())
+            containers = await _store_get_aio(store, "containers", [])
+            if key not in containers:
+                await store.put.aio("containers", (containers + [key])[-MAX_PUBLISHERS:])
+        except Exception as e:  # Metrics must never fail a request.
+            print(f"Could not publish single-flight metrics: {e}")
+
+
+async def _store_get_aio(store, key: str, default=None):
+    try:
+        return await store.get.aio(key)
+    except KeyError:
+        return default
+
+
+async def collect_flight_metrics(store) -> Dict[str, Any]:
+    """The metrics published by all web containers, summed."""
+    containers = await _store_get_aio(store, "containers", [])
+    total: Dict[str, Any] = {}
+    for key in containers:
+        for name, value in (await _store_get_aio(store, key, {})).items():
+            if name != "coalesced_rate":
+                total[name] = total.get(name, 0) + value
+    requests = total.get("flights", 0) + total.get("coalesced", 0)
+    total["coalesced_rate"] = round(total.get("coalesced", 0) / requests, 4) if requests else 0.0
+    return total
+
+
+async def simulate(num_requests: int = 8, late: int = 2, token_latency: float = 0.002) -> Dict[str, Any]:
+    """Identical requests at once, a few late ones and one that never reads; returns the metrics."""
+    from fake_engine import ANSWER, fake_completion_stream
+
+    flights = SingleFlight(buffer_size=16)
+    key = flight_key("fake", "What is the fable involving a fox and grapes?", 256)
+    started = []
+
+    async def backend():
+        started.append(1)
+        async for delta in fake_completion_stream("What is the fable involving a fox and grapes?", token_latency=token_latency):
+            yield delta
+
+    async def client(delay: float = 0.0) -> str:
+        await asyncio.sleep(delay)
+        return "".join([delta async for delta in flights.join(key, backend())])
+
+    async def stalled():
+        # Reads the first delta, then stops reading without disconnecting.
+        stream = flights.join(key, backend())
+        await stream.__anext__()
+        try:
+            await asyncio.sleep(10)
+        finally:
+            await stream.aclose()
+
+    stall = asyncio.ensure_future(stalled())
+    texts = await asyncio.gather(*[client() for _ in range(num_requests)], *[client(0.05 * (i + 1)) for i in range(late)])
+    stall.cancel()
+    assert all(text == ANSWER for text in texts), texts
+    metrics = flights.metrics()
+    metrics["backend_streams_started"] = len(started)
+    return metrics
+
+
+if __name__ == "__main__":
+    print(json.dumps(asyncio.run(simulate()), indent=2))
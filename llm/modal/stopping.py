@@ -0,0 +1,340 @@
+# # Stop sequences and structured output
+#
+# Shared stopping-criteria engine for every model in this directory. It works on the
+# decoded token stream, so it can be driven from vLLM's `RequestOutput`s, from a
+# `transformers` generation loop or from FastChat's `generate_stream`.
+#
+# Three kinds of criteria are supported:
+#
+# - plain stop strings, matched with a streaming-safe partial-match buffer: text that could be the
+#   beginning of a stop string is held back until we know whether it is one, so a `"###"` split
+#   across two chunks never leaks to the client as `"##"`.
+# - a regular expression; generation ends as soon as it matches the output. Each delta only
+#   searches the last `REGEX_WINDOW` characters, so a match must fit in that window, and the cost
+#   per token stays bounded however long the output gets.
+# - a JSON value, optionally checked against a (small subset of) JSON schema; generation ends as
+#   soon as the top-level value is closed, and as soon as the output can no longer be JSON.
+#
+# `stopping_options` validates the options in the web tier (types, sizes, the regex compiles and has
+# no nested quantifiers, which is where catastrophic backtracking comes from) and raises
+# `ValueError`, which the endpoints turn into a 400 before any GPU container is involved.
+#
+# Nothing here imports anything outside the standard library at module level, so it can be
+# mounted into the web images as well as the GPU images (including Vicuna's Python 3.8).
+#
+# Run `python stopping.py` to check the matchers and the validation.
+import json
+import re
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+
+class StopSequenceMatcher:
+    """Trims a text stream at the first occurrence of any of `stop`.
+
+    `feed` returns the part of the text that is safe to emit; the suffix that is still a
+    prefix of some stop string is buffered until the next chunk (or `flush`) resolves it.
+    """
+
+    def __init__(self, stop: Sequence[str]):
+        self.stop = [s for s in stop if s]
+        self.stopped = False
+        self._pending = ""
+
+    def feed(self, text: str) -> Tuple[str, bool]:
+        if self.stopped:
+            return "", True
+        if not self.stop:
+            return text, False
+
+        buffer = self._pending + text
+        cut = min((i for i in (buffer.find(s) for s in self.stop) if i != -1), default=-1)
+        if cut != -1:
+            self._pending = ""
+            self.stopped = True
+            return buffer[:cut], True
+
+        hold = self._partial_suffix(buffer)
+        self._pending = buffer[len(buffer) - hold :]
+        return buffer[: len(buffer) - hold], False
+
+    def flush(self) -> str:
+        pending, self._pending = self._pending, ""
+        return "" if self.stopped else pending
+
+    def _partial_suffix(self, buffer: str) -> int:
+        # Length of the longest suffix of `buffer` that is a proper prefix of a stop string.
+        longest = 0
+        for s in self.stop:
+            for n in range(min(len(s) - 1, len(buffer)), longest, -1):
+                if buffer.endswith(s[:n]):
+                    longest = n
+                    break
+        return longest
+
+
+class JsonValueTracker:
+    """Incrementally scans output for a single top-level JSON object or array.
+
+    `complete` flips once the value is closed, `invalid` as soon as the output can no
+    longer be the JSON value we asked for. On completion the value is parsed and, when a
+    schema is given, checked for its top-level `type` and `required` keys.
+    """
+
+    def __init__(self, schema: Optional[Dict[str, Any]] = None):
+        self.schema = schema or {}
+        self.complete = False
+        self.invalid = False
+        self.value: Any = None
+        self._text: List[str] = []
+        self._depth = 0
+        self._started = False
+        self._in_string = False
+        self._escape = False
+
+    def feed(self, text: str) -> int:
+        """Consume `text`; returns how many characters belong to the value (all of them unless it just closed)."""
+        for i, ch in enumerate(text):
+            if self.complete or self.invalid:
+                return i
+            if not self._started:
+                if ch.isspace():
+                    continue
+                if ch not in "{[":
+                    self.invalid = True
+                    return i
+                self._started = True
+            self._text.append(ch)
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+            elif ch == '"':
+                self._in_string = True
+            elif ch in "{[":
+                self._depth += 1
+            elif ch in "}]":
+                self._depth -= 1
+                if self._depth == 0:
+                    self._finish()
+                    return i + 1
+        return len(text)
+
+    def _finish(self):
+        try:
+            self.value = json.loads("".join(self._text))
+        except ValueError:
+            self.invalid = True
+            return
+        expected = self.schema.get("type")
+        if expected == "object" and not isinstance(self.value, dict):
+            self.invalid = True
+        elif expected == "array" and not isinstance(self.value, list):
+            self.invalid = True
+        elif isinstance(self.value, dict) and any(k not in self.value for k in self.schema.get("required", [])):
+            self.invalid = True
+        else:
+            self.complete = True
+
+
+STOPPING_KEYS = ("stop", "stop_regex", "json_schema", "json_mode")
+MAX_STOP_SEQUENCES = 16
+MAX_STOP_LENGTH = 256
+MAX_REGEX_LENGTH = 256
+REGEX_WINDOW = 512
+# A quantified group that itself contains a quantifier, e.g. `(a+)+` or `(\w*\s?)*`.
+_NESTED_QUANTIFIER = re.compile(r"\((?:[^()\\]|\\.)*[*+}?](?:[^()\\]|\\.)*\)(?:[*+]|\{\d*,)")
+
+
+def stopping_options(payload: Dict[str, Any]) -> Dict[str, Any]:
+    """Picks the stopping options out of a web endpoint payload, validated, to forward to the model class.
+
+    Raises `ValueError` for options the container couldn't use.
+    """
+    options = {key: payload[key] for key in STOPPING_KEYS if payload.get(key)}
+    stop = options.get("stop")
+    if stop is not None:
+        stops = [stop] if isinstance(stop, str) else stop
+        if not isinstance(stops, list) or not all(isinstance(s, str) for s in stops):
+            raise ValueError("stop must be a string or a list of strings")
+        if len(stops) > MAX_STOP_SEQUENCES or any(len(s) > MAX_STOP_LENGTH for s in stops):
+            raise ValueError(f"At most {MAX_STOP_SEQUENCES} stop sequences of at most {MAX_STOP_LENGTH} characters")
+    regex = options.get("stop_regex")
+    if regex is not None:
+        if not isinstance(regex, str) or len(regex) > MAX_REGEX_LENGTH:
+            raise ValueError(f"stop_regex must be a string of at most {MAX_REGEX_LENGTH} characters")
+        if _NESTED_QUANTIFIER.search(regex):
+            raise ValueError("stop_regex may not repeat a group that contains a quantifier")
+        try:
+            re.compile(regex)
+        except re.error as e:
+            raise ValueError(f"Invalid stop_regex: {e}") from None
+    schema = options.get("json_schema")
+    if schema is not None:
+        if not isinstance(schema, dict):
+            raise ValueError("json_schema must be an object")
+        required = schema.get("required", [])
+        if not isinstance(required, list) or not all(isinstance(k, str) for k in required):
+            raise ValueError("json_schema.required must be a list of strings")
+    if "json_mode" in options and not isinstance(options["json_mode"], bool):
+        raise ValueError("json_mode must be a boolean")
+    return options
+
+
+class StoppingEngine:
+    """Combines stop strings, a regex and a JSON constraint over one generation.
+
+    Feed it the decoded text deltas in order; it returns what may be sent to the client
+    and whether generation should end now. `reason` records why it stopped.
+    """
+
+    def __init__(
+        self,
+        stop: Sequence[str] = (),
+        regex: Optional[str] = None,
+        json_schema: Optional[Dict[str, Any]] = None,
+        json_mode: bool = False,
+    ):
+        self.matcher = StopSequenceMatcher(stop)
+        self.pattern = re.compile(regex) if regex else None
+        self.json = JsonValueTracker(json_schema) if (json_mode or json_schema) else None
+        self.reason: Optional[str] = None
+        self._output = ""
+
+    @classmethod
+    def from_payload(cls, payload: Dict[str, Any], default_stop: Sequence[str] = ()) -> "StoppingEngine":
+        stop = payload.get("stop") or []
+        if isinstance(stop, str):
+            stop = [stop]
+        return cls(
+            stop=list(default_stop) + list(stop),
+            regex=payload.get("stop_regex"),
+            json_schema=payload.get("json_schema"),
+            json_mode=bool(payload.get("json_mode")),
+        )
+
+    @property
+    def stopped(self) -> bool:
+        return self.reason is not None
+
+    def feed(self, text: str) -> Tuple[str, bool]:
+        if self.stopped:
+            return "", True
+
+        emit, hit = self.matcher.feed(text)
+        if hit:
+            self.reason = "stop"
+
+        if self.json is not None:
+            keep = self.json.feed(emit)
+            if self.json.complete or self.json.invalid:
+                emit = emit[:keep]
+                self.reason = "json" if self.json.complete else "json_invalid"
+
+        if self.pattern is not None and emit:
+            # Only matches that end in the new text count; earlier text was searched already.
+            start = len(self._output)
+            self._output += emit
+            for match in self.pattern.finditer(self._output):
+                if match.end() > start:
+                    emit = emit[: max(0, match.end() - start)]
+                    self.reason = "regex"
+                    break
+            self._output = self._output[-REGEX_WINDOW:]
+        return emit, self.stopped
+
+    def flush(self) -> str:
+        return "" if self.stopped else self.matcher.flush()
+
+
+def stop_event(reason: Optional[str]) -> Optional[Dict[str, Any]]:
+    """The `stop` event to send after the text, for stop reasons the text alone doesn't show.
+
+    Output that stopped being valid JSON (`json_invalid`) ends at the last character that could
+    still have been JSON, which looks like an ordinary truncated answer to the client.
+    """
+    if reason == "json_invalid":
+        return {"event": "stop", "reason": reason}
+    return None
+
+
+def transformers_stopping_criteria(engine: StoppingEngine, tokenizer, prompt_length: int):
+    """Wraps `engine` in a `transformers.StoppingCriteriaList` so `generate` ends on the GPU side.
+
+    The criteria decode the whole continuation each step and feed only the new characters,
+    which sidesteps tokenizers (SentencePiece) whose per-token decodes don't concatenate. That is
+    quadratic in the output length, so only install them when the request has stopping options.
+    """
+    from transformers import StoppingCriteria, StoppingCriteriaList
+
+    class _EngineCriteria(StoppingCriteria):
+        def __init__(self):
+            self.index = 0
+
+        def __call__(self, input_ids, scores, **kwargs) -> bool:
+            text = tokenizer.decode(input_ids[0, prompt_length:], skip_special_tokens=True)
+            if text.endswith("\ufffd"):
+                return False
+            delta, self.index = text[self.index :], len(text)
+            _, stopped = engine.feed(delta)
+            return stopped
+
+    return StoppingCriteriaList([_EngineCriteria()])
+
+
+if __name__ == "__main__":
+    import time
+
+    # A stop string split across chunks never leaks, and text after it is dropped.
+    matcher = StopSequenceMatcher(["###"])
+    assert matcher.feed("Hello #") == ("Hello ", False)
+    assert matcher.feed("## world") == ("", True)
+    matcher = StopSequenceMatcher(["###"])
+    assert matcher.feed("a #") == ("a ", False) and matcher.feed("b") == ("#b", False) and matcher.flush() == ""
+
+    # JSON ends at the closing brace; output that can't be JSON ends with `json_invalid`.
+    engine = StoppingEngine(json_schema={"type": "object", "required": ["a"]})
+    assert engine.feed(' {"a": "}"') == (' {"a": "}"', False)
+    assert engine.feed("} trailing") == ("}", True) and engine.reason == "json"
+    engine = StoppingEngine(json_mode=True)
+    assert engine.feed("Sure! {") == ("", True) and stop_event(engine.reason) == {"event": "stop", "reason": "json_invalid"}
+
+    # A regex match ends the output right after it, also across deltas and far into the output.
+    engine = StoppingEngine(regex=r"END\d")
+    assert engine.feed("x" * 5000 + "EN") == ("x" * 5000 + "EN", False)
+    assert engine.feed("D7 more") == ("D7", True) and engine.reason == "regex"
+
+    # Per-delta regex cost doesn't grow with the output: the last deltas of a long output cost about
+    # as much as the first ones.
+    engine = StoppingEngine(regex=r"\n\nQuestion \d+:")
+    timings = []
+    for _ in range(4):
+        t0 = time.perf_counter()
+        for _ in range(5000):
+            engine.feed("some words ")
+        timings.append(time.perf_counter() - t0)
+    assert not engine.stopped and timings[-1] < 3 * timings[0], timings
+
+    # Validation happens before anything is sent to a container.
+    assert stopping_options({"stop": "###", "temperature": 0}) == {"stop": "###"}
+    assert stopping_options({"stop_regex": r"\n\n", "json_schema": {"type": "object"}})
+    for bad in [
+        {"stop": [1]},
+        {"stop": {"a": 1}},
+        {"stop": ["x"] * (MAX_STOP_SEQUENCES + 1)},
+        {"stop_regex": "("},
+        {"stop_regex": "(a+)+$"},
+        {"stop_regex": r"(\w*\s?)*x"},
+        {"stop_regex": "a" * (MAX_REGEX_LENGTH + 1)},
+        {"json_schema": "object"},
+        {"json_schema": {"required": "a"}},
+        {"json_mode": "yes"},
+    ]:
+        try:
+            stopping_options(bad)
+        except ValueError:
+            continue
+        raise AssertionError(f"accepted {bad}")
+    print("stopping checks passed")
@@ -0,0 +1,121 @@
+# # Shared tokenization with fast tokenizers and cached templates
+#
+# Token counting (for the frontend's usage display and for prompt budgeting) shouldn't need a GPU
+# container, nor re-tokenize the same prompt template on every request. `CachedTokenizer` wraps a
+# HuggingFace *fast* (Rust) tokenizer and:
+#
+# - encodes batches of texts in one call, which the Rust tokenizer parallelises,
+# - caches the encodings of prompt templates and other fixed prefixes, and
+# - counts a templated prompt as the cached template overhead plus the user text, so only the user
+#   text is tokenized per request. Splitting at the template boundary can differ from tokenizing
+#   the whole prompt by a token where SentencePiece merges across it, which is fine for counting
+#   and budgeting; engines still tokenize the real prompt themselves.
+#
+# `parse_texts` validates what the `count_tokens` endpoints accept: a list of at most `MAX_TEXTS`
+# strings of at most `MAX_TEXT_CHARS` characters each (or a single `prompt`), so one request can't
+# tie up the tokenizer container.
+#
+# `python tokenization.py <model>` benchmarks slow vs fast tokenizers and cached template counts
+# on CPU.
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Sequence
+
+TEMPLATE_FIELD = "{user}"
+MAX_TEXTS = 256
+MAX_TEXT_CHARS = 100_000
+
+
+class TextsTooLarge(ValueError):
+    """More texts, or longer ones, than one `count_tokens` request may carry."""
+
+
+def parse_texts(payload: Dict[str, Any], max_texts: int = MAX_TEXTS, max_chars: int = MAX_TEXT_CHARS) -> List[str]:
+    """The texts to count from a request: `payload["texts"]`, or `[payload["prompt"]]` without it."""
+    texts = payload.get("texts")
+    if texts is None:
+        texts = [payload.get("prompt", "")]
+    if not isinstance(texts, list) or not all(isinstance(text, str) for text in texts):
+        raise ValueError("texts must be a list of strings")
+    if len(texts) > max_texts:
+        raise TextsTooLarge(f"At most {max_texts} texts per request, got {len(texts)}")
+    longest = max(map(len, texts), default=0)
+    if longest > max_chars:
+        raise TextsTooLarge(f"Texts may be at most {max_chars} characters long, got {longest}")
+    return texts
+
+
+def load_fast_tokenizer(name_or_path: str, **kwargs):
+    from transformers import AutoTokenizer
+
+    tokenizer = AutoTokenizer.from_pretrained(name_or_path, use_fast=True, **kwargs)
+    if not tokenizer.is_fast:
+        print(f"No fast tokenizer available for {name_or_path}, using {type(tokenizer).__name__}")
+    return tokenizer
+
+
+class CachedTokenizer:
+    def __init__(self, tokenizer, cache_size: int = 1024):
+        self.tokenizer = tokenizer
+        self._encode_cached = lru_cache(maxsize=cache_size)(self._encode)
+
+    def _encode(self, text: str, add_special_tokens: bool) -> tuple:
+        return tuple(self.tokenizer(text, add_special_tokens=add_special_tokens)["input_ids"])
+
+    def encode_prefix(self, text: str, add_special_tokens: bool = True) -> tuple:
+        """Token ids of a fixed string (template part, system prompt), cached."""
+        return self._encode_cached(text, add_special_tokens)
+
+    def template_overhead(self, template: Optional[str]) -> int:
+        """Tokens a template adds around the user text, special tokens included."""
+        if not template:
+            return len(self.encode_prefix("", True))
+        prefix, _, suffix = template.partition(TEMPLATE_FIELD)
+        return len(self.encode_prefix(prefix, True)) + len(self.encode_prefix(suffix, False))
+
+    def encode_batch(self, texts: Sequence[str]) -> List[List[int]]:
+        if not texts:
+            return []
+        return self.tokenizer(list(texts), add_special_tokens=False)["input_ids"]
+
+    def count_tokens(self, texts: Sequence[str], template: Optional[str] = None) -> List[int]:
+        """Token counts of `texts`, each as it would be sent inside `template`."""
+        overhead = self.template_overhead(template)
+        return [overhead + len(ids) for ids in self.encode_batch(texts)]
+
+    def cache_info(self):
+        return self._encode_cached.cache_info()
+
+
+def benchmark(name_or_path: str, texts: Sequence[str], template: str = "<s> [INST] {user} [/INST] ", repeat: int = 3):
+    """Texts/s for the slow tokenizer, the fast tokenizer one by one, and `CachedTokenizer` batches."""
+    import time
+
+    from transformers import AutoTokenizer
+
+    def rate(fn) -> float:
+        best = float("inf")
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            fn()
+            best = min(best, time.perf_counter() - t0)
+        return len(texts) / best
+
+    slow = AutoTokenizer.from_pretrained(name_or_path, use_fast=False)
+    fast = load_fast_tokenizer(name_or_path)
+    cached = CachedTokenizer(fast)
+    results = {
+        "slow, per text": rate(lambda: [len(slow(template.format(user=t))["input_ids"]) for t in texts]),
+        "fast, per text": rate(lambda: [len(fast(template.format(user=t))["input_ids"]) for t in texts]),
+        "fast, cached template, batched": rate(lambda: cached.count_tokens(texts, template)),
+    }
+    for name, texts_per_s in results.items():
+        print(f"{name:>32}: {texts_per_s:>10.0f} texts/s")
+    return results
+
+
+if __name__ == "__main__":
+    import sys
+
+    model = sys.argv[1] if len(sys.argv) > 1 else "mistralai/Mistral-7B-Instruct-v0.1"
+    sample = "Describe the city of the future, considering advances in technology, environmental changes, and societal shifts."
+    benchmark(model, [f"{sample} ({i})" for i in range(2000)])
@@ -0,0 +1,234 @@
+# # Tensor-parallel setup and Ray CPU pinning
+#
+# With `tensor_parallel_size > 1`, vLLM runs one Ray worker per GPU. Left alone, those workers
+# float across every core in the container and fight the engine loop for CPU time, which is the
+# slowdown described in https://github.com/vllm-project/vllm/issues/2073#issuecomment-1853422529.
+#
+# The helpers here pin each `ray::` worker process to its own core from Python:
+#
+# - cores are read from `/sys/devices/system/cpu`, restricted to the CPUs this container may use,
+# - one hardware thread per physical core is handed out first (hyperthread siblings only when we
+#   run out), and
+# - consecutive workers alternate between NUMA nodes, so the per-GPU workers end up spread the same
+#   way the GPUs usually are.
+#
+# Every filesystem root and affinity call can be swapped out, so the logic can be exercised
+# against a fake `/proc`, a fake `/sys` and a recording `sched_setaffinity`: run `python topology.py`.
+import os
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional, Set
+
+
+@dataclass(frozen=True)
+class Cpu:
+    id: int
+    core: int
+    package: int
+    node: int
+
+
+def parse_cpulist(cpulist: str) -> List[int]:
+    """Parses the kernel's list format, e.g. `"0-3,8,10-11"`."""
+    cpus: List[int] = []
+    for part in cpulist.strip().split(","):
+        if not part:
+            continue
+        if "-" in part:
+            lo, hi = part.split("-")
+            cpus.extend(range(int(lo), int(hi) + 1))
+        else:
+            cpus.append(int(part))
+    return cpus
+
+
+def _read_int(path: Path, default: int = 0) -> int:
+    try:
+        return int(path.read_text().strip())
+    except (OSError, ValueError):
+        return default
+
+
+def read_topology(sys_root: str = "/sys", allowed: Optional[Iterable[int]] = None) -> List[Cpu]:
+    """Lists the CPUs we may run on with their physical core, package and NUMA node."""
+    allowed = set(os.sched_getaffinity(0) if allowed is None else allowed)
+
+    node_of: Dict[int, int] = {}
+    for node_dir in Path(sys_root, "devices/system/node").glob("node[0-9]*"):
+        node = int(node_dir.name[len("node") :])
+        try:
+            cpulist = (node_dir / "cpulist").read_text()
+        except OSError:
+            continue
+        for cpu in parse_cpulist(cpulist):
+            node_of[cpu] = node
+
+    cpus = []
+    for cpu_id in sorted(allowed):
+        topology = Path(sys_root, f"devices/system/cpu/cpu{cpu_id}/topology")
+        cpus.append(
+            Cpu(
+                id=cpu_id,
+                core=_read_int(topology / "core_id", cpu_id),
+                package=_read_int(topology / "physical_package_id"),
+                node=node_of.get(cpu_id, 0),
+            )
+        )
+    return cpus
+
+
+def pin_order(cpus: List[Cpu]) -> List[int]:
+    """Orders CPU ids for pinning: one thread per physical core first, alternating NUMA nodes."""
+    primary: Dict[int, List[int]] = {}
+    siblings: List[int] = []
+    seen = set()
+    for cpu in sorted(cpus, key=lambda c: c.id):
+        key = (cpu.package, cpu.core)
+        if key in seen:
+            siblings.append(cpu.id)
+        else:
+            seen.add(key)
+            primary.setdefault(cpu.node, []).append(cpu.id)
+
+    order: List[int] = []
+    queues = [primary[node] for node in sorted(primary)]
+    while any(queues):
+        for queue in queues:
+            if queue:
+                order.append(queue.pop(0))
+    return order + siblings
+
+
+def ray_worker_pids(proc_root: str = "/proc") -> List[int]:
+    """Finds Ray worker processes by their `ray::` command name, like `ps xo '%p %c' | grep ray::`."""
+    pids = []
+    for entry in Path(proc_root).iterdir():
+        if not entry.name.isdigit():
+            continue
+        try:
+            comm = (entry / "comm").read_text()
+        except OSError:
+            continue  # The process exited while we were looking.
+        if comm.startswith("ray::"):
+            pids.append(int(entry.name))
+    return sorted(pids)
+
+
+def pin_ray_workers(
+    pids: Optional[List[int]] = None,
+    cpus: Optional[List[Cpu]] = None,
+    setaffinity: Optional[Callable[[int, Set[int]], None]] = None,
+    getaffinity: Optional[Callable[[int], Set[int]]] = None,
+) -> Dict[int, int]:
+    """Pins each Ray worker to its own core and returns the verified `{pid: cpu}` mapping.
+
+    Workers that can't be pinned (they exited, or the affinity didn't stick) are logged and
+    left out of the result rather than failing container startup. The affinity calls default
+    to `os.sched_*affinity`, looked up lazily since they don't exist on macOS clients.
+    """
+    setaffinity = setaffinity or os.sched_setaffinity
+    getaffinity = getaffinity or os.sched_getaffinity
+    pids = ray_worker_pids() if pids is None else pids
+    order = pin_order(read_topology() if cpus is None else cpus)
+    if not pids or not order:
+        print(f"Ray CPU pinning skipped: {len(pids)} workers, {len(order)} cpus")
+        return {}
+    if len(pids) > len(order):
+        print(f"Ray CPU pinning: {len(pids)} workers share {len(order)} cpus")
+
+    pinned = {}
+    for i, pid in enumerate(pids):
+        cpu = order[i % len(order)]
+        try:
+            setaffinity(pid, {cpu})
+            actual = set(getaffinity(pid))
+        except OSError as e:
+            print(f"Ray CPU pinning: could not pin pid {pid} to cpu {cpu}: {e}")
+            continue
+        if actual != {cpu}:
+            print(f"Ray CPU pinning: pid {pid} has affinity {sorted(actual)}, expected [{cpu}]")
+            continue
+        pinned[pid] = cpu
+
+    print(f"Ray CPU pinning: {pinned}")
+    return pinned
+
+
+def init_tensor_parallel(gpu_count: int):
+    """Restarts Ray with the container's GPUs before vLLM starts its workers.
+
+    Patch for https://github.com/vllm-project/vllm/issues/1116.
+    """
+    if gpu_count <= 1:
+        return
+
+    import ray
+
+    ray.shutdown()
+    ray.init(num_gpus=gpu_count)
+
+
+def _fake_host(root: str, nodes: int = 2, cores_per_node: int = 4, workers: int = 4) -> List[int]:
+    """Writes a fake `/sys` (`nodes` NUMA nodes of hyperthreaded cores) and `/proc` under `root`.
+
+    CPUs `0..n-1` are the first thread of each core and `n..2n-1` their siblings, numbered the way
+    Linux usually does. Returns the pids of the fake Ray workers.
+    """
+    cores = nodes * cores_per_node
+    for node in range(nodes):
+        node_cpus = list(range(node * cores_per_node, (node + 1) * cores_per_node))
+        node_cpus += [cpu + cores for cpu in node_cpus]
+        node_dir = Path(root, f"sys/devices/system/node/node{node}")
+        node_dir.mkdir(parents=True)
+        (node_dir / "cpulist").write_text(",".join(map(str, node_cpus)) + "\n")
+    for cpu in range(2 * cores):
+        topology = Path(root, f"sys/devices/system/cpu/cpu{cpu}/topology")
+        topology.mkdir(parents=True)
+        (topology / "core_id").write_text(f"{cpu % cores}\n")
+        (topology / "physical_package_id").write_text(f"{(cpu % cores) // cores_per_node}\n")
+
+    processes = {1: "python\n", 7: "raylet\n"}
+    processes.update({100 + i: "ray::RayWorkerVllm\n" for i in range(workers)})
+    for pid, comm in processes.items():
+        Path(root, f"proc/{pid}").mkdir(parents=True)
+        Path(root, f"proc/{pid}/comm").write_text(comm)
+    Path(root, "proc/self").mkdir()
+    return [pid for pid, comm in processes.items() if comm.startswith("ray::")]
+
+
+if __name__ == "__main__":
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as root:
+        expected_pids = _fake_host(root)
+        cpus = read_topology(f"{root}/sys", allowed=range(16))
+        pids = ray_worker_pids(f"{root}/proc")
+        assert pids == expected_pids, pids
+
+        # One thread per physical core, alternating NUMA nodes, then the hyperthread siblings.
+        order = pin_order(cpus)
+        assert order[:8] == [0, 4, 1, 5, 2, 6, 3, 7], order
+        assert sorted(order[8:]) == list(range(8, 16)), order
+
+        affinity: Dict[int, Set[int]] = {}
+        pinned = pin_ray_workers(pids, cpus, affinity.__setitem__, affinity.__getitem__)
+        assert pinned == {100: 0, 101: 4, 102: 1, 103: 5}, pinned
+        assert {cpu.node for cpu in cpus if cpu.id in pinned.values()} == {0, 1}
+
+        # Only CPUs the container may use are handed out.
+        restricted = pin_order(read_topology(f"{root}/sys", allowed=[2, 3, 6, 10]))
+        assert restricted == [2, 6, 3, 10], restricted
+
+        # A worker whose affinity doesn't stick, or that exited, is left out instead of failing.
+        def stubborn(pid: int, cpus: Set[int]):
+            if pid == 101:
+                raise ProcessLookupError(pid)
+            affinity[pid] = cpus if pid != 102 else set(range(16))
+
+        pinned = pin_ray_workers(pids, cpus, stubborn, affinity.__getitem__)
+        assert pinned == {100: 0, 103: 5}, pinned
+
+        # More workers than cores share them round-robin.
+        pinned = pin_ray_workers(list(range(20)), cpus, affinity.__setitem__, affinity.__getitem__)
+        assert pinned[16] == pinned[0] and len(set(pinned.values())) == 16, pinned
+    print("topology checks passed")
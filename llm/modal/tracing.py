@@ -0,0 +1,390 @@
+# # Per-request tracing
+#
+# A slow completion report used to come with nothing but the `Generated N tokens in Xs` print. The
+# tracer here records spans for one request across both tiers and writes them as OTLP-compatible
+# JSON (one `{"resourceSpans": [...]}` document per line) to a file sink:
+#
+#     completion (web)                        the whole web request
+#     ├── auth                                bearer token check
+#     └── remote_gen                          dispatch until the stream ends
+#         ├── queue (container)               dispatch until the container picked the request up
+#         ├── prefill (container)             engine.generate until the first output
+#         └── decode (container)              first output until the last; one event per flush
+#
+# The trace id is the request id the container hands to vLLM, so engine logs, both tiers' spans and
+# the recorded request line up. Sampling is decided from the trace id itself, so the web tier and
+# the container agree without passing a flag, and an unsampled request only pays for the hash check:
+# its trace and spans are shared no-op objects. The root span keeps the request's options and the
+# sizes of its prompt (`request_attributes`), never the text; `recorded_request` reads the options
+# back, and the prompt is in the generation log under the same request id (see `genlog.py`).
+#
+# Finished traces are buffered and written in batches, every `flush_interval` seconds or once
+# `batch_size` are waiting, on a worker thread, so the request path never waits on the disk. The
+# apps point each container's sink at its own file on a Modal `Volume` and commit it after each
+# batch (`on_flush`), so traces outlive the container that recorded them.
+#
+# Container timestamps come from a different clock than the web tier's, so the `queue` span is only
+# as accurate as the clocks are in sync.
+#
+# Run `python tracing.py` to check sampling, redaction and the batched export to a temporary sink.
+import asyncio
+import json
+import os
+import threading
+import time
+import uuid
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+DEFAULT_SINK = os.environ.get("TRACE_SINK", "/tmp/traces.jsonl")
+MAX_EVENTS_PER_SPAN = 256
+# Request fields holding user text; traces record their sizes instead.
+CONTENT_FIELDS = ("prompt", "messages", "texts", "system")
+
+
+def new_request_id() -> str:
+    # Same format as `vllm.utils.random_uuid`, and a valid 16-byte OTLP trace id.
+    return uuid.uuid4().hex
+
+
+def is_sampled(trace_id: str, rate: float) -> bool:
+    return int(trace_id[:8], 16) < rate * 0x100000000
+
+
+def request_attributes(payload: Dict[str, Any]) -> Dict[str, Any]:
+    """Root span attributes for a request: its options, and only the sizes of its user content."""
+    attributes: Dict[str, Any] = {}
+    options = {}
+    for key, value in payload.items():
+        if key not in CONTENT_FIELDS:
+            options[key] = value
+        elif isinstance(value, (str, list)):
+            attributes[f"request.{key}.{'chars' if isinstance(value, str) else 'items'}"] = len(value)
+    attributes["request.options"] = options
+    return attributes
+
+
+def _attribute(key: str, value: Any) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        return {"key": key, "value": {"boolValue": value}}
+    if isinstance(value, int):
+        return {"key": key, "value": {"intValue": str(value)}}
+    if isinstance(value, float):
+        return {"key": key, "value": {"doubleValue": value}}
+    if not isinstance(value, str):
+        value = json.dumps(value)
+    return {"key": key, "value": {"stringValue": value}}
+
+
+class Span:
+    __slots__ = ("name", "span_id", "parent_id", "start_ns", "end_ns", "attributes", "events", "error")
+
+    def __init__(self, name: str, parent_id: Optional[str], start_ns: Optional[int] = None, **attributes):
+        self.name = name
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.start_ns = start_ns or time.time_ns()
+        self.end_ns: Optional[int] = None
+        self.attributes = attributes
+        self.events: List[Dict[str, Any]] = []
+        self.error: Optional[str] = None
+
+    def add_event(self, name: str, **attributes):
+        if len(self.events) < MAX_EVENTS_PER_SPAN:
+            self.events.append({"name": name, "timeUnixNano": str(time.time_ns()), "attributes": attributes})
+
+    def end(self, **attributes):
+        self.attributes.update(attributes)
+        if self.end_ns is None:
+            self.end_ns = time.time_ns()
+
+    def __enter__(self) -> "Span":
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc is not None:
+            self.error = f"{exc_type.__name__}: {exc}"
+        self.end()
+
+    def to_otlp(self, trace_id: str) -> Dict[str, Any]:
+        span = {
+            "traceId": trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": 1,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns or time.time_ns()),
+            "attributes": [_attribute(k, v) for k, v in self.attributes.items()],
+            "events": [
+                dict(event, attributes=[_attribute(k, v) for k, v in event["attributes"].items()])
+                for event in self.events
+            ],
+            "status": {"code": 2, "message": self.error} if self.error else {"code": 1},
+        }
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        return span
+
+
+class _NoopSpan:
+    span_id = None
+
+    def add_event(self, name: str, **attributes):
+        pass
+
+    def end(self, **attributes):
+        pass
+
+    def __enter__(self) -> "_NoopSpan":
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+class Trace:
+    sampled = True
+
+    def __init__(self, tracer: "Tracer", trace_id: str, parent_id: Optional[str] = None):
+        self.tracer = tracer
+        self.trace_id = trace_id
+        self.parent_id = parent_id
+        self.spans: List[Span] = []
+
+    def span(self, name: str, parent: Optional[Span] = None, start_ns: Optional[int] = None, **attributes) -> Span:
+        span = Span(name, parent.span_id if parent is not None else self.parent_id, start_ns, **attributes)
+        self.spans.append(span)
+        return span
+
+    def context(self, parent: Optional[Span] = None) -> Dict[str, Any]:
+        """What the other tier needs to continue this trace: pass it along with the request."""
+        return {
+            "request_id": self.trace_id,
+            "parent_span_id": parent.span_id if parent is not None else self.parent_id,
+            "dispatched_at_ns": time.time_ns(),
+        }
+
+    def finish(self):
+        self.tracer.export(self)
+
+
+class _NoopTrace:
+    sampled = False
+
+    def __init__(self, trace_id: str):
+        self.trace_id = trace_id
+
+    def span(self, name: str, parent=None, start_ns=None, **attributes) -> _NoopSpan:
+        return NOOP_SPAN
+
+    def context(self, parent=None) -> Dict[str, Any]:
+        return {"request_id": self.trace_id}
+
+    def finish(self):
+        pass
+
+
+class Tracer:
+    def __init__(
+        self,
+        service: str,
+        sample_rate: float = 0.01,
+        sink: str = DEFAULT_SINK,
+        batch_size: int = 64,
+        flush_interval: float = 10.0,
+        max_pending: int = 10000,
+        on_flush: Optional[Callable[[], None]] = None,
+    ):
+        self.service = service
+        self.sample_rate = sample_rate
+        self.sink = sink
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        # Runs on the worker thread after each batch, e.g. to commit a Modal `Volume`.
+        self.on_flush = on_flush
+        self.counts = {"exported": 0, "written": 0, "dropped": 0, "failed": 0}
+        self._pending: List[Tuple[str, List[Span]]] = []
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._flusher: Optional[asyncio.Task] = None
+
+    def start_trace(self, request_id: Optional[str] = None):
+        trace_id = request_id or new_request_id()
+        if not is_sampled(trace_id, self.sample_rate):
+            return _NoopTrace(trace_id)
+        return Trace(self, trace_id)
+
+    def continue_trace(self, context: Optional[Dict[str, Any]]):
+        """Picks up a trace started by the other tier, or starts one if there is no context."""
+        if not context:
+            return self.start_trace()
+        trace_id = context["request_id"]
+        if not is_sampled(trace_id, self.sample_rate):
+            return _NoopTrace(trace_id)
+        return Trace(self, trace_id, context.get("parent_span_id"))
+
+    def document(self, trace_id: str, spans: List[Span]) -> Dict[str, Any]:
+        return {
+            "resourceSpans": [
+                {
+                    "resource": {"attributes": [_attribute("service.name", self.service)]},
+                    "scopeSpans": [
+                        {
+                            "scope": {"name": "llm-playground"},
+                            "spans": [span.to_otlp(trace_id) for span in spans],
+                        }
+                    ],
+                }
+            ]
+        }
+
+    def export(self, trace: Trace):
+        """Queues a finished trace for the next batch; called from an event loop, it never blocks."""
+        with self._lock:
+            self.counts["exported"] += 1
+            if len(self._pending) >= self.max_pending:
+                self.counts["dropped"] += 1
+                return
+            self._pending.append((trace.trace_id, trace.spans))
+            full = len(self._pending) >= self.batch_size
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            if full:
+                self.flush()
+            return
+        if full:
+            loop.run_in_executor(None, self.flush)
+        elif self._flusher is None or self._flusher.done():
+            self._flusher = loop.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_interval)
+        await asyncio.get_running_loop().run_in_executor(None, self.flush)
+
+    def flush(self):
+        """Writes the pending traces to the sink; blocking, so run it on a worker thread."""
+        with self._lock:
+            batch, self._pending = self._pending, []
+        if not batch:
+            return
+        try:
+            lines = "".join(json.dumps(self.document(*pending), separators=(",", ":")) + "\n" for pending in batch)
+            with self._write_lock:
+                os.makedirs(os.path.dirname(self.sink) or ".", exist_ok=True)
+                with open(self.sink, "a") as f:
+                    f.write(lines)
+                if self.on_flush is not None:
+                    self.on_flush()
+        except Exception as e:  # Tracing must never fail a request; the batch is lost.
+            self.counts["failed"] += len(batch)
+            print(f"Could not write {len(batch)} traces: {e}")
+        else:
+            self.counts["written"] += len(batch)
+
+
+async def traced_stream(trace: Trace, deltas, span: Span, *enclosing: Span):
+    """Re-yields `deltas` with a flush event per delta on `span`; ends the spans and exports at the end.
+
+    Only wrap sampled traces: unsampled requests should not pay for the extra generator.
+    """
+    count = 0
+    try:
+        async for delta in deltas:
+            count += 1
+            span.add_event("flush", index=count)
+            yield delta
+    finally:
+        span.end(deltas=count)
+        for outer in enclosing:
+            outer.end()
+        trace.finish()
+
+
+def recorded_request(path: str, request_id: str) -> Optional[Dict[str, Any]]:
+    """The options a traced request was made with, from the root span's attributes.
+
+    The prompt isn't traced; look it up in the generation log by the same request id.
+    """
+    with open(path) as f:
+        for line in f:
+            for resource in json.loads(line)["resourceSpans"]:
+                for scope in resource["scopeSpans"]:
+                    for span in scope["spans"]:
+                        if span["traceId"] != request_id or "parentSpanId" in span:
+                            continue
+                        attributes = {a["key"]: list(a["value"].values())[0] for a in span["attributes"]}
+                        if "request.options" in attributes:
+                            return json.loads(attributes["request.options"])
+    return None
+
+
+async def check():
+    import tempfile
+
+    # Sampling only depends on the trace id, so both tiers agree.
+    ids = [new_request_id() for _ in range(20000)]
+    assert all(is_sampled(i, 0.1) == is_sampled(i, 0.1) for i in ids)
+    assert 0.08 < sum(is_sampled(i, 0.1) for i in ids) / len(ids) < 0.12
+    assert not any(is_sampled(i, 0.0) for i in ids) and all(is_sampled(i, 1.0) for i in ids)
+
+    attributes = request_attributes({"prompt": "secret", "messages": [{"content": "secret"}], "max_tokens": 5})
+    assert attributes == {"request.prompt.chars": 6, "request.messages.items": 1, "request.options": {"max_tokens": 5}}
+    assert "secret" not in json.dumps(attributes)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        flushes = []
+        sink = os.path.join(tmp, "traces", "web.jsonl")
+        tracer = Tracer("web", sample_rate=1.0, sink=sink, batch_size=3, flush_interval=0.05, on_flush=lambda: flushes.append(1))
+        assert isinstance(Tracer("web", sample_rate=0.0).start_trace(), _NoopTrace)
+
+        async def deltas():
+            for text in ("a", "b", "c"):
+                yield text
+
+        # A traced request across both tiers, continued from the web tier's context.
+        web = tracer.start_trace()
+        root = web.span("completion", **request_attributes({"prompt": "secret", "temperature": 0.2}))
+        remote = web.span("remote_gen", parent=root)
+        container = tracer.continue_trace(web.context(remote))
+        assert container.trace_id == web.trace_id and container.parent_id == remote.span_id
+        with container.span("prefill"):
+            pass
+        decode = container.span("decode")
+        assert [d async for d in traced_stream(container, deltas(), decode)] == ["a", "b", "c"]
+        assert [d async for d in traced_stream(web, deltas(), remote, root)] == ["a", "b", "c"]
+        assert decode.attributes["deltas"] == 3 and len(decode.events) == 3 and root.end_ns is not None
+
+        # Two traces wait for the flush interval; a third fills the batch.
+        assert tracer.counts["written"] == 0 and not os.path.exists(sink)
+        await asyncio.sleep(0.2)
+        assert tracer.counts["written"] == 2 and len(flushes) == 1, tracer.counts
+        for _ in range(3):
+            tracer.start_trace().finish()
+        await asyncio.sleep(0.1)
+        assert tracer.counts == {"exported": 5, "written": 5, "dropped": 0, "failed": 0}, tracer.counts
+
+        with open(sink) as f:
+            lines = [json.loads(line) for line in f]
+        spans = [span for line in lines[:2] for span in line["resourceSpans"][0]["scopeSpans"][0]["spans"]]
+        assert {span["name"] for span in spans} == {"completion", "remote_gen", "prefill", "decode"}
+        assert "secret" not in json.dumps(lines)
+        assert recorded_request(sink, web.trace_id) == {"temperature": 0.2}
+        assert recorded_request(sink, new_request_id()) is None
+
+        # A full buffer drops traces instead of growing, and a failed write is counted, not raised.
+        bounded = Tracer("web", sample_rate=1.0, sink=os.path.join(tmp, "bounded.jsonl"), max_pending=2)
+        for _ in range(3):
+            bounded.start_trace().finish()
+        assert bounded.counts["dropped"] == 1
+        bounded.sink = tmp  # A directory can't be opened for writing.
+        bounded.flush()
+        assert bounded.counts["failed"] == 2
+
+
+if __name__ == "__main__":
+    asyncio.run(check())
+    print("tracing checks passed")
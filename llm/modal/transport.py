@@ -0,0 +1,215 @@
+# # Streaming transports for the completion endpoints
+#
+# The endpoints used to send every delta as uncompressed plain text. The encoders here let the
+# client pick something better through the usual headers, while plain text stays the default so
+# the existing playground frontend keeps working unchanged:
+#
+# - `Accept: text/event-stream` frames each delta as a proper SSE event (`data: ...` lines).
+# - `Accept: application/x-ndjson` (or `"stream_format": "ndjson"` in the payload) sends one JSON
+#   record per delta with the token ids and the time since the request started, followed by a
+#   final `{"done": true, ...}` summary record.
+# - Requests for several candidates (see `sampling.py`) are multiplexed, so they are sent as NDJSON
+#   unless SSE was asked for, where each record is JSON in its `data:` line.
+# - Records with an `"event"` key become named SSE events, and are dropped from raw text streams.
+# - `Accept: application/x-llm-records` (or `"stream_format": "records"`) sends the binary records
+#   from `records.py`. Uncompressed single streams in `text`, `sse` or `records` format skip this
+#   encoder entirely (see `StreamEncoder.raw`).
+# - `Accept-Encoding: gzip` / `deflate` compresses the stream with a single compressor that is
+#   sync-flushed on every write, so the client can decode each chunk as soon as it arrives while
+#   the dictionary keeps improving over the whole response. A sync flush costs a few bytes, which
+#   is more than a single-token delta saves, so compressed streams coalesce the deltas that arrive
+#   within `flush_interval` (50ms by default) into one flush.
+#
+# Run `python transport.py` to compare the bytes on the wire for each mode against the previous
+# behaviour on a synthetic completion.
+import asyncio
+import json
+import time
+import zlib
+from typing import Any, AsyncIterator, Dict, List, Mapping, Optional, Union
+
+import records
+
+Chunk = Union[str, bytes, Dict[str, Any]]
+
+FORMATS = {
+    "text": "text/event-stream",  # What the endpoints always sent: raw deltas.
+    "sse": "text/event-stream",
+    "ndjson": "application/x-ndjson",
+    "records": records.MEDIA_TYPE,
+}
+
+
+class StreamEncoder:
+    def __init__(self, format: str = "text", encoding: Optional[str] = None, flush_interval: float = 0.05):
+        self.format = format
+        self.encoding = encoding
+        self.flush_interval = flush_interval if encoding else 0.0
+        self.media_type = FORMATS[format]
+        self.headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+        if encoding:
+            self.headers["Content-Encoding"] = encoding
+        self._compressor = None
+        if encoding == "gzip":
+            self._compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        elif encoding == "deflate":
+            self._compressor = zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS)
+        self._t0 = time.time()
+        self._num_tokens = 0
+
+    @property
+    def wants_metadata(self) -> bool:
+        """Whether the model should yield `{"text", "token_ids", "t"}` dicts instead of strings."""
+        return self.format in ("ndjson", "records")
+
+    @property
+    def raw(self) -> bool:
+        """Whether packed records can be written as they are, with `records.RecordStreamingResponse`."""
+        return self.encoding is None and self.format in records.FORMATS
+
+    def encode(self, *chunks: Chunk) -> bytes:
+        return self._compress(b"".join(self._frame(chunk) for chunk in chunks))
+
+    def close(self) -> bytes:
+        tail = b""
+        if self.format == "ndjson":
+            summary = {"done": True, "num_tokens": self._num_tokens, "elapsed": round(time.time() - self._t0, 4)}
+            tail = (json.dumps(summary) + "\n").encode()
+        if self._compressor is None:
+            return tail
+        return self._compressor.compress(tail) + self._compressor.flush(zlib.Z_FINISH)
+
+    def _frame(self, chunk: Chunk) -> bytes:
+        if self.format == "records":
+            return records.frame(chunk, "records")
+        if self.format == "ndjson":
+            if isinstance(chunk, bytes):
+                chunk = records.unpack(chunk)[0]
+            record = chunk if isinstance(chunk, dict) else {"text": chunk}
+            self._num_tokens += len(record.get("token_ids", ()))
+            return (json.dumps(record, separators=(",", ":")) + "\n").encode()
+        if isinstance(chunk, dict) and "event" in chunk:
+            # Out-of-band events (e.g. cold-start ETAs from `warmup.py`); raw text has no room for them.
+            if self.format == "text":
+                return b""
+            data = json.dumps({k: v for k, v in chunk.items() if k != "event"}, separators=(",", ":"))
+            return f"event: {chunk['event']}\ndata: {data}\n\n".encode()
+        if isinstance(chunk, dict) and ("index" in chunk or "text" not in chunk):
+            # Multiplexed candidates and control records only make sense as JSON.
+            text = json.dumps(chunk, separators=(",", ":"))
+        else:
+            text = chunk["text"] if isinstance(chunk, dict) else chunk
+        if self.format == "sse":
+            return ("".join(f"data: {line}\n" for line in text.split("\n")) + "\n").encode()
+        return text.encode()
+
+    def _compress(self, data: bytes) -> bytes:
+        if self._compressor is None:
+            return data
+        return self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    async def stream(self, chunks: AsyncIterator[Chunk]) -> AsyncIterator[bytes]:
+        if not self.flush_interval:
+            async for chunk in chunks:
+                yield self.encode(chunk)
+            yield self.close()
+            return
+
+        # Wait for the next delta without cancelling it, so a timeout only means "flush what we have".
+        iterator = chunks.__aiter__()
+        pending: List[Chunk] = []
+        deadline = None
+        next_chunk = asyncio.ensure_future(iterator.__anext__())
+        try:
+            while True:
+                timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+                done, _ = await asyncio.wait({next_chunk}, timeout=timeout)
+                if not done:
+                    yield self.encode(*pending)
+                    pending, deadline = [], None
+                    continue
+                try:
+                    pending.append(next_chunk.result())
+                except StopAsyncIteration:
+                    break
+                if deadline is None:
+                    deadline = time.monotonic() + self.flush_interval
+                next_chunk = asyncio.ensure_future(iterator.__anext__())
+        finally:
+            if not next_chunk.done():
+                next_chunk.cancel()
+        if pending:
+            yield self.encode(*pending)
+        yield self.close()
+
+
+def _accepts(header: str, value: str) -> bool:
+    for part in header.split(","):
+        name, *params = [p.strip() for p in part.split(";")]
+        if name.lower() != value:
+            continue
+        q = next((p[2:] for p in params if p.startswith("q=")), "1")
+        try:
+            return float(q) > 0
+        except ValueError:
+            return True
+    return False
+
+
+def negotiate(headers: Mapping[str, str], requested: Optional[str] = None, multiplexed: bool = False) -> StreamEncoder:
+    """Picks the stream format and content encoding for a request.
+
+    `multiplexed` streams (several candidates at once) can't be told apart as raw text, so they
+    fall back to NDJSON instead.
+    """
+    accept = headers.get("accept", "")
+    if requested in FORMATS:
+        format = requested
+    elif _accepts(accept, records.MEDIA_TYPE):
+        format = "records"
+    elif _accepts(accept, "application/x-ndjson"):
+        format = "ndjson"
+    elif _accepts(accept, "text/event-stream"):
+        format = "sse"
+    else:
+        format = "text"
+    if multiplexed and format == "text":
+        format = "ndjson"
+
+    accept_encoding = headers.get("accept-encoding", "")
+    encoding = next((e for e in ("gzip", "deflate") if _accepts(accept_encoding, e)), None)
+    return StreamEncoder(format, encoding)
+
+
+def benchmark(deltas, token_ids=None, deltas_per_flush: int = 1) -> Dict[str, int]:
+    """Bytes on the wire for `deltas` in each transport, next to the old behaviour.
+
+    `deltas_per_flush` models how many deltas land in one `flush_interval` for compressed streams.
+    """
+    results = {"legacy_falcon": len(("...\n\n" + "\n" * 14 + "".join(deltas)).encode())}
+    results["legacy_text"] = len("".join(deltas).encode())
+    chunks = [
+        {"text": delta, "token_ids": token_ids[i], "t": 0.01 * i} if token_ids else delta
+        for i, delta in enumerate(deltas)
+    ]
+    for format in ("text", "sse", "ndjson", "records"):
+        for encoding in (None, "gzip", "deflate"):
+            encoder = StreamEncoder(format, encoding)
+            step = deltas_per_flush if encoding else 1
+            size = sum(len(encoder.encode(*chunks[i : i + step])) for i in range(0, len(chunks), step))
+            size += len(encoder.close())
+            results[f"{format}+{encoding or 'identity'}"] = size
+    return results
+
+
+if __name__ == "__main__":
+    import random
+
+    random.seed(0)
+    words = "the fox saw some grapes hanging from a high vine and tried to reach them but could not".split()
+    deltas = [" " + random.choice(words) for _ in range(1000)]
+    token_ids = [[random.randrange(32000)] for _ in deltas]
+    for per_flush in (1, 4, 16):
+        print(f"{per_flush} delta(s) per compressed flush:")
+        for name, size in benchmark(deltas, token_ids, per_flush).items():
+            print(f"{name:>20}: {size:>7} bytes")
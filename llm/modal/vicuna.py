@@ -8,24 +8,34 @@ please check the license before using for commercial purposes!
 import time
 from pathlib import Path
 
-from modal import Image, Stub, method
+from modal import Image, Stub, Volume, method
+
+from budget import ContextBudget
+from stopping import StoppingEngine
+from weights import VOLUME_NAME, WEIGHTS_DIR, materialize, populate
 
 stub = Stub(name="llama-vicuna")
 
 MODEL_NAME = "anon8231489123/vicuna-13b-GPTQ-4bit-128g"
+MODEL_REVISION = "main"
+MAX_NEW_TOKENS = 512
+# Vicuna's context window. Long conversations keep the template and the most recent turns that fit.
+budget = ContextBudget(2048, default_max_tokens=MAX_NEW_TOKENS)
 
 
-def download_model():
-    from huggingface_hub import snapshot_download
-
+def link_model():
+    """Lays the weights out where FastChat expects them, as symlinks into the shared weights volume."""
     # Match what FastChat expects
     # https://github.com/thisserand/FastChat/blob/4a57c928a906705404eae06f7a44b4da45828487/download-model.py#L203
     output_folder = f"{'_'.join(MODEL_NAME.split('/')[-2:])}"
 
-    snapshot_download(
-        local_dir=Path("/FastChat", "models", output_folder),
-        repo_id=MODEL_NAME,
-    )
+    dest = str(Path("/FastChat", "models", output_folder))
+    try:
+        return materialize(MODEL_NAME, MODEL_REVISION, dest=dest)
+    except FileNotFoundError:
+        populate(MODEL_NAME, MODEL_REVISION)
+        weights_volume.commit()
+        return materialize(MODEL_NAME, MODEL_REVISION, dest=dest)
 
 
 stub.vicuna_image = (
@@ -47,8 +57,8 @@ stub.vicuna_image = (
         "cd /FastChat/repositories/GPTQ-for-LLaMa && python setup_cuda.py install",
         gpu="any",
     )
-    .run_function(download_model)
 )
+weights_volume = Volume.persisted(VOLUME_NAME)
 
 ""
 
@@ -70,10 +80,16 @@ if stub.is_inside(stub.vicuna_image):
     from transformers import AutoTokenizer
 
 
-@stub.cls(image=stub.vicuna_image, gpu="A10G", container_idle_timeout=300)
+@stub.cls(
+    image=stub.vicuna_image,
+    gpu="A10G",
+    container_idle_timeout=300,
+    volumes={WEIGHTS_DIR: weights_volume},
+)
 class Vicuna:
     def __enter__(self):
-        tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME)
+        model_dir = link_model()
+        tokenizer = AutoTokenizer.from_pretrained(model_dir, use_fast=True)
 
         print("Loading GPTQ quantized model...")
         model = load_quantized(MODEL_NAME)
@@ -84,7 +100,7 @@ class Vicuna:
         print(f"Model loaded in {time.time() - t0:.2f}s")
 
     @method()
-    async def generate(self, input, history=[]):
+    async def generate(self, input, history=[], stopping=None):
         if input == "":
             return
 
@@ -94,7 +110,22 @@ class Vicuna:
 
         assert len(history) % 2 == 0, "History must be an even number of messages"
 
-        for i in range(0, len(history), 2):
+        # One batched tokenization of the prompt without history and of every past message as the
+        # template renders it; whole user/assistant pairs are then dropped, oldest first, to fit.
+        bare = conv.copy()
+        bare.append_message(conv.roles[0], input)
+        bare.append_message(conv.roles[1], None)
+        turns = [f"{conv.roles[i % 2]}: {message}{conv.sep}" for i, message in enumerate(history)]
+        encoded = self.tokenizer([bare.get_prompt()] + turns, add_special_tokens=False)["input_ids"]
+        counts = [len(ids) for ids in encoded]
+        kept, fitted = budget.fit_turns(counts[1:], counts[0] + 1, MAX_NEW_TOKENS, turn_size=2)  # + BOS
+        if fitted.truncated_tokens:
+            print(
+                f"Dropped {len(history) - len(kept)} history messages "
+                f"({fitted.truncated_tokens} tokens) to fit the context"
+            )
+
+        for i in kept[::2]:
             conv.append_message(conv.roles[0], history[i])
             conv.append_message(conv.roles[1], history[i + 1])
 
@@ -106,14 +137,30 @@ class Vicuna:
             "model": MODEL_NAME,
             "prompt": prompt,
             "temperature": 0.7,
-            "max_new_tokens": 512,
+            "max_new_tokens": MAX_NEW_TOKENS,
             "stop": conv.sep if conv.sep_style == SeparatorStyle.SINGLE else conv.sep2,
         }
 
+        # FastChat only knows the separator; extra stop strings are matched here, and breaking
+        # out of `generate_stream` stops its decode loop. The matcher also holds back partial
+        # separators ("#", "##") instead of stripping them after the fact.
+        stopper = StoppingEngine.from_payload(stopping or {}, default_stop=[params["stop"]])
         prev = len(prompt) + 2
         for outputs in generate_stream(self.tokenizer, self.model, params, "cuda"):
-            yield outputs[prev:].replace("##", "")
+            if len(outputs) < prev:
+                # FastChat trimmed the separator off the end; what we held back was part of it.
+                stopper.reason = "stop"
+                break
+            text, stopped = stopper.feed(outputs[prev:])
             prev = len(outputs)
+            if text:
+                yield text
+            if stopped:
+                break
+
+        tail = stopper.flush()
+        if tail:
+            yield tail
 
         print(f"Output generated in {time.time() - t0:.2f}s")
 
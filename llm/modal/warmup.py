@@ -0,0 +1,304 @@
+# # Readiness, warmup and cold-start ETAs
+#
+# Requests that arrived while a container was still in `__enter__` just waited, and some endpoints
+# kept the connection busy with a fake "Loading model" string or a block of newlines. Instead:
+#
+# - Each GPU container runs a short warmup generation at the end of `__enter__` (for vLLM through
+#   the synchronous engine, before the async loop exists; for transformers it also triggers CUDA
+#   kernel selection and `torch.compile`). Modal only routes inputs to a container once `__enter__`
+#   returns, so a container that answers its `ready` method has a warm engine. A failed warmup
+#   raises, and Modal replaces the container.
+# - Containers record when they start, when they became ready and how long the cold start took (an
+#   EWMA) in a Modal `Dict`.
+# - The web tier's `ReadinessProbe` never sends work to a GPU container to find out: it reads the
+#   GPU function's `get_current_stats` (runners and backlog) and that `Dict`, and caches the answer
+#   for a few seconds. No runners, or a backlog, or only the container that started last and hasn't
+#   finished warming up, means a request will wait; the ETA comes from the recorded cold starts.
+#   A probe that can't get the stats reports "unknown" and is treated as ready.
+# - `with_eta` runs the probe alongside the real request. If the first delta comes before the probe
+#   says "not ready", nothing changes; otherwise clients get `{"event": "status", "eta_s": ...}`
+#   records (a named SSE event, or an NDJSON record; raw text clients just wait) with a countdown
+#   until the first delta. The probe never delays a request to a warm container.
+#
+# Run `python warmup.py` to check the probe's states and `with_eta` against fake stats.
+import asyncio
+import time
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Optional
+
+CONTAINER_STARTED_AT = time.time()  # Close enough: the app module imports this at container start.
+
+
+def _store_get(store, key: str, default=None):
+    try:
+        return store[key]
+    except KeyError:
+        return default
+
+
+async def _store_get_aio(store, key: str, default=None):
+    try:
+        return await store.get.aio(key)
+    except KeyError:
+        return default
+
+
+class Readiness:
+    """In-container readiness: `starting` until `warmup` succeeds, then `ready`."""
+
+    def __init__(self, store=None, started_at: float = CONTAINER_STARTED_AT, alpha: float = 0.3):
+        self.store = store
+        self.started_at = started_at
+        self.alpha = alpha
+        self.state = "starting"
+        self.ready_at: Optional[float] = None
+        self.warmup_s: Optional[float] = None
+        self._publish("starting_since", started_at)
+
+    def _publish(self, key: str, value: Any):
+        if self.store is None:
+            return
+        try:
+            self.store[key] = value
+        except Exception as e:  # Readiness bookkeeping must never take the container down.
+            print(f"Could not record {key}: {e}")
+
+    def warmup(self, run: Callable[[], Any]) -> Any:
+        """Runs a warmup generation; the container is ready once it returns."""
+        t0 = time.time()
+        self.state = "warming"
+        try:
+            result = run()
+        except Exception:
+            self.state = "failed"
+            raise
+        self.ready_at = time.time()
+        self.warmup_s = self.ready_at - t0
+        self.state = "ready"
+        self._publish("ready_at", self.ready_at)
+
+        cold_start_s = self.ready_at - self.started_at
+        previous = _store_get(self.store, "cold_start_s") if self.store is not None else None
+        if previous is not None:
+            cold_start_s = (1 - self.alpha) * previous + self.alpha * cold_start_s
+        self._publish("cold_start_s", cold_start_s)
+        print(f"Warmup done in {self.warmup_s:.2f}s, ready {self.ready_at - self.started_at:.2f}s after start")
+        return result
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "state": self.state,
+            "started_at": self.started_at,
+            "ready_at": self.ready_at,
+            "warmup_s": self.warmup_s,
+        }
+
+
+def warmup_llm_engine(llm_engine, prompt: str = "Hello", max_tokens: int = 8) -> str:
+    """Runs one short request through a vLLM `LLMEngine` synchronously.
+
+    Use the engine under `AsyncLLMEngine.engine` from `__enter__`: the async background loop is
+    started lazily by the first `generate`, on the event loop that serves requests.
+    """
+    from vllm import SamplingParams
+
+    request_id = "warmup"
+    llm_engine.add_request(request_id, prompt, SamplingParams(max_tokens=max_tokens))
+    text = ""
+    while llm_engine.has_unfinished_requests():
+        for output in llm_engine.step():
+            if output.request_id == request_id and output.finished:
+                text = output.outputs[0].text
+    return text
+
+
+class ReadinessProbe:
+    """Web-tier view of whether a warm container is available, cached for `ttl` seconds.
+
+    `stats` returns the GPU function's `FunctionStats`, e.g. `Model().completion_stream.get_current_stats.aio()`.
+    """
+
+    def __init__(
+        self,
+        stats: Callable[[], Awaitable[Any]],
+        store=None,
+        default_cold_start: float = 60.0,
+        timeout: float = 0.5,
+        ttl: float = 5.0,
+    ):
+        self.stats = stats
+        self.store = store
+        self.default_cold_start = default_cold_start
+        self.timeout = timeout
+        self.ttl = ttl
+        self._cached: Optional[Dict[str, Any]] = None
+        self._checked_at = 0.0
+
+    async def eta(self) -> float:
+        """Seconds until a container that is starting now (or started last) should be ready."""
+        cold_start = self.default_cold_start
+        since = None
+        if self.store is not None:
+            cold_start = await _store_get_aio(self.store, "cold_start_s", cold_start)
+            since = await _store_get_aio(self.store, "starting_since")
+        elapsed = time.time() - since if since else 0.0
+        if elapsed > cold_start:
+            # That container is done (or gone); a new one starts from scratch.
+            elapsed = 0.0
+        return max(1.0, cold_start - elapsed)
+
+    async def check(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        if self._cached is not None and now - self._checked_at < self.ttl:
+            return self._cached
+        try:
+            status = await asyncio.wait_for(self._status(), self.timeout)
+        except Exception as e:  # Not knowing must not hold up or fail the request.
+            print(f"Could not check readiness: {type(e).__name__}: {e}")
+            status = {"ready": None, "state": "unknown", "eta_s": None}
+        self._cached, self._checked_at = status, now
+        return status
+
+    async def _status(self) -> Dict[str, Any]:
+        stats = await self.stats()
+        if not stats.num_total_runners:
+            # The request itself will start a container.
+            cold_start = self.default_cold_start
+            if self.store is not None:
+                cold_start = await _store_get_aio(self.store, "cold_start_s", cold_start)
+            return {"ready": False, "state": "cold", "eta_s": round(max(1.0, float(cold_start)), 1)}
+        if stats.backlog:
+            # Inputs are already waiting for a free or new container; assume the next one is starting.
+            return {"ready": False, "state": "queued", "eta_s": round(await self.eta(), 1)}
+        if stats.num_total_runners == 1 and self.store is not None:
+            since = await _store_get_aio(self.store, "starting_since")
+            ready_at = await _store_get_aio(self.store, "ready_at")
+            if since and (ready_at is None or ready_at < since):
+                return {"ready": False, "state": "starting", "eta_s": round(await self.eta(), 1)}
+        return {"ready": True, "state": "ready", "eta_s": 0.0}
+
+
+async def with_eta(deltas: AsyncIterator[Any], status: Awaitable[Dict[str, Any]], interval: float = 5.0):
+    """Re-yields `deltas`; while waiting for the first one on a cold backend, yields status records."""
+    iterator = deltas.__aiter__()
+    first = asyncio.ensure_future(iterator.__anext__())
+    status = asyncio.ensure_future(status)
+    try:
+        done, _ = await asyncio.wait({first, status}, return_when=asyncio.FIRST_COMPLETED)
+        report = None
+        if first not in done and status.exception() is None:
+            report = status.result()
+        if report is not None and report["ready"] is False:
+            t0 = time.monotonic()
+            while True:
+                remaining = max(0.0, report["eta_s"] - (time.monotonic() - t0))
+                yield {"event": "status", "state": report["state"], "eta_s": round(remaining, 1)}
+                done, _ = await asyncio.wait({first}, timeout=interval)
+                if done:
+                    break
+        try:
+            item = await first
+        except StopAsyncIteration:
+            return
+        yield item
+    finally:
+        for task in (first, status):
+            if not task.done():
+                task.cancel()
+    async for item in iterator:
+        yield item
+
+
+async def check():
+    from types import SimpleNamespace
+
+    class FakeDict(dict):
+        """The parts of a Modal `Dict` used here: item access, and `get.aio` raising KeyError."""
+
+        def __init__(self, **items):
+            super().__init__(**items)
+
+            async def get_aio(key):
+                return self[key]
+
+            self.get = SimpleNamespace(aio=get_aio)
+
+    def probe(runners: int, backlog: int = 0, store=None, **kwargs) -> ReadinessProbe:
+        async def stats():
+            return SimpleNamespace(num_total_runners=runners, backlog=backlog)
+
+        return ReadinessProbe(stats, store, default_cold_start=30.0, **kwargs)
+
+    # Containers publish when they started and became ready, and an EWMA of their cold starts.
+    store = FakeDict(cold_start_s=10.0)
+    readiness = Readiness(store, started_at=time.time() - 20, alpha=0.5)
+    assert store["starting_since"] == readiness.started_at and readiness.state == "starting"
+    assert readiness.warmup(lambda: "hi") == "hi" and readiness.state == "ready"
+    assert store["ready_at"] == readiness.ready_at and 14.9 < store["cold_start_s"] < 15.1, store
+
+    now = time.time()
+    assert await probe(0).check() == {"ready": False, "state": "cold", "eta_s": 30.0}
+    assert (await probe(0, store=FakeDict(cold_start_s=12.0)).check())["eta_s"] == 12.0
+    queued = await probe(1, backlog=3, store=FakeDict(cold_start_s=20.0, starting_since=now - 5)).check()
+    assert queued["state"] == "queued" and 14 <= queued["eta_s"] <= 15, queued
+    starting = await probe(1, store=FakeDict(cold_start_s=20.0, starting_since=now - 5, ready_at=now - 60)).check()
+    assert starting["state"] == "starting" and starting["ready"] is False, starting
+    assert (await probe(1, store=FakeDict(starting_since=now - 5)).check())["state"] == "starting"
+    assert (await probe(1, store=FakeDict(starting_since=now - 60, ready_at=now - 50)).check())["ready"] is True
+    assert (await probe(2, store=FakeDict(starting_since=now - 5)).check())["ready"] is True
+    assert (await probe(1).check())["ready"] is True
+
+    async def failing_stats():
+        raise ConnectionError("stats unavailable")
+
+    async def slow_stats():
+        await asyncio.sleep(10)
+
+    unknown = {"ready": None, "state": "unknown", "eta_s": None}
+    assert await ReadinessProbe(failing_stats).check() == unknown
+    assert await ReadinessProbe(slow_stats, timeout=0.01).check() == unknown
+
+    # The answer is cached for `ttl` seconds.
+    calls = []
+
+    async def counted_stats():
+        calls.append(1)
+        return SimpleNamespace(num_total_runners=1, backlog=0)
+
+    cached = ReadinessProbe(counted_stats, ttl=60)
+    await cached.check()
+    await cached.check()
+    assert len(calls) == 1
+
+    async def deltas(first_after: float):
+        await asyncio.sleep(first_after)
+        for text in ("a", "b"):
+            yield text
+
+    async def status(report, after: float = 0.0):
+        await asyncio.sleep(after)
+        return report
+
+    async def collect(stream):
+        return [item async for item in stream]
+
+    cold = {"ready": False, "state": "cold", "eta_s": 30.0}
+    # A warm backend's first delta beats the probe: nothing changes.
+    assert await collect(with_eta(deltas(0), status(cold, after=0.05))) == ["a", "b"]
+    # A cold backend: countdown records until the first delta, then the deltas.
+    items = await collect(with_eta(deltas(0.12), status(cold), interval=0.05))
+    events = [item for item in items if isinstance(item, dict)]
+    assert items[len(events) :] == ["a", "b"] and len(events) >= 2, items
+    assert all(e["event"] == "status" and e["state"] == "cold" for e in events)
+    assert events[0]["eta_s"] >= events[-1]["eta_s"]
+    # An unknown or failed probe is treated as ready.
+    assert await collect(with_eta(deltas(0.05), status(unknown))) == ["a", "b"]
+
+    async def failing_status():
+        raise ConnectionError("stats unavailable")
+
+    assert await collect(with_eta(deltas(0.05), failing_status())) == ["a", "b"]
+
+
+if __name__ == "__main__":
+    asyncio.run(check())
+    print("warmup checks passed")
@@ -0,0 +1,276 @@
+# # Content-addressed model weights on a shared volume
+#
+# Every app used to `snapshot_download` its model inside `run_function`, baking many GB into its
+# own image layer. Any change to an earlier layer (a pip pin) re-downloaded everything, and apps
+# with the same files each kept a copy. Instead, weights live once on a shared Modal volume:
+#
+#     /weights/blobs/<sha256>                              file contents, stored once
+#     /weights/manifests/<org>--<name>/<commit>.json       {"files": {path: sha256}, ...}
+#     /weights/refs/<org>--<name>/<revision>               commit a branch/tag resolved to
+#
+# `populate` resolves a model revision to its commit, stores each file under its SHA-256 (the Hub
+# already knows it for LFS files, so those are skipped without downloading when present) and writes
+# the manifest last, so a revision is populated once and an interrupted run just resumes.
+# `materialize` turns a manifest into a local directory of symlinks into the volume that
+# `from_pretrained` / vLLM can load from, and the volume pages file contents in lazily as they are
+# read. Each app's `populate_weights` writes to the volume; model containers only read it, unless
+# they are the first to start on a revision nobody populated, in which case `ensure` does it once.
+#
+# Run `python weights.py` to check the layout, deduplication and resumption against a fake Hub in
+# a temporary directory.
+import hashlib
+import json
+import os
+import shutil
+from typing import Any, Callable, Dict, Iterable, Optional, Union
+
+WEIGHTS_DIR = "/weights"
+VOLUME_NAME = "llm-weights"
+
+
+def _slug(repo_id: str) -> str:
+    return repo_id.replace("/", "--")
+
+
+def sha256_file(path: str, chunk_size: int = 1 << 24) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _lfs_sha256(sibling) -> Optional[str]:
+    lfs = getattr(sibling, "lfs", None)
+    if isinstance(lfs, dict):  # huggingface_hub < 0.16
+        return lfs.get("sha256")
+    return getattr(lfs, "sha256", None)
+
+
+def _matches(path: str, allow: Iterable[str], ignore: Iterable[str]) -> bool:
+    from fnmatch import fnmatch
+
+    allow, ignore = list(allow), list(ignore)
+    if allow and not any(fnmatch(path, pattern) for pattern in allow):
+        return False
+    return not any(fnmatch(path, pattern) for pattern in ignore)
+
+
+def _write_atomic(path: str, text: str):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.tmp{os.getpid()}"
+    with open(tmp, "w") as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+
+def manifest_path(root: str, repo_id: str, commit: str) -> str:
+    return os.path.join(root, "manifests", _slug(repo_id), f"{commit}.json")
+
+
+def resolve(repo_id: str, revision: str = "main", root: str = WEIGHTS_DIR) -> Optional[str]:
+    """The commit `revision` was populated as, from the volume alone (no network)."""
+    if os.path.exists(manifest_path(root, repo_id, revision)):
+        return revision
+    try:
+        with open(os.path.join(root, "refs", _slug(repo_id), revision)) as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return None
+
+
+def load_manifest(repo_id: str, revision: str = "main", root: str = WEIGHTS_DIR) -> Optional[Dict[str, Any]]:
+    commit = resolve(repo_id, revision, root)
+    if commit is None:
+        return None
+    try:
+        with open(manifest_path(root, repo_id, commit)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def populate(
+    repo_id: str,
+    revision: str = "main",
+    root: str = WEIGHTS_DIR,
+    allow_patterns: Union[str, Iterable[str]] = (),
+    ignore_patterns: Union[str, Iterable[str]] = (),
+    token: Optional[str] = None,
+    model_info: Optional[Callable[..., Any]] = None,
+    download: Optional[Callable[..., str]] = None,
+) -> Dict[str, Any]:
+    """Stores the files of `repo_id@revision` on the volume; a no-op if that commit is already there.
+
+    `model_info` and `download` default to `HfApi().model_info` and `hf_hub_download`.
+    """
+    if model_info is None or download is None:
+        from huggingface_hub import HfApi, hf_hub_download
+
+        model_info = model_info or HfApi().model_info
+        download = download or hf_hub_download
+
+    allow = [allow_patterns] if isinstance(allow_patterns, str) else list(allow_patterns)
+    ignore = [ignore_patterns] if isinstance(ignore_patterns, str) else list(ignore_patterns)
+
+    info = model_info(repo_id, revision=revision, token=token, files_metadata=True)
+    commit = info.sha
+    existing = load_manifest(repo_id, commit, root)
+    if existing is not None:
+        print(f"{repo_id}@{commit[:10]} is already populated")
+        _write_atomic(os.path.join(root, "refs", _slug(repo_id), revision), commit)
+        return existing
+
+    blobs = os.path.join(root, "blobs")
+    staging = os.path.join(root, "staging", _slug(repo_id), commit)
+    os.makedirs(blobs, exist_ok=True)
+    files, fetched, reused = {}, 0, 0
+    for sibling in info.siblings:
+        path = sibling.rfilename
+        if not _matches(path, allow, ignore):
+            continue
+        digest = _lfs_sha256(sibling)
+        if digest and os.path.exists(os.path.join(blobs, digest)):
+            files[path] = digest
+            reused += 1
+            continue
+
+        local = download(
+            repo_id, path, revision=commit, token=token, local_dir=staging, local_dir_use_symlinks=False
+        )
+        digest = sha256_file(local)
+        blob = os.path.join(blobs, digest)
+        if os.path.exists(blob):
+            os.remove(local)
+            reused += 1
+        else:
+            shutil.move(local, blob)
+            fetched += 1
+        files[path] = digest
+
+    shutil.rmtree(staging, ignore_errors=True)
+    manifest = {"repo_id": repo_id, "commit": commit, "files": files}
+    _write_atomic(manifest_path(root, repo_id, commit), json.dumps(manifest, indent=1))
+    _write_atomic(os.path.join(root, "refs", _slug(repo_id), revision), commit)
+    print(f"Populated {repo_id}@{commit[:10]}: {fetched} files downloaded, {reused} already stored")
+    return manifest
+
+
+def materialize(
+    repo_id: str,
+    revision: str = "main",
+    root: str = WEIGHTS_DIR,
+    dest: Optional[str] = None,
+) -> str:
+    """A local directory laid out like the repo, whose files are symlinks into the volume's blobs."""
+    manifest = load_manifest(repo_id, revision, root)
+    if manifest is None:
+        raise FileNotFoundError(
+            f"{repo_id}@{revision} is not on the weights volume; run the app's `populate_weights` first"
+        )
+    dest = dest or os.path.join("/tmp/models", _slug(repo_id), manifest["commit"])
+    for path, digest in manifest["files"].items():
+        link = os.path.join(dest, path)
+        if os.path.lexists(link):
+            continue
+        os.makedirs(os.path.dirname(link), exist_ok=True)
+        os.symlink(os.path.join(root, "blobs", digest), link)
+    return dest
+
+
+def ensure(repo_id: str, revision: str = "main", volume=None, root: str = WEIGHTS_DIR, **populate_kwargs) -> str:
+    """`materialize`, populating the volume first (and committing it) if this revision isn't there yet."""
+    try:
+        return materialize(repo_id, revision, root)
+    except FileNotFoundError:
+        print(f"{repo_id}@{revision} is not on the weights volume yet, populating it")
+    populate(repo_id, revision, root, **populate_kwargs)
+    if volume is not None:
+        volume.commit()
+    return materialize(repo_id, revision, root)
+
+
+def disk_usage(root: str = WEIGHTS_DIR) -> Dict[str, int]:
+    """Bytes stored on the volume next to what the manifests reference, to see the dedup."""
+    sizes = {entry.name: entry.stat().st_size for entry in os.scandir(os.path.join(root, "blobs"))}
+    referenced = 0
+    for model in os.scandir(os.path.join(root, "manifests")):
+        for manifest in os.scandir(model.path):
+            with open(manifest.path) as f:
+                referenced += sum(sizes.get(d, 0) for d in json.load(f)["files"].values())
+    return {"stored_bytes": sum(sizes.values()), "referenced_bytes": referenced}
+
+
+def check():
+    import tempfile
+    from types import SimpleNamespace
+
+    # Two repos sharing a tokenizer; the Hub knows the SHA-256 of LFS files only.
+    hub = {
+        "org/a": {"sha": "a" * 40, "files": {"config.json": b"{}", "tokenizer.json": b"tok", "model.safetensors": b"A" * 64}},
+        "org/b": {"sha": "b" * 40, "files": {"config.json": b"{ }", "tokenizer.json": b"tok", "model.bin": b"B" * 64}},
+    }
+    downloads = []
+
+    def model_info(repo_id, revision, token, files_metadata):
+        repo = hub[repo_id]
+        siblings = [
+            SimpleNamespace(rfilename=path, lfs={"sha256": hashlib.sha256(data).hexdigest()} if len(data) > 32 else None)
+            for path, data in repo["files"].items()
+        ]
+        return SimpleNamespace(sha=repo["sha"], siblings=siblings)
+
+    def download(repo_id, path, revision, token, local_dir, local_dir_use_symlinks):
+        downloads.append((repo_id, path))
+        local = os.path.join(local_dir, path)
+        os.makedirs(os.path.dirname(local), exist_ok=True)
+        with open(local, "wb") as f:
+            f.write(hub[repo_id]["files"][path])
+        return local
+
+    with tempfile.TemporaryDirectory() as root:
+        hub_fns = dict(model_info=model_info, download=download)
+        manifest = populate("org/a", "main", root, **hub_fns)
+        assert manifest["commit"] == "a" * 40 and len(downloads) == 3
+        for path, digest in manifest["files"].items():
+            with open(os.path.join(root, "blobs", digest), "rb") as f:
+                data = f.read()
+            assert data == hub["org/a"]["files"][path] and digest == hashlib.sha256(data).hexdigest()
+        assert resolve("org/a", "main", root) == "a" * 40 and resolve("org/a", "a" * 40, root) == "a" * 40
+        assert resolve("org/a", "dev", root) is None
+        assert os.path.exists(os.path.join(root, "manifests", "org--a", "a" * 40 + ".json"))
+        assert not os.path.exists(os.path.join(root, "staging", "org--a", "a" * 40))
+
+        # Populated revisions are a no-op; a new ref to the same commit only writes the ref.
+        populate("org/a", "main", root, **hub_fns)
+        populate("org/a", "v1", root, **hub_fns)
+        assert len(downloads) == 3 and resolve("org/a", "v1", root) == "a" * 40
+
+        # The shared tokenizer is downloaded (it isn't LFS) but stored once; patterns filter files.
+        populate("org/b", "main", root, ignore_patterns="*.bin", **hub_fns)
+        assert ("org/b", "model.bin") not in downloads and len(downloads) == 5
+        usage = disk_usage(root)
+        assert usage["referenced_bytes"] - usage["stored_bytes"] == len(b"tok"), usage
+
+        # A known LFS blob is reused without downloading.
+        hub["org/c"] = {"sha": "c" * 40, "files": {"model.safetensors": b"A" * 64}}
+        populate("org/c", "main", root, **hub_fns)
+        assert len(downloads) == 5
+
+        # Materialized directories are symlinks into the blobs, readable like the repo.
+        dest = materialize("org/a", "main", root, dest=os.path.join(root, "local", "a"))
+        for path, data in hub["org/a"]["files"].items():
+            assert os.path.islink(os.path.join(dest, path))
+            with open(os.path.join(dest, path), "rb") as f:
+                assert f.read() == data
+        try:
+            materialize("org/missing", "main", root)
+        except FileNotFoundError:
+            pass
+        else:
+            raise AssertionError("materialized a model that isn't on the volume")
+
+
+if __name__ == "__main__":
+    check()
+    print("weights checks passed")